@@ -0,0 +1,59 @@
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+
+# pragmas applied to every new connection unless overridden by the "pragmas" option
+DEFAULT_PRAGMAS = {
+    # readers no longer block the writer and the writer no longer blocks readers
+    "journal_mode": "WAL",
+    # in WAL mode only a checkpoint needs to sync, which is still safe against corruption
+    "synchronous": "NORMAL",
+    # milliseconds a connection waits for a lock held by another connection before
+    # raising "database is locked"
+    "busy_timeout": 5000,
+    # bytes of the database file read through memory mapping
+    "mmap_size": 268435456,
+    # negative values are KiB, so each connection caches up to 64 MiB of pages
+    "cache_size": -65536,
+    "temp_store": "MEMORY",
+}
+
+
+class DatabaseWrapper(SQLiteDatabaseWrapper):
+    """
+    SQLite backend tuned for concurrent access by the worker threads of the ASGI server.
+
+    Every new connection is configured with the pragmas in DEFAULT_PRAGMAS, which can be
+    overridden or extended by the "pragmas" dictionary in OPTIONS. The "transaction_mode"
+    option sets how transactions started by atomic() begin. With the default of
+    "IMMEDIATE" the write lock is taken when the transaction starts, so a concurrent
+    writer waits for busy_timeout instead of failing with "database is locked" when a
+    deferred transaction tries to upgrade its read lock.
+
+    Under ASGI each request runs on a thread of its own, which opens a connection of its
+    own, so the pragmas are applied to every connection rather than being paid for once
+    by a persistent connection. WAL is recorded in the database file, so only the other
+    pragmas take effect per connection, each of them a statement which does not touch
+    the disk.
+    """
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        # these options configure the backend and are not arguments of sqlite3.connect()
+        kwargs.pop("pragmas", None)
+        kwargs.pop("transaction_mode", None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+
+        options = self.settings_dict["OPTIONS"]
+        pragmas = {**DEFAULT_PRAGMAS, **options.get("pragmas", {})}
+        # in-memory databases, used by the test runner, cannot use WAL
+        if self.is_in_memory_db():
+            pragmas.pop("journal_mode", None)
+
+        for name, value in pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict["OPTIONS"].get("transaction_mode", "IMMEDIATE")
+        self.cursor().execute(f"BEGIN {mode}")
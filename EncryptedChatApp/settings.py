@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -52,6 +53,95 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Registry of online users and their socket channels, shared by all worker processes.
+# Use chat.presence.LocalPresenceRegistry when running a single process or in tests.
+CHAT_PRESENCE = {
+    'BACKEND': 'chat.presence.RedisPresenceRegistry',
+    'CONFIG': {
+        "hosts": [('127.0.0.1', 6379)],
+        # seconds a socket channel stays registered without a heartbeat
+        "ttl": 60,
+    },
+    # channel layer calls in flight at once when an event is sent to many users, or a socket
+    # channel joins or leaves the interest groups of many users
+    'FANOUT_CONCURRENCY': 50,
+}
+
+# Index of chat room memberships used for membership checks. The Redis backend shares
+# invalidations between worker processes; chat.membership.LocalMembershipIndex keeps
+# an LRU-bounded index in process memory for single process runs and tests.
+CHAT_MEMBERSHIP = {
+    'BACKEND': 'chat.membership.RedisMembershipIndex',
+    'CONFIG': {
+        "hosts": [('127.0.0.1', 6379)],
+    },
+}
+
+# Offline messages are written to the database in batches of up to batch_size, at most
+# max_delay seconds after being received. Senders wait while max_pending messages are
+# queued, and write directly once enqueue_timeout seconds have passed.
+CHAT_WRITE_BEHIND = {
+    "batch_size": 100,
+    "max_delay": 0.005,
+    "max_pending": 10000,
+    "enqueue_timeout": 1.0,
+}
+
+# Frames waiting to be sent to each socket connection. Up to batch_frames consecutive
+# frames totalling at most batch_bytes are sent together in one batch frame. When
+# max_frames frames are waiting, the overflow policy "disconnect" closes the connection,
+# while "drop_newest" and "drop_oldest" discard frames.
+CHAT_OUTBOUND = {
+    "max_frames": 1000,
+    "overflow": "disconnect",
+    "batch_frames": 20,
+    "batch_bytes": 4096,
+}
+
+# Token bucket rate limits of the frames each user sends over socket connections, as
+# (tokens added per second, bucket size) for each frame type, and default for frame types
+# not listed. The Redis backend limits each user across every worker process, while
+# chat.ratelimit.LocalRateLimiter limits each worker process separately.
+CHAT_RATE_LIMIT = {
+    'BACKEND': 'chat.ratelimit.RedisRateLimiter',
+    'CONFIG': {
+        "hosts": [('127.0.0.1', 6379)],
+        "limits": {
+            "send_msg": (10, 30),
+            "send_msg_multi": (10, 30),
+            "ack_msgs": (10, 30),
+            "join_room": (5, 20),
+            "create_room": (0.2, 5),
+            "add_member": (0.2, 5),
+            "remove_member": (0.2, 5),
+            "remove_room_member": (0.2, 5),
+            "request_res": (1, 10),
+            "pk_key_change": (0.1, 3),
+        },
+        "default": (5, 20),
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # sidebar data of each user, patched by socket events on any worker process. Memory
+    # is bounded by the timeout and by the maxmemory policy of the Redis server
+    'sidebar': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379',
+        'TIMEOUT': 3600,
+        'KEY_PREFIX': 'chat',
+    },
+    # failed password attempts, shared by every worker process so that lockouts apply to all
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379',
+        'KEY_PREFIX': 'users',
+    },
+}
+
 AUTH_USER_MODEL = 'users.AccountUser'
 
 ASGI_APPLICATION = 'EncryptedChatApp.asgi.application'
@@ -90,11 +180,60 @@ WSGI_APPLICATION = 'EncryptedChatApp.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# The database profile is selected by the CHAT_DB_PROFILE environment variable.
+# "sqlite-tuned" uses the SQLite backend in EncryptedChatApp.db.sqlite3, which enables
+# WAL, takes write locks when transactions begin and waits on locks held by other
+# threads rather than failing with "database is locked".
+# "postgres" allows any number of worker processes to write concurrently.
+DB_PROFILE = os.environ.get('CHAT_DB_PROFILE', 'sqlite')
+#
+# Django runs every request served over ASGI on a new thread, which opens a connection of
+# its own, while the database_sync_to_async calls made by socket consumers share one
+# thread and its connection. A persistent connection is only reused by the thread that
+# opened it, so it would never be reused by a request and would stay open until garbage
+# collected. Connections are therefore closed at the end of each request. A worker
+# process holds one connection per request being served at once, plus the one of its
+# socket consumers, so PostgreSQL should be reached through PgBouncer, whose pool size
+# rather than the max_connections of the server bounds the connections a burst of
+# requests opens.
+
+DATABASE_PROFILES = {
+    'sqlite': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    'sqlite-tuned': {
+        'ENGINE': 'EncryptedChatApp.db.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        # every request runs on a thread of its own, which would never reuse a persistent
+        # connection, so connections are closed at the end of each request
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            # overrides of EncryptedChatApp.db.sqlite3.base.DEFAULT_PRAGMAS
+            'pragmas': {},
+        },
+    },
+    'postgres': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'chat'),
+        'USER': os.environ.get('POSTGRES_USER', 'chat'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        # connections are pooled by PgBouncer rather than kept open by Django
+        'CONN_MAX_AGE': 0,
+        # set POSTGRES_PGBOUNCER=1 when connecting through PgBouncer in transaction
+        # pooling mode, which cannot keep server side cursors open between transactions
+        'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_PGBOUNCER') == '1',
+        'OPTIONS': {
+            'connect_timeout': 5,
+        },
+    },
+}
+
+DATABASES = {
+    'default': DATABASE_PROFILES[DB_PROFILE]
 }
 
 
@@ -116,6 +255,28 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Passwords are hashed and checked by a dedicated pool of threads, hashing at most workers
+# passwords at once with up to max_pending more waiting. Logins and registrations arriving
+# once the pool is full are answered with 429 Too Many Requests.
+PASSWORD_HASHING = {
+    "workers": 2,
+    "max_pending": 16,
+}
+
+# Failed password attempts allowed per username and per client IP address within window
+# seconds, after which attempts are locked out for base_lockout seconds, doubling with
+# each further failure up to max_lockout seconds. A session which verified its password
+# has its next verification within verified_ttl seconds accepted without hashing.
+LOGIN_THROTTLE = {
+    "cache": "throttle",
+    "user_attempts": 5,
+    "ip_attempts": 20,
+    "base_lockout": 1,
+    "max_lockout": 900,
+    "window": 3600,
+    "verified_ttl": 300,
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
@@ -0,0 +1,46 @@
+"""
+Settings for running the test suite without a Redis server.
+
+The database is still selected by the CHAT_DB_PROFILE environment variable, so that the
+suite can be run against each database profile. Every backend which is configured to
+use Redis is replaced by its in-process counterpart.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+CHAT_PRESENCE = {
+    **CHAT_PRESENCE,  # noqa: F405
+    'BACKEND': 'chat.presence.LocalPresenceRegistry',
+    'CONFIG': {},
+}
+
+CHAT_MEMBERSHIP = {
+    'BACKEND': 'chat.membership.LocalMembershipIndex',
+    'CONFIG': {},
+}
+
+# the local backend ignores the hosts of the Redis backend and keeps its limits
+CHAT_RATE_LIMIT = {
+    **CHAT_RATE_LIMIT,  # noqa: F405
+    'BACKEND': 'chat.ratelimit.LocalRateLimiter',
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sidebar': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sidebar',
+    },
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'throttle',
+    },
+}
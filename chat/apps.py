@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+
+class ChatConfig(AppConfig):
+    name = 'chat'
+
+    def ready(self):
+        from .membership import room_member_saved, room_members_changed
+        from .models import ChatRoom, RoomMember
+
+        # keep the membership index consistent with the RoomMember table
+        post_save.connect(room_member_saved, sender=RoomMember)
+        post_delete.connect(room_member_saved, sender=RoomMember)
+        m2m_changed.connect(room_members_changed, sender=ChatRoom.members.through)
@@ -0,0 +1,238 @@
+import datetime
+import json
+import uuid
+from collections import OrderedDict
+from django.core.serializers.json import DjangoJSONEncoder
+
+# frames of channel layer events encoded by this process, by frame id and wire format
+_encoded = OrderedDict()
+ENCODED_FRAMES = 1024
+
+
+class FrameEncoder(DjangoJSONEncoder):
+    """
+    JSON encoder of frames, which carries ciphertexts held as bytes as arrays of byte values.
+    """
+    def default(self, value):
+        if isinstance(value, bytes):
+            return list(value)
+        return super().default(value)
+
+
+class JSONCodec:
+    """
+    Default wire format of the chat socket, in which every frame is a JSON text message.
+
+    Ciphertexts and initialization vectors travel as arrays of byte values, and those of
+    saved messages as the JSON text of such an array. Ciphertexts sent by clients as text
+    travel unchanged.
+    """
+    subprotocol = None
+    # keyword argument of send() carrying frames in this wire format
+    send_key = "text_data"
+
+    def decode(self, text_data=None, bytes_data=None):
+        """
+        Decode a frame received from the client.
+
+        args:
+            text_data (str): the text message received, if any
+            bytes_data (bytes): the binary message received, if any
+
+        returns:
+            the decoded frame
+
+        raises:
+            ValueError: if the message is not valid JSON text
+        """
+        if text_data is None:
+            raise ValueError("binary frames require the msgpack subprotocol")
+        return json.loads(text_data)
+
+    def encode(self, frame):
+        """
+        Encode a frame to be sent to the client.
+
+        args:
+            frame (dict): the frame to send
+
+        returns:
+            dict: the keyword arguments of send() carrying the encoded frame
+        """
+        return {"text_data": json.dumps(frame, cls=FrameEncoder)}
+
+    def batch(self, frames):
+        """
+        Combine encoded frames into a single batch frame, whose content is the list of the
+        frames in order, without decoding and encoding them again.
+
+        args:
+            frames (list): the send() keyword arguments carrying each encoded frame
+
+        returns:
+            dict: the send() keyword arguments carrying the batch frame
+        """
+        return {"text_data": '{"type": "batch", "content": [' + ", ".join(frame["text_data"] for frame in frames) + "]}"}
+
+    def saved_ciphertext(self, value):
+        """
+        Convert a ciphertext or initialization vector saved on the database into the form
+        sent by this codec.
+
+        args:
+            value (str): the ciphertext as saved, normally the JSON text of an array of byte values
+
+        returns:
+            str: the saved text unchanged
+        """
+        return value
+
+
+class MsgpackCodec(JSONCodec):
+    """
+    Binary wire format negotiated with the "chat.msgpack.v1" subprotocol, in which every
+    frame is a MessagePack binary message with the same structure as the JSON frames.
+
+    Ciphertexts and initialization vectors travel as MessagePack bin values in both
+    directions, including those of saved messages, rather than as arrays of numbers.
+    Ciphertexts sent by clients as text travel unchanged.
+    """
+    subprotocol = "chat.msgpack.v1"
+    send_key = "bytes_data"
+
+    def decode(self, text_data=None, bytes_data=None):
+        import msgpack
+
+        if bytes_data is None:
+            raise ValueError("text frames are not accepted by the msgpack subprotocol")
+        return msgpack.unpackb(bytes_data, raw=False)
+
+    def encode(self, frame):
+        import msgpack
+
+        return {"bytes_data": msgpack.packb(frame, default=self.default)}
+
+    def batch(self, frames):
+        import msgpack
+
+        # a map of two entries holding the type and an array of the already encoded frames
+        header = b"\x82" + msgpack.packb("type") + msgpack.packb("batch") + msgpack.packb("content")
+        array = msgpack.Packer().pack_array_header(len(frames))
+        return {"bytes_data": header + array + b"".join(frame["bytes_data"] for frame in frames)}
+
+    def default(self, value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        raise TypeError(f"cannot encode {type(value).__name__}")
+
+    def saved_ciphertext(self, value):
+        # saved ciphertexts are the JSON text of an array of byte values, unless a client sent text
+        try:
+            decoded = json.loads(value)
+            if isinstance(decoded, list):
+                return bytes(decoded)
+        except (TypeError, ValueError):
+            pass
+        return value
+
+
+CODECS = [MsgpackCodec(), JSONCodec()]
+
+
+def negotiate_codec(subprotocols):
+    """
+    Select the wire format of a socket connection from the subprotocols offered by the
+    client, falling back to JSON when none of them is supported.
+
+    args:
+        subprotocols (list): the subprotocols offered by the client, in order of preference
+
+    returns:
+        JSONCodec: the codec of the first supported subprotocol, or the JSON codec
+    """
+    for subprotocol in subprotocols:
+        for codec in CODECS:
+            if codec.subprotocol == subprotocol:
+                return codec
+    return CODECS[-1]
+
+
+def prepare_frame(frame):
+    """
+    Wrap a frame to be carried through the channel layer in a channel layer event, so
+    that each receiving process encodes it once in each wire format its consumers use
+    with encode_prepared(), rather than once for each recipient.
+
+    args:
+        frame (dict): the frame, holding any ciphertexts as returned by wire_ciphertext()
+
+    returns:
+        dict: the frame and the id identifying its encodings
+    """
+    return {"frame": frame, "frame_id": uuid.uuid4().hex}
+
+
+def encode_prepared(event, codec):
+    """
+    Encode the frame of a channel layer event built with prepare_frame() in a wire format,
+    reusing the encoding made by this process for another recipient of the event.
+
+    args:
+        event (dict): the channel layer event carrying the frame
+        codec (JSONCodec): the codec of the wire format to encode the frame in
+
+    returns:
+        dict: the keyword arguments of send() carrying the encoded frame
+    """
+    key = (event["frame_id"], codec.send_key)
+    encoded = _encoded.get(key)
+    if encoded is None:
+        encoded = codec.encode(event["frame"])
+        _encoded[key] = encoded
+        if len(_encoded) > ENCODED_FRAMES:
+            _encoded.popitem(last=False)
+    else:
+        _encoded.move_to_end(key)
+    return encoded
+
+
+def wire_ciphertext(value):
+    """
+    Convert a ciphertext or initialization vector received from a client into the form
+    held by frames sent to other clients, which every wire format can carry.
+
+    args:
+        value (list | str | bytes): the ciphertext as received from the client
+
+    returns:
+        bytes | str: the ciphertext as bytes, or text sent by the client unchanged
+
+    raises:
+        ValueError: if an array holds values which are not byte values
+    """
+    if isinstance(value, list):
+        try:
+            return bytes(value)
+        except (TypeError, ValueError):
+            raise ValueError("ciphertexts must be arrays of byte values")
+    return value
+
+
+def stored_ciphertext(value):
+    """
+    Convert a ciphertext or initialization vector received from a client into the form
+    saved on the database, which is the JSON text of an array of byte values.
+
+    args:
+        value (list | str | bytes): the ciphertext as received from the client
+
+    returns:
+        list | str: the ciphertext in a form saved as the JSON text of an array
+
+    raises:
+        ValueError: if an array holds values which are not byte values
+    """
+    if isinstance(value, (list, bytes)):
+        # arrays are checked as they are before being sent to an online receiver
+        return list(wire_ciphertext(value))
+    return value
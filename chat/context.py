@@ -0,0 +1,54 @@
+class SessionContext:
+    """
+    Identity, public key and chat room memberships of the user of a socket connection,
+    loaded once when the connection is opened so that frames can be handled without
+    querying the database to learn who sent them.
+
+    The context is not kept in sync with the database by itself. The consumer updates
+    the chat rooms when the user of the connection joins or leaves one, and discards
+    the whole context upon a "context_invalidate" event, such as when the user saves
+    a new public key, is removed from a chat room by its owner, or joins or leaves a
+    chat room from another connection.
+    """
+    def __init__(self, user, rooms):
+        self.user = user
+        self.username = user.username
+        # primary keys of the chat rooms the user is a member of
+        self.rooms = rooms
+
+    @property
+    def public_key(self):
+        return self.user.public_key
+
+    def is_member(self, room_id):
+        """
+        Check whether the user is a member of a chat room.
+
+        args:
+            room_id (int): the primary key of the chat room
+
+        returns:
+            bool: True if the user is a member of the chat room
+        """
+        try:
+            return int(room_id) in self.rooms
+        except (TypeError, ValueError):
+            return False
+
+
+def load_session_context(username):
+    """
+    Load the session context of a user from the database.
+
+    args:
+        username (str): the username of the user
+
+    returns:
+        SessionContext: the session context of the user
+    """
+    from users.models import AccountUser
+    from .models import RoomMember
+
+    user = AccountUser.objects.get(username=username)
+    rooms = set(RoomMember.objects.filter(user=user).values_list("chat_room", flat=True))
+    return SessionContext(user, rooms)
@@ -0,0 +1,188 @@
+import bisect
+import time
+
+
+class FrameError(Exception):
+    """
+    Raised when a frame received from a client is malformed, so that an error response
+    can be sent back instead of the socket connection being closed.
+    """
+
+
+def compile_schema(schema, path="content"):
+    """
+    Compile a schema into a function which validates a value against it, raising a
+    FrameError describing the first mismatch.
+
+    A schema is either a dictionary mapping required keys to the schemas of their values,
+    a list holding the schema of every item of a list, or a type or tuple of types which
+    the value must be an instance of.
+
+    args:
+        schema (dict | list | type | tuple): the schema to compile
+        path (str): the location of the value in the frame, used in error messages
+
+    returns:
+        function: a function taking a value and raising FrameError if it does not match
+    """
+    if isinstance(schema, dict):
+        fields = {name: compile_schema(field, f"{path}.{name}") for name, field in schema.items()}
+
+        def validate(value):
+            if not isinstance(value, dict):
+                raise FrameError(f"{path} must be an object")
+            for name, validate_field in fields.items():
+                if name not in value:
+                    raise FrameError(f"{path}.{name} is required")
+                validate_field(value[name])
+        return validate
+
+    if isinstance(schema, list):
+        validate_item = compile_schema(schema[0], f"{path}[]")
+
+        def validate(value):
+            if not isinstance(value, list):
+                raise FrameError(f"{path} must be a list")
+            for item in value:
+                validate_item(item)
+        return validate
+
+    types = schema if isinstance(schema, tuple) else (schema,)
+    names = " or ".join(type_.__name__ for type_ in types)
+    # bool is a subclass of int, so booleans are only accepted where bool is expected
+    allow_bool = bool in types
+
+    def validate(value):
+        if not isinstance(value, types) or (isinstance(value, bool) and not allow_bool):
+            raise FrameError(f"{path} must be of type {names}")
+    return validate
+
+
+class Histogram:
+    """
+    Histogram of durations with fixed bucket bounds in seconds.
+    """
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        """
+        Retrieve the counts of each bucket along with the number, mean and maximum of the
+        observed durations.
+
+        returns:
+            dict: the histogram with durations in milliseconds
+        """
+        labels = [f"<={bound * 1000:g}ms" for bound in self.BOUNDS] + ["+inf"]
+        return {
+            "count": self.count,
+            "mean_ms": self.total * 1000 / self.count if self.count else 0.0,
+            "max_ms": self.max * 1000,
+            "buckets": dict(zip(labels, self.buckets))
+        }
+
+
+class FrameRegistry:
+    """
+    Registry mapping the type of each frame a client can send to the consumer method
+    handling it and the compiled schema of the frame's content.
+
+    Handlers are registered with the handler() decorator and called by dispatch(), which
+    validates the content of the frame before the handler runs and records how long each
+    handler took in a histogram per frame type.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.timings = {}
+        self.rejected = 0
+
+    def handler(self, frame_type, schema=None):
+        """
+        Decorator registering a consumer method as the handler of a frame type.
+
+        args:
+            frame_type (str): the type of frame handled by the method
+            schema (dict): the schema of the content of the frame, or None if the frame
+            has no content
+        """
+        validate = compile_schema(schema) if schema is not None else None
+
+        def register(function):
+            self.handlers[frame_type] = (function, validate)
+            self.timings[frame_type] = Histogram()
+            return function
+        return register
+
+    def frame_type(self, frame):
+        """
+        Retrieve the type of a frame, checking that it is one with a registered handler.
+
+        args:
+            frame: the decoded frame
+
+        returns:
+            str: the type of the frame
+
+        raises:
+            FrameError: if the frame has no type or an unknown type
+        """
+        if not isinstance(frame, dict) or not isinstance(frame.get("type"), str):
+            self.rejected += 1
+            raise FrameError("frames must be objects with a type")
+
+        if frame["type"] not in self.handlers:
+            self.rejected += 1
+            raise FrameError(f"unknown frame type {frame['type']}")
+        return frame["type"]
+
+    async def dispatch(self, consumer, frame, *args):
+        """
+        Validate a frame and call the handler of its type.
+
+        args:
+            consumer (AsyncWebsocketConsumer): the consumer which received the frame
+            frame: the decoded frame
+            args: further arguments passed to the handler after the content of the frame
+
+        raises:
+            FrameError: if the frame has an unknown type or does not match its schema
+        """
+        frame_type = self.frame_type(frame)
+        function, validate = self.handlers[frame_type]
+        content = frame.get("content")
+        if validate is not None:
+            try:
+                validate(content)
+            except FrameError:
+                self.rejected += 1
+                raise
+
+        start = time.perf_counter()
+        try:
+            await function(consumer, content, *args)
+        finally:
+            self.timings[frame_type].observe(time.perf_counter() - start)
+
+    def stats(self):
+        """
+        Retrieve the timing histogram of each frame type handled by this process and the
+        number of frames rejected.
+
+        returns:
+            dict: the histograms by frame type and the number of rejected frames
+        """
+        return {
+            "handlers": {frame_type: histogram.snapshot() for frame_type, histogram in self.timings.items()},
+            "rejected": self.rejected
+        }
@@ -0,0 +1,58 @@
+def get_queued_messages(username, after=0, limit=100):
+    """
+    Retrieve a page of the messages saved on the server for a user while they were offline.
+
+    args:
+        username (str): the username of the receiver of the messages
+        after (int): the primary key of the message after which the page starts
+        limit (int): the maximum number of messages in the page
+
+    returns:
+        list: a dictionary for each message in the order the messages were received
+    """
+    from .models import Message
+
+    # usernames are the primary keys of users, so the sender is available without a join
+    history = (
+        Message.objects
+        .filter(receiver_id=username, pk__gt=after)
+        .order_by('pk')
+        .values("pk", "sender_id", "content", "room_id", "date_time", "public_key", "iv")[:limit]
+    )
+
+    messages = []
+    for message in history:
+        messages.append({
+            "id": message["pk"],
+            "sender": message["sender_id"],
+            "content": message["content"],
+            "room_id": message["room_id"],
+            "date_time": message["date_time"],
+            "public_key": message["public_key"],
+            "iv": message["iv"]
+        })
+    return messages
+
+
+def delete_acknowledged_messages(username, served, ack, kept=()):
+    """
+    Delete the messages that were served to a user up to and including the message the
+    user acknowledged receiving, except those the user could not read.
+
+    Only messages which were actually served are deleted. A message saved with a
+    primary key below ack can be committed after the page was read, and must still be
+    served before it is deleted. Messages the client failed to decrypt or save are kept,
+    so that they are served again the next time the client drains its messages.
+
+    args:
+        username (str): the username of the receiver of the messages
+        served (list): the primary keys of the messages served to the user
+        ack (int): the primary key of the last message the user acknowledged
+        kept (iterable): the primary keys of the served messages the user could not read
+    """
+    from .models import Message
+
+    kept = set(kept)
+    acknowledged = [pk for pk in served if pk <= ack and pk not in kept]
+    if acknowledged:
+        Message.objects.filter(receiver_id=username, pk__in=acknowledged).delete()
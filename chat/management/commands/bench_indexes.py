@@ -0,0 +1,185 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from chat.history import get_queued_messages
+from chat.models import ChatRoom, FriendRequest, Message, RoomMember
+from users.models import AccountUser
+
+
+class Rollback(Exception):
+    """
+    Raised to roll back the seeded data once the benchmark has finished.
+    """
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed messages, chat rooms and friend requests inside a transaction and compare the "
+        "latency of the hot chat queries without and with the indexes declared on the chat "
+        "models. Everything is rolled back afterwards"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000, help="number of users to seed")
+        parser.add_argument("--rooms", type=int, default=100000, help="number of chat rooms to seed")
+        parser.add_argument("--messages", type=int, default=1000000, help="number of messages to seed")
+        parser.add_argument("--queries", type=int, default=200, help="number of times each query is run")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+
+        # SQLite can only change its schema inside a transaction with foreign key checks
+        # disabled, which cannot be done once the transaction has started
+        connection.disable_constraint_checking()
+        try:
+            with transaction.atomic():
+                usernames = self.seed(options["users"], options["rooms"], options["messages"])
+                indexes = self.model_indexes()
+
+                with connection.schema_editor() as editor:
+                    for model, index in indexes:
+                        editor.remove_index(model, index)
+                before = self.run(usernames, options["queries"])
+
+                with connection.schema_editor() as editor:
+                    for model, index in indexes:
+                        editor.add_index(model, index)
+                after = self.run(usernames, options["queries"])
+
+                self.stdout.write(f"{'query':<28} {'without p50 ms':>15} {'without p99 ms':>15} {'with p50 ms':>12} {'with p99 ms':>12}")
+                for name in before:
+                    self.stdout.write(
+                        f"{name:<28} {self.percentile(before[name], 50):>15.3f} {self.percentile(before[name], 99):>15.3f} "
+                        f"{self.percentile(after[name], 50):>12.3f} {self.percentile(after[name], 99):>12.3f}"
+                    )
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            connection.enable_constraint_checking()
+
+    def model_indexes(self):
+        """
+        Retrieve the indexes declared in the Meta of the chat models.
+
+        returns:
+            list: a tuple of the model and the index for each declared index
+        """
+        return [
+            (model, index)
+            for model in (RoomMember, ChatRoom, FriendRequest, Message)
+            for index in model._meta.indexes
+        ]
+
+    def seed(self, users, rooms, messages):
+        """
+        Seed users, chat rooms with their members, friend requests and messages using bulk
+        inserts.
+
+        args:
+            users (int): the number of users to create
+            rooms (int): the number of chat rooms to create
+            messages (int): the number of messages to create
+
+        returns:
+            list: the usernames of the seeded users
+        """
+        start = time.perf_counter()
+        now = timezone.now()
+
+        usernames = [f"bench-user-{i}" for i in range(users)]
+        AccountUser.objects.bulk_create(
+            [AccountUser(username=username, first_name="bench", last_name="user") for username in usernames],
+            batch_size=5000
+        )
+
+        # a third of the chat rooms are group chats, the rest are direct message chats
+        chat_rooms = ChatRoom.objects.bulk_create(
+            [
+                ChatRoom(name=f"bench-room-{i}", type=i % 3 == 0, owner_id=random.choice(usernames))
+                for i in range(rooms)
+            ],
+            batch_size=5000
+        )
+        room_members = {}
+        for room in chat_rooms:
+            room_members[room.pk] = random.sample(usernames, 4 if room.type else 2)
+
+        RoomMember.objects.bulk_create(
+            [
+                RoomMember(chat_room_id=room_id, user_id=username)
+                for room_id, members in room_members.items()
+                for username in members
+            ],
+            batch_size=5000
+        )
+        FriendRequest.objects.bulk_create(
+            [
+                FriendRequest(sender_id=members[0], receiver_id=members[1], room_id=room_id,
+                              status=FriendRequest.Status.ACCEPTED, chat_type=len(members) > 2)
+                for room_id, members in room_members.items()
+            ],
+            batch_size=5000
+        )
+
+        room_ids = list(room_members)
+        for offset in range(0, messages, 10000):
+            batch = []
+            for _ in range(min(10000, messages - offset)):
+                room_id = random.choice(room_ids)
+                sender, receiver = random.sample(room_members[room_id], 2)
+                batch.append(Message(sender_id=sender, receiver_id=receiver, content="[0]", room_id=room_id,
+                                     date_time=now, public_key={}, iv="[0]"))
+            Message.objects.bulk_create(batch)
+
+        self.stdout.write(f"seeded {users} users, {rooms} chat rooms and {messages} messages "
+                          f"in {time.perf_counter() - start:.1f}s")
+        return usernames
+
+    def run(self, usernames, queries):
+        """
+        Time each hot query against random users and chat rooms.
+
+        args:
+            usernames (list): the usernames of the seeded users
+            queries (int): the number of times each query is run
+
+        returns:
+            dict: the latencies in milliseconds of each query
+        """
+        timings = {
+            "queued messages": [],
+            "direct message requests": [],
+            "rooms of user": [],
+            "direct message rooms": [],
+        }
+
+        for _ in range(queries):
+            sender, receiver = random.sample(usernames, 2)
+
+            timings["queued messages"].append(self.time(lambda: get_queued_messages(receiver)))
+            timings["direct message requests"].append(self.time(
+                lambda: list(FriendRequest.objects.filter(sender=sender, receiver=receiver, chat_type=False))
+            ))
+            timings["rooms of user"].append(self.time(
+                lambda: list(RoomMember.objects.filter(user_id=sender).values_list("chat_room", flat=True))
+            ))
+            timings["direct message rooms"].append(self.time(
+                lambda: list(ChatRoom.objects.filter(members=sender, type=False).filter(members=receiver))
+            ))
+
+        return timings
+
+    def time(self, query):
+        start = time.perf_counter()
+        query()
+        return (time.perf_counter() - start) * 1000
+
+    def percentile(self, values, percent):
+        if len(values) < 2:
+            return values[0]
+        return statistics.quantiles(values, n=100)[percent - 1]
@@ -0,0 +1,68 @@
+import random
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from chat.presence import interest_group
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the fan-out cost of public key change notifications sent to a global "
+        "broadcast group against notifications sent to per-user interest groups"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 5000],
+                            help="numbers of online users to benchmark")
+        parser.add_argument("--contacts", type=int, default=20,
+                            help="number of users each user shares a chat room with")
+        parser.add_argument("--rotations", type=int, default=200,
+                            help="number of key changes sent for each number of online users")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+
+        self.stdout.write(f"{'users':>8} {'broadcast frames':>18} {'broadcast ms':>14} {'interest frames':>17} {'interest ms':>13}")
+        for users in options["users"]:
+            broadcast = async_to_sync(self.run)(users, options["contacts"], options["rotations"], False)
+            interest = async_to_sync(self.run)(users, options["contacts"], options["rotations"], True)
+            self.stdout.write(f"{users:>8} {broadcast[0]:>18} {broadcast[1]:>14.1f} {interest[0]:>17} {interest[1]:>13.1f}")
+
+    async def run(self, users, contacts, rotations, use_interest_groups):
+        """
+        Send key change notifications from random users through an in-memory channel
+        layer and count the frames that the receiving consumers would have to send.
+
+        args:
+            users (int): the number of online users
+            contacts (int): the number of users each user shares a chat room with
+            rotations (int): the number of key changes to send
+            use_interest_groups (bool): send to interest groups rather than the broadcast group
+
+        returns:
+            tuple: the number of frames delivered and the milliseconds spent sending them
+        """
+        layer = InMemoryChannelLayer(capacity=rotations + 1)
+        usernames = [f"user{i}" for i in range(users)]
+        channels = {username: await layer.new_channel() for username in usernames}
+
+        for username in usernames:
+            if use_interest_groups:
+                for contact in random.sample(usernames, min(contacts, users - 1)):
+                    if contact != username:
+                        await layer.group_add(interest_group(contact), channels[username])
+            else:
+                await layer.group_add("broadcast", channels[username])
+
+        start = time.perf_counter()
+        for _ in range(rotations):
+            sender = random.choice(usernames)
+            group = interest_group(sender) if use_interest_groups else "broadcast"
+            await layer.group_send(group, {"type": "update_key", "content": sender})
+        elapsed = (time.perf_counter() - start) * 1000
+
+        delivered = sum(queue.qsize() for queue in layer.channels.values())
+        await layer.flush()
+        return delivered, elapsed
@@ -0,0 +1,77 @@
+import time
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from chat.codec import CODECS, prepare_frame
+from chat.sockets import ChatConsumer
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the CPU time of handling an event broadcast to many consumers when each "
+        "consumer encodes the frame itself and when it is sent with prepare_frame(), which "
+        "encodes it once per wire format. The channel layer is left out, as it costs the same either way"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=5000, help="number of consumers receiving the broadcast")
+        parser.add_argument("--msgpack", type=float, default=0.0,
+                            help="fraction of consumers using the msgpack wire format")
+        parser.add_argument("--repeat", type=int, default=5, help="number of broadcasts timed for each mode")
+
+    def handle(self, *args, **options):
+        frames = {
+            "update_key": {"type": "update_key", "content": "user0"},
+            # a presence delta of many users, as sent when a large group chat comes online together
+            "presence": {
+                "type": "presence",
+                "content": {"online": [f"user{i}" for i in range(200)], "offline": []}
+            },
+        }
+
+        self.stdout.write(f"{'frame':<12} {'users':>6} {'per recipient ms':>17} {'prepared ms':>12} {'saved':>7}")
+        for name, frame in frames.items():
+            per_recipient = async_to_sync(self.run)(frame, options["users"], options["msgpack"], options["repeat"], False)
+            prepared = async_to_sync(self.run)(frame, options["users"], options["msgpack"], options["repeat"], True)
+            self.stdout.write(
+                f"{name:<12} {options['users']:>6} {per_recipient:>17.1f} {prepared:>12.1f} "
+                f"{1 - prepared / per_recipient:>7.1%}"
+            )
+
+    async def run(self, frame, users, msgpack_share, repeat, prepared):
+        """
+        Broadcast a frame to many consumers and handle it on each of them.
+
+        args:
+            frame (dict): the frame to broadcast
+            users (int): the number of consumers receiving the frame
+            msgpack_share (float): the fraction of consumers using the msgpack wire format
+            repeat (int): the number of broadcasts to time
+            prepared (bool): whether the frame is encoded once per wire format for every consumer
+
+        returns:
+            float: the mean process CPU milliseconds spent on each broadcast
+        """
+        json_codec, msgpack_codec = CODECS[-1], CODECS[0]
+
+        consumers = []
+        for i in range(users):
+            consumer = ChatConsumer()
+            consumer.codec = msgpack_codec if i < users * msgpack_share else json_codec
+            # frames are discarded rather than queued, leaving only the cost of encoding them
+            consumer.outbound = self
+            consumers.append(consumer)
+
+        start = time.process_time()
+        for _ in range(repeat):
+            if prepared:
+                event = {"type": frame["type"], **prepare_frame(frame)}
+                for consumer in consumers:
+                    await consumer.forward(event)
+            else:
+                event = {"type": frame["type"], "content": frame["content"]}
+                for consumer in consumers:
+                    await consumer.send_frame({"type": event["type"], "content": event["content"]})
+        return (time.process_time() - start) * 1000 / repeat
+
+    async def put(self, frame, coalesce_key=None):
+        pass
@@ -0,0 +1,143 @@
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections, transaction
+from django.utils import timezone
+from chat import membership
+from chat.history import delete_acknowledged_messages, get_queued_messages
+from chat.models import ChatRoom, Message, RoomMember
+from users.models import AccountUser
+
+
+class Command(BaseCommand):
+    help = (
+        "Stress the configured database with threads inserting offline messages in batches "
+        "while other threads read and delete acknowledged messages, as the socket consumers "
+        "and ChatHistoryView do, and report the throughput and rate of lock errors. Run it "
+        "with CHAT_DB_PROFILE=sqlite and CHAT_DB_PROFILE=sqlite-tuned to compare the profiles"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--writers", type=int, default=8, help="number of threads inserting messages")
+        parser.add_argument("--readers", type=int, default=4, help="number of threads reading and deleting messages")
+        parser.add_argument("--seconds", type=float, default=10.0, help="duration of the stress test")
+        parser.add_argument("--batch", type=int, default=20, help="number of messages inserted per transaction")
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        self.stdout.write(f"backend {connection.settings_dict['ENGINE']} ({vendor})")
+        if vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                journal_mode = cursor.fetchone()[0]
+                cursor.execute("PRAGMA busy_timeout")
+                self.stdout.write(f"journal_mode={journal_mode} busy_timeout={cursor.fetchone()[0]}ms")
+
+        # only the database is measured, so memberships changed by the benchmark are indexed in
+        # the memory of this process rather than on a Redis server which may not be running
+        configured = membership._index
+        membership._index = membership.LocalMembershipIndex()
+        try:
+            self.stress(options)
+        finally:
+            membership._index = configured
+
+    def stress(self, options):
+        receivers = [f"bench-writer-{i}" for i in range(options["readers"])]
+        sender = "bench-writer-sender"
+        AccountUser.objects.bulk_create(
+            [AccountUser(username=username, first_name="bench", last_name="user") for username in receivers + [sender]]
+        )
+        room = ChatRoom.objects.create(name="bench-writer-room", type=True, owner_id=sender)
+        RoomMember.objects.bulk_create(
+            [RoomMember(chat_room=room, user_id=username) for username in receivers + [sender]]
+        )
+
+        self.counts = {"inserted": 0, "read": 0, "deleted": 0, "transactions": 0, "locked": 0}
+        self.lock = threading.Lock()
+        deadline = time.monotonic() + options["seconds"]
+
+        threads = [
+            threading.Thread(target=self.write, args=(deadline, sender, receivers, room.pk, options["batch"]))
+            for _ in range(options["writers"])
+        ] + [
+            threading.Thread(target=self.read, args=(deadline, receiver))
+            for receiver in receivers
+        ]
+
+        start = time.perf_counter()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            # deleting the users cascades to the chat room, its members and its messages
+            AccountUser.objects.filter(username__in=receivers + [sender]).delete()
+
+        attempts = self.counts["transactions"] + self.counts["locked"]
+        self.stdout.write(f"inserted {self.counts['inserted'] / elapsed:.0f} messages/s, "
+                          f"read {self.counts['read'] / elapsed:.0f} messages/s, "
+                          f"deleted {self.counts['deleted'] / elapsed:.0f} messages/s")
+        self.stdout.write(f"{self.counts['locked']} of {attempts} transactions failed with a lock error "
+                          f"({self.counts['locked'] / attempts if attempts else 0:.2%})")
+
+    def count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def attempt(self, function, *args):
+        """
+        Run a database operation, counting it as a transaction or as a lock error.
+
+        returns:
+            the result of the operation, or None if it failed with a lock error
+        """
+        try:
+            result = function(*args)
+        except OperationalError as error:
+            if "locked" not in str(error):
+                raise
+            self.count(locked=1)
+            return None
+        self.count(transactions=1)
+        return result
+
+    def write(self, deadline, sender, receivers, room_id, batch):
+        def insert(index):
+            with transaction.atomic():
+                Message.objects.bulk_create([
+                    Message(sender_id=sender, receiver_id=receivers[(index + i) % len(receivers)], content="[0]",
+                            room_id=room_id, date_time=timezone.now(), public_key={}, iv="[0]")
+                    for i in range(batch)
+                ])
+            return batch
+
+        index = 0
+        try:
+            while time.monotonic() < deadline:
+                inserted = self.attempt(insert, index)
+                if inserted:
+                    self.count(inserted=inserted)
+                index += 1
+        finally:
+            connections.close_all()
+
+    def read(self, deadline, receiver):
+        def drain():
+            # read a page of saved messages then acknowledge it, as a client draining its history does
+            with transaction.atomic():
+                messages = get_queued_messages(receiver)
+                if messages:
+                    delete_acknowledged_messages(receiver, [message["id"] for message in messages], messages[-1]["id"])
+            return len(messages)
+
+        try:
+            while time.monotonic() < deadline:
+                drained = self.attempt(drain)
+                if drained:
+                    self.count(read=drained, deleted=drained)
+        finally:
+            connections.close_all()
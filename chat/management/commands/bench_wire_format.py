@@ -0,0 +1,105 @@
+import os
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.codec import JSONCodec, MsgpackCodec
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the size on the wire and the encode and decode time of chat socket frames "
+        "in the JSON and msgpack wire formats"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[32, 256, 2048],
+                            help="plaintext sizes in bytes of the messages to benchmark")
+        parser.add_argument("--members", type=int, default=8,
+                            help="number of members a send_msg_multi frame is encrypted for")
+        parser.add_argument("--queued", type=int, default=100,
+                            help="number of saved messages in a queued_msgs frame")
+        parser.add_argument("--iterations", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        codecs = {"json": JSONCodec(), "msgpack": MsgpackCodec()}
+
+        self.stdout.write(f"{'frame':<16} {'size':>6} {'codec':<8} {'bytes':>9} {'encode us':>10} {'decode us':>10}")
+        for size in options["sizes"]:
+            for name, codec in codecs.items():
+                for frame_type, frame in self.frames(codec, size, options["members"], options["queued"]).items():
+                    encoded, encode_time = self.time(lambda: codec.encode(frame), options["iterations"])
+                    _, decode_time = self.time(lambda: codec.decode(**encoded), options["iterations"])
+                    wire_bytes = len(encoded.get("bytes_data") or encoded["text_data"].encode())
+                    self.stdout.write(
+                        f"{frame_type:<16} {size:>6} {name:<8} {wire_bytes:>9} {encode_time:>10.1f} {decode_time:>10.1f}"
+                    )
+
+    def frames(self, codec, size, members, queued):
+        """
+        Build the frames carrying ciphertexts as they are sent in the wire format of a codec.
+
+        args:
+            codec (JSONCodec): the codec the frames are built for
+            size (int): the plaintext size in bytes of each message
+            members (int): the number of members a send_msg_multi frame is encrypted for
+            queued (int): the number of saved messages in a queued_msgs frame
+
+        returns:
+            dict: the frames by frame type
+        """
+        def ciphertext():
+            # AES-GCM appends a 16 byte authentication tag to the ciphertext. Frames hold
+            # ciphertexts as bytes, which the JSON codec sends as arrays of byte values
+            return os.urandom(size + 16)
+
+        def iv():
+            return os.urandom(12)
+
+        now = timezone.now()
+        return {
+            "send_msg_multi": {
+                "type": "send_msg_multi",
+                "content": {
+                    "room_id": 1,
+                    "messages": [
+                        {"receiver": f"user{i}", "message": ciphertext(), "iv": iv()}
+                        for i in range(members)
+                    ]
+                }
+            },
+            "new_msg": {
+                "type": "new_msg",
+                "content": ["user0", 1, ciphertext(), now.isoformat(), iv()]
+            },
+            "queued_msgs": {
+                "type": "queued_msgs",
+                "content": {
+                    "messages": [
+                        {
+                            "id": i,
+                            "sender": "user0",
+                            # saved ciphertexts are the JSON text of an array of byte values
+                            "content": codec.saved_ciphertext(str(list(os.urandom(size + 16)))),
+                            "room_id": 1,
+                            "date_time": now,
+                            "public_key": {"kty": "EC", "crv": "P-384", "x": "x" * 64, "y": "y" * 64},
+                            "iv": codec.saved_ciphertext(str(list(os.urandom(12))))
+                        }
+                        for i in range(queued)
+                    ],
+                    "next": queued
+                }
+            }
+        }
+
+    def time(self, function, iterations):
+        """
+        Time a function over many iterations.
+
+        returns:
+            tuple: the result of the last call and the mean microseconds per call
+        """
+        start = time.perf_counter()
+        for _ in range(iterations):
+            result = function()
+        return result, (time.perf_counter() - start) * 1000000 / iterations
@@ -0,0 +1,409 @@
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+DEFAULT_MEMBERSHIP = {
+    "BACKEND": "chat.membership.LocalMembershipIndex",
+    "CONFIG": {},
+}
+
+_index = None
+
+
+class BaseMembershipIndex:
+    """
+    Index of the members of each chat room and the chat rooms of each user, so that
+    membership checks are set lookups rather than database queries.
+
+    Entries are loaded from the database the first time they are requested and are
+    dropped by invalidate_room() and invalidate_user(), which are called by the
+    RoomMember signal handlers below once the transaction adding or removing a
+    membership has committed. An entry loaded while it was being invalidated is not
+    stored, as it may have been read before the change committed.
+    """
+    def members(self, room_id):
+        """
+        Retrieve the usernames of the members of a chat room.
+
+        args:
+            room_id (int): the primary key of the chat room
+
+        returns:
+            frozenset: the usernames of the members of the chat room
+        """
+        raise NotImplementedError
+
+    def rooms(self, username):
+        """
+        Retrieve the primary keys of the chat rooms a user is a member of.
+
+        args:
+            username (str): the username of the user
+
+        returns:
+            frozenset: the primary keys of the chat rooms of the user
+        """
+        raise NotImplementedError
+
+    def is_member(self, room_id, username):
+        """
+        Check whether a user is a member of a chat room.
+
+        args:
+            room_id (int): the primary key of the chat room
+            username (str): the username of the user
+
+        returns:
+            bool: True if the user is a member of the chat room
+        """
+        return username in self.members(int(room_id))
+
+    def invalidate_room(self, room_id):
+        """
+        Drop the cached members of a chat room.
+
+        args:
+            room_id (int): the primary key of the chat room
+        """
+        raise NotImplementedError
+
+    def invalidate_user(self, username):
+        """
+        Drop the cached chat rooms of a user.
+
+        args:
+            username (str): the username of the user
+        """
+        raise NotImplementedError
+
+    async def amembers(self, room_id):
+        """
+        Asynchronous version of members() for use by socket consumers.
+        """
+        return await database_sync_to_async(self.members)(int(room_id))
+
+    async def arooms(self, username):
+        """
+        Asynchronous version of rooms() for use by socket consumers.
+        """
+        return await database_sync_to_async(self.rooms)(username)
+
+    async def ais_member(self, room_id, username):
+        """
+        Asynchronous version of is_member() for use by socket consumers.
+        """
+        return username in await self.amembers(room_id)
+
+    def load_members(self, room_id):
+        from .models import RoomMember
+        return frozenset(RoomMember.objects.filter(chat_room_id=room_id).values_list("user", flat=True))
+
+    def load_rooms(self, username):
+        from .models import RoomMember
+        return frozenset(RoomMember.objects.filter(user_id=username).values_list("chat_room", flat=True))
+
+
+class LocalMembershipIndex(BaseMembershipIndex):
+    """
+    Membership index held in the memory of the current process, keeping at most
+    max_entries chat rooms and max_entries users and evicting the least recently used.
+
+    Signal handlers only invalidate the index of the process that changed the
+    membership, so this backend is only suitable for tests and deployments running a
+    single worker process.
+
+    The index is used by the threads of sync views and by socket consumers on the event
+    loop at once, so every access to it holds a lock. Memberships are loaded from the
+    database without holding it.
+    """
+    def __init__(self, max_entries=10000, **kwargs):
+        self.max_entries = max_entries
+        self._members = OrderedDict()
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        # incremented by every invalidation, so that a value loaded meanwhile is not stored
+        self._generation = 0
+
+    def _cached(self, cache, key):
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _get(self, cache, key, loader):
+        value = self._cached(cache, key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            generation = self._generation
+        value = loader(key)
+        with self._lock:
+            if generation == self._generation:
+                cache[key] = value
+                cache.move_to_end(key)
+                if len(cache) > self.max_entries:
+                    cache.popitem(last=False)
+        return value
+
+    def members(self, room_id):
+        return self._get(self._members, int(room_id), self.load_members)
+
+    def rooms(self, username):
+        return self._get(self._rooms, username, self.load_rooms)
+
+    def invalidate_room(self, room_id):
+        with self._lock:
+            self._generation += 1
+            self._members.pop(int(room_id), None)
+
+    def invalidate_user(self, username):
+        with self._lock:
+            self._generation += 1
+            self._rooms.pop(username, None)
+
+    async def amembers(self, room_id):
+        # only hop to a thread when the database has to be queried
+        members = self._cached(self._members, int(room_id))
+        if members is not None:
+            return members
+        return await super().amembers(room_id)
+
+    async def arooms(self, username):
+        rooms = self._cached(self._rooms, username)
+        if rooms is not None:
+            return rooms
+        return await super().arooms(username)
+
+
+class RedisMembershipIndex(BaseMembershipIndex):
+    """
+    Membership index stored on Redis as one set per chat room and per user, so that an
+    invalidation made by any worker process is seen by all of them.
+
+    Each set expires ttl seconds after it was loaded, and Redis evicts sets under memory
+    pressure when configured with an LRU maxmemory-policy.
+
+    Keys used:
+        {prefix}:room:{room_id}          set of the usernames of the members of a chat room
+        {prefix}:user:{username}         set of the primary keys of the chat rooms of a user
+        {key}:version                    counter incremented by every invalidation of a set,
+                                         which is watched while the set is stored
+    """
+    # member stored in every cached set so that empty sets are also cached
+    LOADED = "\x00"
+
+    def __init__(self, hosts=None, prefix="membership", ttl=3600, **kwargs):
+        self.hosts = hosts or [("127.0.0.1", 6379)]
+        self.prefix = prefix
+        self.ttl = ttl
+        self._redis = None
+        # a redis.asyncio client can only be used on the event loop it was created on
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        import redis
+
+        if self._redis is None:
+            host = self.hosts[0]
+            if isinstance(host, str):
+                self._redis = redis.Redis.from_url(host, decode_responses=True)
+            else:
+                self._redis = redis.Redis(host=host[0], port=host[1], decode_responses=True)
+        return self._redis
+
+    def _async_client(self):
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            host = self.hosts[0]
+            if isinstance(host, str):
+                client = redis.Redis.from_url(host, decode_responses=True)
+            else:
+                client = redis.Redis(host=host[0], port=host[1], decode_responses=True)
+            self._clients[loop] = client
+        return client
+
+    def _room_key(self, room_id):
+        return f"{self.prefix}:room:{int(room_id)}"
+
+    def _user_key(self, username):
+        return f"{self.prefix}:user:{username}"
+
+    def _get(self, key, loader, convert):
+        # the version is read before the database, so a change committed meanwhile is noticed
+        with self._client().pipeline(transaction=False) as pipe:
+            pipe.smembers(key)
+            pipe.get(f"{key}:version")
+            cached, version = pipe.execute()
+        if cached:
+            return frozenset(convert(value) for value in cached if value != self.LOADED)
+
+        value = loader()
+        self._store(key, version, value)
+        return value
+
+    def _store(self, key, version, value):
+        import redis
+
+        with self._client().pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(f"{key}:version")
+                if pipe.get(f"{key}:version") != version:
+                    return
+                pipe.multi()
+                pipe.sadd(key, self.LOADED, *value)
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+            except redis.WatchError:
+                # invalidated while being stored, so the value may already be stale
+                pass
+
+    async def _aget(self, key, loader, convert):
+        async with self._async_client().pipeline(transaction=False) as pipe:
+            pipe.smembers(key)
+            pipe.get(f"{key}:version")
+            cached, version = await pipe.execute()
+        if cached:
+            return frozenset(convert(value) for value in cached if value != self.LOADED)
+
+        value = await database_sync_to_async(loader)()
+        await self._astore(key, version, value)
+        return value
+
+    async def _astore(self, key, version, value):
+        import redis
+
+        async with self._async_client().pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(f"{key}:version")
+                if await pipe.get(f"{key}:version") != version:
+                    return
+                pipe.multi()
+                pipe.sadd(key, self.LOADED, *value)
+                pipe.expire(key, self.ttl)
+                await pipe.execute()
+            except redis.WatchError:
+                pass
+
+    def _invalidate(self, key):
+        with self._client().pipeline(transaction=True) as pipe:
+            pipe.incr(f"{key}:version")
+            pipe.expire(f"{key}:version", self.ttl)
+            pipe.delete(key)
+            pipe.execute()
+
+    def members(self, room_id):
+        room_id = int(room_id)
+        return self._get(self._room_key(room_id), lambda: self.load_members(room_id), str)
+
+    def rooms(self, username):
+        return self._get(self._user_key(username), lambda: self.load_rooms(username), int)
+
+    def is_member(self, room_id, username):
+        # a cached set is checked with SISMEMBER rather than transferring every member
+        with self._client().pipeline(transaction=False) as pipe:
+            pipe.sismember(self._room_key(room_id), self.LOADED)
+            pipe.sismember(self._room_key(room_id), username)
+            loaded, member = pipe.execute()
+        if loaded:
+            return bool(member)
+        return username in self.members(room_id)
+
+    def invalidate_room(self, room_id):
+        self._invalidate(self._room_key(room_id))
+
+    def invalidate_user(self, username):
+        self._invalidate(self._user_key(username))
+
+    async def amembers(self, room_id):
+        room_id = int(room_id)
+        return await self._aget(self._room_key(room_id), lambda: self.load_members(room_id), str)
+
+    async def arooms(self, username):
+        return await self._aget(self._user_key(username), lambda: self.load_rooms(username), int)
+
+    async def ais_member(self, room_id, username):
+        async with self._async_client().pipeline(transaction=False) as pipe:
+            pipe.sismember(self._room_key(room_id), self.LOADED)
+            pipe.sismember(self._room_key(room_id), username)
+            loaded, member = await pipe.execute()
+        if loaded:
+            return bool(member)
+        return username in await self.amembers(room_id)
+
+
+def get_membership_index():
+    """
+    Retrieve the membership index of this process, creating it from the CHAT_MEMBERSHIP
+    setting on first use.
+
+    returns:
+        BaseMembershipIndex: the configured membership index
+    """
+    global _index
+    if _index is None:
+        config = getattr(settings, "CHAT_MEMBERSHIP", DEFAULT_MEMBERSHIP)
+        backend = import_string(config["BACKEND"])
+        _index = backend(**config.get("CONFIG", {}))
+    return _index
+
+
+def invalidate_on_commit(rooms=(), users=(), using=None):
+    """
+    Invalidate the membership index once the current transaction has committed, or at
+    once outside of a transaction. Invalidating earlier would let a reader reload the
+    memberships from before the change and cache them until they expire.
+
+    args:
+        rooms (iterable): the primary keys of the chat rooms whose members changed
+        users (iterable): the usernames of the users whose chat rooms changed
+        using (str): the alias of the database the change was made on
+    """
+    rooms, users = list(rooms), list(users)
+
+    def invalidate():
+        index = get_membership_index()
+        for room_id in rooms:
+            index.invalidate_room(room_id)
+        for username in users:
+            index.invalidate_user(username)
+
+    transaction.on_commit(invalidate, using=using)
+
+
+def room_member_saved(sender, instance, using=None, **kwargs):
+    """
+    Signal handler invalidating the membership index when a RoomMember row is created
+    or deleted directly, including deletions cascaded from chat rooms and users.
+    """
+    invalidate_on_commit([instance.chat_room_id], [instance.user_id], using)
+
+
+def room_members_changed(sender, instance, action, reverse, pk_set, using=None, **kwargs):
+    """
+    Signal handler invalidating the membership index when members are added to or
+    removed from a chat room through ChatRoom.members or its reverse relation.
+    """
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+
+    # clear() does not provide the primary keys of the rows being removed
+    if action == "pre_clear":
+        if reverse:
+            pk_set = set(instance.chatroom_set.values_list("pk", flat=True))
+        else:
+            pk_set = set(instance.members.values_list("pk", flat=True))
+
+    if reverse:
+        invalidate_on_commit(pk_set or (), [instance.pk], using)
+    else:
+        invalidate_on_commit([instance.pk], pk_set or (), using)
@@ -7,9 +7,15 @@ class RoomMember(models.Model):
 
     class Meta:
         unique_together = ['chat_room', 'user']
+        indexes = [
+            # the unique constraint leads with chat_room, so lookups of the rooms of a user
+            # need an index leading with user which also covers the chat room column
+            models.Index(fields=['user', 'chat_room'], name='roommember_user_room_idx'),
+        ]
 
 class ChatRoom(models.Model):
-    name = models.CharField(max_length=100)
+    # the unique index also serves lookups of chat rooms by name
+    name = models.CharField(max_length=100, unique=True)
     # type = True if the chat room is a group chat, False if it is a direct message chat
     type = models.BooleanField()
     owner = models.ForeignKey(AccountUser, on_delete=models.CASCADE, related_name='owned_rooms')
@@ -29,6 +35,12 @@ class FriendRequest(models.Model):
     # type = True if the chat room referenced is a group chat, False if it is a direct message chat
     chat_type = models.BooleanField()
 
+    class Meta:
+        indexes = [
+            # existing direct message requests are looked up by sender, receiver and type
+            models.Index(fields=['sender', 'receiver', 'chat_type'], name='request_sender_receiver_idx'),
+        ]
+
 class Message(models.Model):
     sender = models.ForeignKey(AccountUser, on_delete=models.CASCADE, related_name="sender")
     receiver = models.ForeignKey(AccountUser, on_delete=models.CASCADE, related_name="receiver") 
@@ -39,4 +51,10 @@ class Message(models.Model):
     # Sender's public key used for deriving the Diffie-Hellman shared key used for encrypting this message
     public_key = models.JSONField()
     # Initialization Vector used for encrypting this message
-    iv = models.TextField()
\ No newline at end of file
+    iv = models.TextField()
+
+    class Meta:
+        indexes = [
+            # saved messages are read and deleted by receiver in primary key order
+            models.Index(fields=['receiver', 'id'], name='message_receiver_id_idx'),
+        ]
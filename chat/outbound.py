@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import weakref
+from collections import deque
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOUND = {
+    "max_frames": 1000,
+    "overflow": "disconnect",
+    "batch_frames": 20,
+    "batch_bytes": 4096,
+}
+
+# every open outbound queue of this process, for outbound_stats()
+_queues = weakref.WeakSet()
+_totals = {"sent": 0, "batches": 0, "coalesced": 0, "dropped": 0, "overflows": 0, "failures": 0}
+
+
+class OutboundQueue:
+    """
+    Bounded queue of the frames waiting to be sent to the client of one socket
+    connection, written by a writer task so that the handlers queueing frames never wait
+    on a slow client.
+
+    Frames queued with a coalesce key are skipped while a frame with the same key is
+    still waiting, as the frame already queued has the same effect. Consecutive small
+    frames are sent together in one batch frame of up to batch_frames frames and
+    batch_bytes bytes, which is built by the codec without encoding the frames again.
+
+    When max_frames frames are waiting the overflow policy applies: "drop_newest"
+    discards the frame being queued, "drop_oldest" discards the oldest waiting frame and
+    "disconnect" calls on_overflow, which closes the socket connection so the client
+    reconnects and reloads its state. If sending a frame fails the error is logged, the
+    queue is closed and on_failure is called to close the socket connection.
+
+    A queue created with start=False holds the frames queued until start() is called, so
+    that it can be created before the socket connection is accepted.
+    """
+    POLICIES = ("drop_newest", "drop_oldest", "disconnect")
+
+    def __init__(self, send, codec, on_overflow=None, max_frames=1000, overflow="disconnect",
+                 batch_frames=20, batch_bytes=4096, on_failure=None, start=True):
+        if overflow not in self.POLICIES:
+            raise ValueError(f"unknown overflow policy {overflow}")
+
+        self.send = send
+        self.codec = codec
+        self.on_overflow = on_overflow
+        self.on_failure = on_failure
+        self.max_frames = max_frames
+        self.overflow = overflow
+        self.batch_frames = batch_frames
+        self.batch_bytes = batch_bytes
+
+        # (send() keyword arguments, coalesce key) of each waiting frame, taken from the left
+        self._frames = deque()
+        self._keys = {}
+        self._ready = asyncio.Event()
+        self._started = asyncio.Event()
+        if start:
+            self._started.set()
+        self._writer = asyncio.get_running_loop().create_task(self._run())
+        self.closed = False
+
+        self.max_depth = 0
+        _queues.add(self)
+
+    @property
+    def depth(self):
+        return len(self._frames)
+
+    async def put(self, frame, coalesce_key=None):
+        """
+        Queue an encoded frame to be sent to the client.
+
+        args:
+            frame (dict): the send() keyword arguments carrying the encoded frame
+            coalesce_key (hashable): if provided, the frame is skipped while another frame
+            with the same key is waiting to be sent
+        """
+        if self.closed:
+            return
+
+        if coalesce_key is not None and coalesce_key in self._keys:
+            _totals["coalesced"] += 1
+            return
+
+        if len(self._frames) >= self.max_frames:
+            _totals["overflows"] += 1
+            if self.overflow == "drop_newest":
+                _totals["dropped"] += 1
+                return
+            elif self.overflow == "drop_oldest":
+                _totals["dropped"] += 1
+                self._forget(self._frames.popleft())
+            else:
+                logger.warning("closing socket connection with %d frames waiting to be sent", len(self._frames))
+                await self.close()
+                if self.on_overflow is not None:
+                    await self.on_overflow()
+                return
+
+        self._frames.append((frame, coalesce_key))
+        if coalesce_key is not None:
+            self._keys[coalesce_key] = self._keys.get(coalesce_key, 0) + 1
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._ready.set()
+
+    def start(self):
+        """
+        Start sending the frames queued, once the socket connection has been accepted.
+        """
+        self._started.set()
+
+    async def close(self):
+        """
+        Stop the writer task and discard the frames waiting to be sent.
+        """
+        self.closed = True
+        self._frames.clear()
+        self._keys.clear()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    def _forget(self, item):
+        _, coalesce_key = item
+        if coalesce_key is not None:
+            self._keys[coalesce_key] -= 1
+            if not self._keys[coalesce_key]:
+                del self._keys[coalesce_key]
+
+    def _take(self):
+        # take the next frame, along with the small frames after it when it is small itself
+        first = self._frames.popleft()
+        self._forget(first)
+        frames = [first[0]]
+        size = self._size(first[0])
+
+        while (
+            self._frames
+            and len(frames) < self.batch_frames
+            and size + self._size(self._frames[0][0]) <= self.batch_bytes
+        ):
+            item = self._frames.popleft()
+            self._forget(item)
+            frames.append(item[0])
+            size += self._size(item[0])
+
+        if len(frames) == 1:
+            return frames[0]
+        _totals["batches"] += 1
+        return self.codec.batch(frames)
+
+    def _size(self, frame):
+        return len(frame[self.codec.send_key])
+
+    async def _run(self):
+        await self._started.wait()
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+
+                while self._frames:
+                    frame = self._take()
+                    await self.send(**frame)
+                    _totals["sent"] += 1
+        except Exception:
+            # without its writer the queue would fill until a healthy connection overflowed
+            _totals["failures"] += 1
+            logger.exception("closing socket connection after failing to send a frame")
+            await self.close()
+            if self.on_failure is not None:
+                await self.on_failure()
+
+
+def create_outbound_queue(send, codec, on_overflow=None, on_failure=None, start=True):
+    """
+    Create the outbound queue of a socket connection, configured by the CHAT_OUTBOUND
+    setting.
+
+    args:
+        send (function): the send() method of the consumer of the socket connection
+        codec (JSONCodec): the codec of the wire format of the socket connection
+        on_overflow (function): coroutine function called when the queue overflows under
+        the "disconnect" policy
+        on_failure (function): coroutine function called when a frame could not be sent
+        start (bool): whether to send frames as soon as they are queued, rather than once
+        start() is called
+
+    returns:
+        OutboundQueue: the outbound queue
+    """
+    config = {**DEFAULT_OUTBOUND, **getattr(settings, "CHAT_OUTBOUND", {})}
+    return OutboundQueue(send, codec, on_overflow, on_failure=on_failure, start=start, **config)
+
+
+def outbound_stats():
+    """
+    Retrieve the queue depth metrics of the open socket connections of this process and
+    the counters of frames sent, batched, coalesced and dropped.
+
+    returns:
+        dict: the outbound queue metrics of this process
+    """
+    queues = [queue for queue in _queues if not queue.closed]
+    depths = [queue.depth for queue in queues]
+    return {
+        "connections": len(queues),
+        "queued_frames": sum(depths),
+        "max_depth": max(depths, default=0),
+        "max_depth_seen": max((queue.max_depth for queue in queues), default=0),
+        **_totals
+    }
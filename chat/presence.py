@@ -0,0 +1,511 @@
+import asyncio
+import hashlib
+import time
+import weakref
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .codec import prepare_frame
+
+DEFAULT_PRESENCE = {
+    "BACKEND": "chat.presence.LocalPresenceRegistry",
+    "CONFIG": {},
+}
+
+_registry = None
+_notifier = None
+
+
+class BasePresenceRegistry:
+    """
+    Tracks which users are online and which socket channels (devices) belong to each
+    user, along with the chat room that each channel has joined.
+
+    Every channel entry expires ttl seconds after it was last added or touched, so a
+    worker that dies without running its disconnect handlers does not leave its users
+    online forever. Consumers are expected to call touch() every heartbeat_interval
+    seconds while the socket is open.
+    """
+    def __init__(self, ttl=60, heartbeat_interval=None, **kwargs):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval or ttl / 3
+
+    async def add(self, username, channel_name):
+        """
+        Register a socket channel of a user, marking the user as online.
+
+        args:
+            username (str): the username of the user who opened the socket connection
+            channel_name (str): the channel name of the socket connection
+
+        returns:
+            bool: True if the user was offline before this channel was registered
+        """
+        raise NotImplementedError
+
+    async def touch(self, username, channel_name):
+        """
+        Refresh the expiry of a socket channel of a user.
+
+        args:
+            username (str): the username of the user who owns the socket connection
+            channel_name (str): the channel name of the socket connection
+        """
+        await self.add(username, channel_name)
+
+    async def join(self, username, channel_name, room_id):
+        """
+        Record the chat room that a socket channel of a user has joined.
+
+        args:
+            username (str): the username of the user who owns the socket connection
+            channel_name (str): the channel name of the socket connection
+            room_id (int): the primary key of the chat room that was joined
+        """
+        raise NotImplementedError
+
+    async def remove(self, username, channel_name):
+        """
+        Discard a socket channel of a user.
+
+        args:
+            username (str): the username of the user who closed the socket connection
+            channel_name (str): the channel name of the socket connection
+
+        returns:
+            bool: True if the user has no remaining socket channels and is now offline
+        """
+        raise NotImplementedError
+
+    async def channels(self, username):
+        """
+        Retrieve all live socket channels of a user.
+
+        args:
+            username (str): the username of the user
+
+        returns:
+            dict: maps each channel name of the user to the primary key of the chat room
+            the channel has joined, or None if the channel has not joined a chat room
+        """
+        raise NotImplementedError
+
+    async def channels_many(self, usernames):
+        """
+        Retrieve all live socket channels of each of many users.
+
+        args:
+            usernames (iterable): the usernames of the users
+
+        returns:
+            dict: maps each username to the result of channels() for the user
+        """
+        return {username: await self.channels(username) for username in usernames}
+
+    async def is_online(self, username):
+        """
+        Check whether a user has at least one live socket channel.
+
+        args:
+            username (str): the username of the user
+
+        returns:
+            bool: True if the user is online
+        """
+        raise NotImplementedError
+
+    async def online(self):
+        """
+        Retrieve the usernames of all users who are online.
+
+        returns:
+            list: the usernames of all online users
+        """
+        raise NotImplementedError
+
+    async def filter_online(self, usernames):
+        """
+        Retrieve which of the provided users are online.
+
+        args:
+            usernames (iterable): the usernames of the users to check
+
+        returns:
+            set: the usernames of the provided users who are online
+        """
+        return {username for username in usernames if await self.is_online(username)}
+
+
+class LocalPresenceRegistry(BasePresenceRegistry):
+    """
+    Presence registry held in the memory of the current process. Only suitable for
+    tests and deployments running a single worker process.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # username -> {channel_name: expiry}
+        self._expiry = {}
+        # username -> {channel_name: room_id}
+        self._rooms = {}
+
+    def _live(self, username):
+        now = time.monotonic()
+        channels = self._expiry.get(username)
+        if not channels:
+            return {}
+        for channel_name in [c for c, expiry in channels.items() if expiry <= now]:
+            del channels[channel_name]
+            self._rooms.get(username, {}).pop(channel_name, None)
+        if not channels:
+            self._expiry.pop(username, None)
+            self._rooms.pop(username, None)
+        return channels
+
+    async def add(self, username, channel_name):
+        was_online = bool(self._live(username))
+        self._expiry.setdefault(username, {})[channel_name] = time.monotonic() + self.ttl
+        return not was_online
+
+    async def join(self, username, channel_name, room_id):
+        if channel_name in self._live(username):
+            self._rooms.setdefault(username, {})[channel_name] = room_id
+
+    async def remove(self, username, channel_name):
+        self._expiry.get(username, {}).pop(channel_name, None)
+        self._rooms.get(username, {}).pop(channel_name, None)
+        return not self._live(username)
+
+    async def channels(self, username):
+        rooms = self._rooms.get(username, {})
+        return {channel_name: rooms.get(channel_name) for channel_name in self._live(username)}
+
+    async def is_online(self, username):
+        return bool(self._live(username))
+
+    async def online(self):
+        return [username for username in list(self._expiry) if self._live(username)]
+
+
+class RedisPresenceRegistry(BasePresenceRegistry):
+    """
+    Presence registry stored on Redis so that it is shared by every worker process and
+    host serving socket connections.
+
+    Keys used:
+        {prefix}:u:{username} sorted set of the user's channel names scored by expiry
+        {prefix}:r:{username} hash mapping the user's channel names to joined room ids
+        {prefix}:online       sorted set of online usernames scored by expiry
+    """
+    # atomically discard a channel and drop the user from the online set once no live
+    # channels remain, so that two devices disconnecting together cannot race
+    REMOVE_SCRIPT = """
+        redis.call('ZREM', KEYS[1], ARGV[1])
+        redis.call('HDEL', KEYS[2], ARGV[1])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+        if redis.call('ZCARD', KEYS[1]) == 0 then
+            redis.call('ZREM', KEYS[3], ARGV[3])
+            redis.call('DEL', KEYS[2])
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, hosts=None, prefix="presence", **kwargs):
+        super().__init__(**kwargs)
+        self.hosts = hosts or [("127.0.0.1", 6379)]
+        self.prefix = prefix
+        # a redis.asyncio client can only be used on the event loop it was created on,
+        # and sync views reach the registry through async_to_sync on their own loops
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            host = self.hosts[0]
+            if isinstance(host, str):
+                client = redis.Redis.from_url(host, decode_responses=True)
+            else:
+                client = redis.Redis(host=host[0], port=host[1], decode_responses=True)
+            self._clients[loop] = client
+        return client
+
+    def _user_key(self, username):
+        return f"{self.prefix}:u:{username}"
+
+    def _rooms_key(self, username):
+        return f"{self.prefix}:r:{username}"
+
+    def _online_key(self):
+        return f"{self.prefix}:online"
+
+    async def add(self, username, channel_name):
+        now = time.time()
+        async with self._client().pipeline(transaction=True) as pipe:
+            pipe.zadd(self._user_key(username), {channel_name: now + self.ttl})
+            pipe.expire(self._user_key(username), self.ttl)
+            pipe.expire(self._rooms_key(username), self.ttl)
+            pipe.zremrangebyscore(self._online_key(), "-inf", now)
+            pipe.zadd(self._online_key(), {username: now + self.ttl})
+            results = await pipe.execute()
+
+        # ZADD reports how many members were newly added to the online set
+        return results[-1] == 1
+
+    async def join(self, username, channel_name, room_id):
+        async with self._client().pipeline(transaction=True) as pipe:
+            pipe.hset(self._rooms_key(username), channel_name, room_id)
+            pipe.expire(self._rooms_key(username), self.ttl)
+            await pipe.execute()
+
+    async def remove(self, username, channel_name):
+        offline = await self._client().eval(
+            self.REMOVE_SCRIPT,
+            3,
+            self._user_key(username),
+            self._rooms_key(username),
+            self._online_key(),
+            channel_name,
+            time.time(),
+            username,
+        )
+        return bool(offline)
+
+    async def channels(self, username):
+        async with self._client().pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(self._user_key(username), time.time(), "+inf")
+            pipe.hgetall(self._rooms_key(username))
+            channel_names, rooms = await pipe.execute()
+
+        return {
+            channel_name: int(rooms[channel_name]) if channel_name in rooms else None
+            for channel_name in channel_names
+        }
+
+    async def channels_many(self, usernames):
+        usernames = list(usernames)
+        if not usernames:
+            return {}
+
+        # look up the channels of every user in a single round trip
+        now = time.time()
+        async with self._client().pipeline(transaction=False) as pipe:
+            for username in usernames:
+                pipe.zrangebyscore(self._user_key(username), now, "+inf")
+                pipe.hgetall(self._rooms_key(username))
+            results = await pipe.execute()
+
+        channels = {}
+        for index, username in enumerate(usernames):
+            channel_names, rooms = results[2 * index], results[2 * index + 1]
+            channels[username] = {
+                channel_name: int(rooms[channel_name]) if channel_name in rooms else None
+                for channel_name in channel_names
+            }
+        return channels
+
+    async def is_online(self, username):
+        expiry = await self._client().zscore(self._online_key(), username)
+        return expiry is not None and expiry > time.time()
+
+    async def online(self):
+        return await self._client().zrangebyscore(self._online_key(), time.time(), "+inf")
+
+    async def filter_online(self, usernames):
+        usernames = list(usernames)
+        if not usernames:
+            return set()
+
+        now = time.time()
+        async with self._client().pipeline(transaction=False) as pipe:
+            for username in usernames:
+                pipe.zscore(self._online_key(), username)
+            expiries = await pipe.execute()
+
+        return {
+            username for username, expiry in zip(usernames, expiries)
+            if expiry is not None and expiry > now
+        }
+
+
+class PresenceNotifier:
+    """
+    Sends presence deltas to the contacts of users who came online or went offline.
+
+    Changes are collected over a short window and then sent as one delta per
+    recipient, so when many users connect at once each contact receives a single
+    frame listing all of them rather than one frame per user. The state of each
+    changed user is read back from the registry when the window closes, so a user
+    who reconnects within the window is not reported offline.
+    """
+    def __init__(self, registry, window=0.25):
+        self.registry = registry
+        self.window = window
+        # username -> usernames of the contacts to inform of the user's presence
+        self._pending = {}
+        self._flush_task = None
+
+    def notify(self, username, contacts):
+        """
+        Queue a presence change of a user to be sent to their contacts.
+
+        args:
+            username (str): the username of the user who came online or went offline
+            contacts (iterable): the usernames of the users who share a chat room with the user
+        """
+        self._pending.setdefault(username, set()).update(contacts)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def flush(self):
+        """
+        Send every queued presence change to the contacts who are online.
+        """
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        online = await self.registry.filter_online(pending)
+
+        deltas = {}
+        for username, contacts in pending.items():
+            key = "online" if username in online else "offline"
+            for contact in contacts:
+                deltas.setdefault(contact, {"online": [], "offline": []})[key].append(username)
+
+        # recipients who share the same delta are sent the same frame, which is only encoded once
+        events = {}
+        recipients = {}
+        for recipient in await self.registry.filter_online(deltas):
+            delta = deltas[recipient]
+            key = (tuple(delta["online"]), tuple(delta["offline"]))
+            if key not in events:
+                events[key] = {"type": "presence", **prepare_frame({"type": "presence", "content": delta})}
+            recipients[recipient] = events[key]
+
+        await send_to_users(recipients, registry=self.registry)
+
+
+def get_presence_registry():
+    """
+    Retrieve the presence registry of this process, creating it from the CHAT_PRESENCE
+    setting on first use.
+
+    returns:
+        BasePresenceRegistry: the configured presence registry
+    """
+    global _registry
+    if _registry is None:
+        config = getattr(settings, "CHAT_PRESENCE", DEFAULT_PRESENCE)
+        backend = import_string(config["BACKEND"])
+        _registry = backend(**config.get("CONFIG", {}))
+    return _registry
+
+
+async def send_to_user(username, event, room_id=None):
+    """
+    Send a channel layer event to every socket channel of a user, on whichever worker
+    process the socket connection is held.
+
+    args:
+        username (str): the username of the user to send the event to
+        event (dict): the channel layer event to send
+        room_id (int): if provided, only send to socket channels that joined this chat room
+    """
+    await send_to_users({username: event}, room_id=room_id)
+
+
+async def send_to_users(events, room_id=None, registry=None):
+    """
+    Send a channel layer event to every socket channel of each of many users.
+
+    The socket channels of every user are looked up together, in a single round trip
+    with the Redis registry, and the events are sent concurrently with up to
+    FANOUT_CONCURRENCY of the CHAT_PRESENCE setting in flight at once.
+
+    args:
+        events (dict): maps the username of each user to the channel layer event to send them
+        room_id (int): if provided, only send to socket channels that joined this chat room
+        registry (BasePresenceRegistry): the registry to look the channels up in, the
+        configured presence registry if not provided
+    """
+    registry = registry or get_presence_registry()
+    channels = await registry.channels_many(events)
+    await fan_out([
+        (channel_name, events[username])
+        for username, user_channels in channels.items()
+        for channel_name, joined in user_channels.items()
+        if room_id is None or joined == room_id
+    ])
+
+
+async def fan_out(sends):
+    """
+    Send channel layer events to many socket channels concurrently, with a bounded number
+    of sends in flight at once so that a large fan-out cannot exhaust the connections
+    of the channel layer.
+
+    args:
+        sends (list): a tuple of the channel name and the event to send it for each send
+    """
+    if not sends:
+        return
+
+    channel_layer = get_channel_layer()
+    await gather_bounded(channel_layer.send(channel_name, event) for channel_name, event in sends)
+
+
+async def gather_bounded(awaitables):
+    """
+    Await many channel layer calls concurrently, with up to FANOUT_CONCURRENCY of the
+    CHAT_PRESENCE setting in flight at once.
+
+    args:
+        awaitables (iterable): the channel layer calls to await
+    """
+    config = getattr(settings, "CHAT_PRESENCE", DEFAULT_PRESENCE)
+    semaphore = asyncio.Semaphore(config.get("FANOUT_CONCURRENCY", 50))
+
+    async def bounded(awaitable):
+        async with semaphore:
+            await awaitable
+
+    await asyncio.gather(*(bounded(awaitable) for awaitable in awaitables))
+
+
+def interest_group(username):
+    """
+    Retrieve the name of the channel group holding the socket channels of every user who
+    shares a chat room with a user, and so is interested in events about that user.
+
+    Usernames may contain characters that are not allowed in channel group names, so the
+    group is named after a digest of the username.
+
+    args:
+        username (str): the username of the user
+
+    returns:
+        str: the name of the interest group of the user
+    """
+    return "interest." + hashlib.sha1(username.encode()).hexdigest()
+
+
+def get_presence_notifier():
+    """
+    Retrieve the presence notifier of this process, using the DELTA_WINDOW of the
+    CHAT_PRESENCE setting as the number of seconds over which changes are coalesced.
+
+    returns:
+        PresenceNotifier: the presence notifier
+    """
+    global _notifier
+    if _notifier is None:
+        config = getattr(settings, "CHAT_PRESENCE", DEFAULT_PRESENCE)
+        _notifier = PresenceNotifier(get_presence_registry(), config.get("DELTA_WINDOW", 0.25))
+    return _notifier
@@ -0,0 +1,214 @@
+import asyncio
+import time
+import weakref
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .frames import FrameError
+
+DEFAULT_RATE_LIMIT = {
+    "BACKEND": "chat.ratelimit.LocalRateLimiter",
+    "CONFIG": {},
+}
+
+_limiter = None
+
+
+class RateLimited(FrameError):
+    """
+    Raised when a user sends frames of a type faster than its rate limit allows, so
+    that an error response is sent back instead of the frame being handled.
+    """
+    def __init__(self, frame_type, retry_after):
+        super().__init__(f"too many {frame_type} frames, retry in {retry_after:.1f} seconds")
+        self.frame_type = frame_type
+        self.retry_after = retry_after
+
+
+class BaseRateLimiter:
+    """
+    Token bucket rate limiter of the frames each user sends, with one bucket per user
+    and frame type.
+
+    Each bucket holds up to burst tokens and gains rate tokens every second. Handling a
+    frame takes one token, and frames arriving while the bucket is empty are throttled.
+    The rate and burst of each frame type are provided by limits, falling back to
+    default for frame types without a limit of their own. Frame types without either,
+    or whose limit is None, are not limited. Rates must be positive, as an empty bucket
+    which is never refilled would throttle the frame type for good.
+    """
+    def __init__(self, limits=None, default=None, **kwargs):
+        # frame type -> (tokens per second, bucket size)
+        self.limits = limits or {}
+        self.default = default
+
+        for frame_type, limit in [*self.limits.items(), ("default", default)]:
+            if limit is None:
+                continue
+            rate, burst = limit
+            if rate <= 0 or burst < 1:
+                raise ValueError(f"the rate limit of {frame_type} needs a positive rate and a burst of at least 1, "
+                                 f"or None to not limit it")
+
+        self.allowed = Counter()
+        self.throttled = Counter()
+
+    async def check(self, username, frame_type):
+        """
+        Take a token from the bucket of a user for a frame type.
+
+        args:
+            username (str): the username of the user who sent the frame
+            frame_type (str): the type of the frame
+
+        raises:
+            RateLimited: if the bucket of the user has no tokens left
+        """
+        limit = self.limits.get(frame_type, self.default)
+        if limit is None:
+            return
+
+        rate, burst = limit
+        retry_after = await self.take(f"{username}:{frame_type}", rate, burst)
+        if retry_after > 0:
+            self.throttled[frame_type] += 1
+            raise RateLimited(frame_type, retry_after)
+        self.allowed[frame_type] += 1
+
+    async def take(self, key, rate, burst):
+        """
+        Refill a bucket for the time passed since it was last used and take a token from
+        it if one is available.
+
+        args:
+            key (str): the key of the bucket
+            rate (float): the tokens added to the bucket every second
+            burst (int): the maximum number of tokens the bucket holds
+
+        returns:
+            float: 0 if a token was taken, otherwise the seconds until one is available
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Retrieve the number of frames allowed and throttled by this process for each
+        frame type.
+
+        returns:
+            dict: the counters of allowed and throttled frames by frame type
+        """
+        return {
+            "allowed": dict(self.allowed),
+            "throttled": dict(self.throttled)
+        }
+
+
+class LocalRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter holding its buckets in the memory of the current process, keeping at
+    most max_entries buckets and evicting the least recently used.
+
+    Each worker process limits a user separately, so a user whose socket connections are
+    spread over several worker processes can send frames at a multiple of the rate. Only
+    suitable for tests and deployments running a single worker process.
+    """
+    def __init__(self, max_entries=100000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_entries = max_entries
+        # key -> (tokens, time the bucket was last used)
+        self._buckets = OrderedDict()
+
+    async def take(self, key, rate, burst):
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class RedisRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter storing its buckets on Redis so that a user is limited across every
+    worker process and host serving socket connections.
+
+    Keys used:
+        {prefix}:{username}:{frame_type} hash of the tokens left and the time the
+                                         bucket was last used, expiring once full again
+    """
+    # refill and take from a bucket in one round trip, atomically so that frames handled
+    # by several worker processes at once cannot take the same token. Times are passed
+    # by the caller, and the wait is returned as a string as Redis truncates Lua numbers
+    TAKE_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+        local retry_after = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            retry_after = (1 - tokens) / rate
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+        return tostring(retry_after)
+    """
+
+    def __init__(self, hosts=None, prefix="ratelimit", **kwargs):
+        super().__init__(**kwargs)
+        self.hosts = hosts or [("127.0.0.1", 6379)]
+        self.prefix = prefix
+        # a redis.asyncio client can only be used on the event loop it was created on
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _script(self):
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        script = self._clients.get(loop)
+        if script is None:
+            host = self.hosts[0]
+            if isinstance(host, str):
+                client = redis.Redis.from_url(host, decode_responses=True)
+            else:
+                client = redis.Redis(host=host[0], port=host[1], decode_responses=True)
+            # registered scripts are run by their SHA1, rather than sending the script
+            # with every frame
+            script = client.register_script(self.TAKE_SCRIPT)
+            self._clients[loop] = script
+        return script
+
+    async def take(self, key, rate, burst):
+        retry_after = await self._script()(keys=[f"{self.prefix}:{key}"], args=[rate, burst, time.time()])
+        return float(retry_after)
+
+
+def get_rate_limiter():
+    """
+    Retrieve the rate limiter of this process, creating it from the CHAT_RATE_LIMIT
+    setting on first use.
+
+    returns:
+        BaseRateLimiter: the configured rate limiter
+    """
+    global _limiter
+    if _limiter is None:
+        config = getattr(settings, "CHAT_RATE_LIMIT", DEFAULT_RATE_LIMIT)
+        backend = import_string(config["BACKEND"])
+        _limiter = backend(**config.get("CONFIG", {}))
+    return _limiter
@@ -0,0 +1,82 @@
+from django.db import IntegrityError, transaction
+
+
+class RoomNameTaken(Exception):
+    """
+    Raised when a chat room could not be created because another chat room already has
+    its name.
+    """
+
+
+def find_users(usernames):
+    """
+    Look up which of a list of usernames belong to existing users in a single query.
+
+    args:
+        usernames (list): the usernames to look up
+
+    returns:
+        tuple: the set of usernames which exist and the set of usernames which do not
+    """
+    from users.models import AccountUser
+
+    usernames = set(usernames)
+    found = set(AccountUser.objects.filter(username__in=usernames).values_list("username", flat=True))
+    return found, usernames - found
+
+
+def create_friend_requests(sender, room, receivers):
+    """
+    Create a pending friend request to a chat room for each receiver with a single insert.
+
+    args:
+        sender (AccountUser): the sender of the friend requests
+        room (ChatRoom): the chat room the receivers are invited to
+        receivers (list): the usernames of the receivers of the friend requests
+
+    returns:
+        list: the FriendRequest objects created, in the order of the receivers
+    """
+    from .models import FriendRequest
+
+    # usernames are the primary keys of users, so the receivers do not have to be loaded
+    return FriendRequest.objects.bulk_create([
+        FriendRequest(sender=sender, receiver_id=receiver, room=room, status=FriendRequest.Status.PENDING,
+                      chat_type=room.type)
+        for receiver in receivers
+    ])
+
+
+def create_room_with_requests(name, room_type, owner, receivers):
+    """
+    Create a chat room with its owner as its first member and a pending friend request to
+    each receiver, in one transaction so that a failure leaves no partial chat room.
+
+    The name is not checked beforehand. Of two chat rooms created with the same name at
+    once, the unique index on the name lets only the first be inserted.
+
+    args:
+        name (str): the name of the chat room
+        room_type (bool): the type of chat room (True = group chat, False = direct message chat)
+        owner (AccountUser): the creator of the chat room
+        receivers (list): the usernames of the users invited to the chat room
+
+    returns:
+        tuple: the ChatRoom object and the list of FriendRequest objects created
+
+    raises:
+        RoomNameTaken: if a chat room with the name already exists
+    """
+    from .models import ChatRoom, RoomMember
+
+    with transaction.atomic():
+        try:
+            room = ChatRoom.objects.create(name=name, type=room_type, owner=owner)
+        except IntegrityError:
+            # foreign keys are only checked when the transaction commits, so the unique
+            # index on the name is the only constraint the insert can violate
+            raise RoomNameTaken(name)
+        # created individually so that its post_save signal updates the membership index
+        RoomMember.objects.create(chat_room=room, user=owner)
+        requests = create_friend_requests(owner, room, receivers)
+    return room, requests
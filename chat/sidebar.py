@@ -0,0 +1,354 @@
+import secrets
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+
+_sidebar_cache = None
+
+
+def get_friends(user):
+    """
+    Retrieve the direct message chat rooms of a user which the other user has joined,
+    along with the details of that other user, in a single query.
+
+    args:
+        user (AccountUser): the user whose friends to retrieve
+
+    returns:
+        list: a dictionary for each friend containing their username, the id of the direct
+        message chat room and their about me
+    """
+    from .models import RoomMember
+
+    user_rooms = RoomMember.objects.filter(user=user).values("chat_room")
+    # a direct message chat room has the friend as its only other member once they accepted the request
+    friends = (
+        RoomMember.objects
+        .filter(chat_room__in=user_rooms, chat_room__type=False)
+        .exclude(user=user)
+        .values("chat_room_id", "user_id", "user__about")
+        .order_by("chat_room_id")
+    )
+
+    return [
+        {"username": friend["user_id"], "room_id": friend["chat_room_id"], "about": friend["user__about"]}
+        for friend in friends
+    ]
+
+
+def get_group_chats(user):
+    """
+    Retrieve the group chat rooms of a user in a single query.
+
+    args:
+        user (AccountUser): the user whose group chats to retrieve
+
+    returns:
+        list: a dictionary for each group chat containing its id and name
+    """
+    from .models import ChatRoom
+
+    return list(
+        ChatRoom.objects
+        .filter(roommember__user=user, type=True)
+        .values("pk", "name")
+        .order_by("pk")
+    )
+
+
+def get_requests(ordering="pk", **filters):
+    """
+    Retrieve friend requests matching the provided filters in a single query.
+
+    args:
+        ordering (str): the field to order the friend requests by
+        filters: keyword arguments used to filter the friend requests
+
+    returns:
+        list: a dictionary for each friend request containing its id, the usernames of its
+        sender and receiver, the id, name and type of its chat room and its status
+    """
+    from .models import FriendRequest
+
+    requests = FriendRequest.objects.filter(**filters).order_by(ordering).values(
+        "pk", "sender_id", "receiver_id", "room_id", "room__name", "chat_type", "status"
+    )
+
+    return [
+        {
+            "id": request["pk"],
+            "sender": request["sender_id"],
+            "receiver": request["receiver_id"],
+            "room_id": request["room_id"],
+            "room_name": request["room__name"],
+            "room_type": request["chat_type"],
+            "status": request["status"]
+        }
+        for request in requests
+    ]
+
+
+def build_sidebar(user, include_requests=False):
+    """
+    Build the data displayed in the navigation bar of the friends and chat pages, using
+    a fixed number of queries regardless of how many friends, group chats and requests
+    the user has.
+
+    args:
+        user (AccountUser): the user whose sidebar to build
+        include_requests (bool): whether to include the friend requests the user sent and received
+
+    returns:
+        dict: the friends and group chats of the user and, if requested, the friend
+        requests the user received and sent
+    """
+    sidebar = {
+        "friends": get_friends(user),
+        "group_chats": get_group_chats(user),
+    }
+
+    if include_requests:
+        sidebar["received_requests"] = get_requests(receiver=user)
+        sidebar["sent_requests"] = get_requests(ordering="-pk", sender=user)
+
+    return sidebar
+
+
+def request_data(request_id, sender, receiver, room_id, room_name, room_type, status=-1):
+    """
+    Build the dictionary describing a friend request in the sidebar.
+
+    args:
+        request_id (int): the primary key of the friend request
+        sender (str): the username of the sender of the friend request
+        receiver (str): the username of the receiver of the friend request
+        room_id (int): the primary key of the chat room of the friend request
+        room_name (str): the name of the chat room of the friend request
+        room_type (bool): the type of chat room (True = group chat, False = direct message chat)
+        status (int): the status of the friend request
+
+    returns:
+        dict: the friend request in the format returned by get_requests()
+    """
+    return {
+        "id": request_id,
+        "sender": sender,
+        "receiver": receiver,
+        "room_id": room_id,
+        "room_name": room_name,
+        "room_type": room_type,
+        "status": status
+    }
+
+
+def add_friend(sidebar, username, room_id, about):
+    """
+    Patch a sidebar with a new friend.
+    """
+    sidebar["friends"].append({"username": username, "room_id": room_id, "about": about})
+
+
+def add_group_chat(sidebar, room_id, name):
+    """
+    Patch a sidebar with a new group chat.
+    """
+    sidebar["group_chats"].append({"pk": room_id, "name": name})
+
+
+def remove_room(sidebar, room_id):
+    """
+    Patch a sidebar to remove a friend or group chat by the primary key of its chat room.
+    """
+    sidebar["friends"] = [friend for friend in sidebar["friends"] if friend["room_id"] != room_id]
+    sidebar["group_chats"] = [group for group in sidebar["group_chats"] if group["pk"] != room_id]
+
+
+def add_received_request(sidebar, request):
+    """
+    Patch a sidebar with a friend request the user received.
+    """
+    sidebar["received_requests"].append(request)
+
+
+def add_sent_request(sidebar, request):
+    """
+    Patch a sidebar with a friend request the user sent, which is displayed first.
+    """
+    sidebar["sent_requests"].insert(0, request)
+
+
+def set_request_status(sidebar, request_id, status):
+    """
+    Patch a sidebar with the new status of a friend request the user sent or received.
+    """
+    for request in sidebar["received_requests"] + sidebar["sent_requests"]:
+        if request["id"] == request_id:
+            request["status"] = status
+
+
+class SidebarCache:
+    """
+    Cache of the sidebar of each user, stored in the "sidebar" cache so that it is shared
+    by every worker process and bounded by the cache's timeout and eviction policy.
+
+    Rather than being rebuilt whenever the friends or chat page is loaded, a cached
+    sidebar is patched by the socket events that change it. Each user has a revision
+    counter, incremented atomically by every patch, and a cached sidebar is only used
+    while its revision matches the counter. A patch only stores the patched sidebar when
+    its increment moved the counter on from the revision of the sidebar it read, so of
+    two patches made at once the second finds the sidebar stale instead of overwriting
+    the first. A sidebar built while a patch is made is stored with the revision read
+    before it was built, so it is stale once stored and built again on the next page
+    load. The cache key is versioned by VERSION so that entries of an older format are
+    never read.
+    """
+    VERSION = 2
+
+    def __init__(self, alias="sidebar"):
+        self.alias = alias
+        self.hits = 0
+        self.misses = 0
+        self.patches = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, username):
+        return f"sidebar:{username}"
+
+    def revision_key(self, username):
+        return f"sidebar:{username}:revision"
+
+    def get(self, user):
+        """
+        Retrieve the sidebar of a user, building and caching it if it is not cached or is
+        stale.
+
+        args:
+            user (AccountUser): the user whose sidebar to retrieve
+
+        returns:
+            dict: the sidebar of the user as returned by build_sidebar() with requests included
+        """
+        key, revision_key = self.key(user.username), self.revision_key(user.username)
+        cached = self.cache.get_many([key, revision_key], version=self.VERSION)
+        entry, revision = cached.get(key), cached.get(revision_key)
+        if entry is not None and entry["revision"] == revision:
+            self.hits += 1
+            return entry["sidebar"]
+
+        self.misses += 1
+        if revision is None:
+            # a random first revision cannot match a sidebar stored before the counter expired
+            self.cache.add(revision_key, secrets.randbits(48), version=self.VERSION)
+            revision = self.cache.get(revision_key, version=self.VERSION)
+        # the revision is read before the database, so a patch made meanwhile makes this entry stale
+        sidebar = build_sidebar(user, include_requests=True)
+        self.cache.set(key, {"revision": revision, "sidebar": sidebar}, version=self.VERSION)
+        return sidebar
+
+    def patch(self, username, *patches):
+        """
+        Apply patches to the cached sidebar of a user, if it is cached.
+
+        args:
+            username (str): the username of the user whose sidebar to patch
+            patches: tuples of a patch function followed by its arguments after the sidebar
+        """
+        self.patch_many({username: patches})
+
+    def patch_many(self, patches):
+        """
+        Apply patches to the cached sidebars of many users, reading and writing every
+        cached sidebar together rather than one user at a time. The revision counter of
+        each user is incremented separately, as the cache has no atomic bulk increment.
+
+        args:
+            patches (dict): maps the username of each user to the list of patches for their sidebar
+        """
+        keys = {username: self.key(username) for username in patches}
+        entries = self.cache.get_many(list(keys.values()), version=self.VERSION)
+
+        patched = {}
+        for username, user_patches in patches.items():
+            # incremented even when the sidebar is not cached, so a sidebar being built is stale
+            try:
+                revision = self.cache.incr(self.revision_key(username), version=self.VERSION)
+            except ValueError:
+                # the counter expired, so no cached sidebar of the user can be used
+                continue
+
+            entry = entries.get(keys[username])
+            # another patch moved the counter on since the sidebar was stored, or is storing it
+            if entry is None or entry["revision"] != revision - 1:
+                continue
+
+            for function, *args in user_patches:
+                function(entry["sidebar"], *args)
+            entry["revision"] = revision
+            patched[keys[username]] = entry
+            self.patches += 1
+
+        if patched:
+            self.cache.set_many(patched, version=self.VERSION)
+
+    def invalidate(self, username):
+        """
+        Drop the cached sidebar of a user so it is rebuilt on the next page load.
+
+        args:
+            username (str): the username of the user whose sidebar to drop
+        """
+        try:
+            # a sidebar being built while it is dropped is stale once stored
+            self.cache.incr(self.revision_key(username), version=self.VERSION)
+        except ValueError:
+            pass
+        self.cache.delete(self.key(username), version=self.VERSION)
+
+    async def apatch(self, username, *patches):
+        """
+        Asynchronous version of patch() for use by socket consumers.
+        """
+        await self.apatch_many({username: patches})
+
+    async def apatch_many(self, patches):
+        """
+        Asynchronous version of patch_many() for use by socket consumers.
+        """
+        # the cache is called over the network, so it is not made on the thread shared by database calls
+        await sync_to_async(self.patch_many, thread_sensitive=False)(patches)
+
+    async def ainvalidate(self, username):
+        """
+        Asynchronous version of invalidate() for use by socket consumers.
+        """
+        await sync_to_async(self.invalidate, thread_sensitive=False)(username)
+
+    def stats(self):
+        """
+        Retrieve the hit, miss and patch counters of this process.
+
+        returns:
+            dict: the number of cache hits, misses and patches and the hit ratio
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "patches": self.patches,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+def get_sidebar_cache():
+    """
+    Retrieve the sidebar cache of this process.
+
+    returns:
+        SidebarCache: the sidebar cache
+    """
+    global _sidebar_cache
+    if _sidebar_cache is None:
+        _sidebar_cache = SidebarCache()
+    return _sidebar_cache
@@ -1,45 +1,94 @@
-import json
+import asyncio
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.db.models import Q
+from django.db import DatabaseError
 from django.utils import timezone
-
-user_connections = {}
-user_rooms = {}
+from urllib.parse import parse_qs
+from .codec import encode_prepared, negotiate_codec, prepare_frame, stored_ciphertext, wire_ciphertext
+from .context import load_session_context
+from .frames import FrameError, FrameRegistry, compile_schema
+from .history import delete_acknowledged_messages, get_queued_messages
+from .membership import get_membership_index
+from .outbound import create_outbound_queue
+from .presence import (fan_out, gather_bounded, get_presence_notifier, get_presence_registry, interest_group, send_to_user,
+                       send_to_users)
+from .ratelimit import get_rate_limiter
+from .rooms import RoomNameTaken, create_friend_requests, create_room_with_requests, find_users
+from .sidebar import (add_friend, add_group_chat, add_received_request, add_sent_request, get_sidebar_cache,
+                      remove_room, request_data, set_request_status)
+from .writebehind import WriteBehindFull, get_write_behind
+
+logger = logging.getLogger(__name__)
+
+# handlers of the frames clients send to ChatConsumer, registered by frame type
+frames = FrameRegistry()
+# the optional list of messages an ack_msgs frame asks to keep, which the schema of the frame cannot express
+validate_kept = compile_schema([int], "content.keep")
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # maximum number of saved messages pushed to the client in a single queued_msgs frame
+    queued_batch_size = 100
+    # maximum number of users invited by a single create_room or add_member frame
+    max_invitees = 100
+
     async def connect(self):
         """
         Method executed upon server receiving a socket connection from client.
 
-        Adds client to the socket channel with other users, saves the socket 
-        connection object, updates list of users who are currently online and 
-        sends out the updated list to all socket clients.
+        Registers the socket channel in the presence registry, adds client to the 
+        interest groups of every user it shares a chat room with, sends the client 
+        which of those users are online and, if the user just came online, informs 
+        those users of the change.
+
+        Clients which can decrypt messages as soon as they connect may request that the
+        messages saved for them while offline are pushed straight away by connecting with
+        the "drain" query string parameter set, otherwise they are pushed upon join_room.
+
+        Clients may offer the "chat.msgpack.v1" subprotocol to exchange MessagePack binary
+        frames, in which ciphertexts travel as raw bytes. Otherwise frames are JSON text.
         """
-        self.room_group_name = "broadcast"
+        self.registry = get_presence_registry()
+        self.codec = negotiate_codec(self.scope.get("subprotocols", []))
+        self.outbound = None
+        self.heartbeat = None
+        # primary keys of the messages in the last queued_msgs frame, deleted once acknowledged
+        self.pushed = []
+        # usernames of the users who share a chat room with the user of this connection
+        self.contacts = set()
+        self.context = None
 
         session = self.scope['session']
         
         # check that the client has a HTTP session with the server before starting
         # a websocket connection
         if session.get('username'):
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
-
-            user_connections[session.get('username')] = self.channel_name
-            online = list(user_connections.keys())
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "broadcast",
-                    "content": online
-                }
-            )
+            username = session.get('username')
+            # created before the socket channel can receive events, which are held until the connection is accepted
+            self.outbound = create_outbound_queue(self.send, self.codec, self.overflowed, self.send_failed, start=False)
+
+            came_online = await self.registry.add(username, self.channel_name)
+            self.heartbeat = asyncio.create_task(self.send_heartbeats(username))
+            await self.get_context()
+            self.contacts = await self.get_contacts(username)
+            await self.join_interest_groups(self.contacts)
+
+            await self.accept(subprotocol=self.codec.subprotocol)
+            self.outbound.start()
 
-            await self.accept()
+            # send the full list of online contacts once, after which the client only receives deltas
+            online_contacts = await self.registry.filter_online(self.contacts)
+            await self.send_frame({
+                "type": "presence_snapshot",
+                "content": sorted(online_contacts)
+            })
+
+            if came_online:
+                get_presence_notifier().notify(username, self.contacts)
+
+            query = parse_qs(self.scope.get("query_string", b"").decode())
+            if query.get("drain"):
+                await self.push_queued_messages(username)
 
         else:
             await self.close()
@@ -48,626 +97,858 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         Method executed upon a client disconnecting with the socket server.
 
-        Client's socket connection object is discarded, all clients are
-        informed of the updated list of online users and client is removed
-        from the socket channels.
+        Client's socket channel is discarded from the presence registry, the 
+        user's contacts are informed if the user no longer has any open socket 
+        connections and client is removed from the interest groups it joined.
         """
         session = self.scope['session']
 
         user = session.get('username') 
+
+        if self.outbound:
+            await self.outbound.close()
         
         if user:
-            if user in user_connections:
-                del user_connections[user]
+            if self.heartbeat:
+                self.heartbeat.cancel()
+                self.heartbeat = None
 
-                if user in user_rooms:
-                    del user_rooms[user]
-        
-                online = list(user_connections.keys())
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "broadcast",
-                        "content": online
-                    }
-                )
+                went_offline = await self.registry.remove(user, self.channel_name)
+                if went_offline:
+                    get_presence_notifier().notify(user, self.contacts)
                 
-                if self.room_group_name:
-                    await self.channel_layer.group_discard(
-                        self.room_group_name,
-                        self.channel_name
-                    )
+                await self.leave_interest_groups(self.contacts)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Method executed upon the socket server receiving a message from a client.
 
-        The message is parsed and the appropriate action is taken based on the type
-        of message received.
-
-        All text_data is expected to be in JSON format and contain a "type" key and
-        a "content" key. The "type" key is used to determine the type of message while
-        the content key contains the message's content which should be appropriate for
-        the message type.
+        Every message is expected to be a frame in the wire format negotiated when the
+        socket connected and contain a "type" key and a "content" key. The frame is passed to the handler registered for its type,
+        which is called with the validated content of the frame. Malformed frames, frames
+        sent faster than the rate limit of their type, and frames whose changes the database
+        refused, are answered with an error frame rather than closing the socket connection.
 
         args:
-            text_data (str): the message received from the client
+            text_data (str): the text message received from the client, if any
+            bytes_data (bytes): the binary message received from the client, if any
         """
-        from users.models import AccountUser
-        from chat.models import ChatRoom
+        from django.core.exceptions import ObjectDoesNotExist
 
-        message = json.loads(text_data)
         session = self.scope['session']
 
         if "username" in session:
-            session_username = session.get("username")
-            user = await self.get_user_by_username(session_username)
+            try:
+                message = self.codec.decode(text_data, bytes_data)
+                # throttle before the session context is loaded or the handler queries the database
+                await get_rate_limiter().check(session["username"], frames.frame_type(message))
+                await frames.dispatch(self, message, await self.get_context())
+            except (FrameError, ValueError) as error:
+                await self.send_frame({"type": "error", "content": str(error)})
+            except ObjectDoesNotExist:
+                await self.send_frame({"type": "error", "content": "the requested object does not exist"})
+            except DatabaseError:
+                # such as a value too long for its column, or a row referenced by the frame deleted meanwhile
+                logger.exception("database error handling a frame from %s", session["username"])
+                await self.send_frame({"type": "error", "content": "the request could not be saved"})
+
+    @frames.handler("create_room", {"receivers": [str], "room_type": bool, "group_name": str})
+    async def receive_create_room(self, content, context):
+        """
+        Create a new chat room with the sender as its first member and send a friend request to
+        every invitee.
+        """
+        from users.models import AccountUser
+        session_username = context.username
+        user = context.user
+
+        # a user invited more than once only receives one friend request
+        receivers = list(dict.fromkeys(content["receivers"]))
+
+        # prevent chat room creation if no users are included in the chat room creation
+        if len(receivers) == 0:
+            await self.send_frame({"type": "response", "content": "no users were included in chat room creation"}) 
+            return
+
+        if len(receivers) > self.max_invitees:
+            await self.send_frame({"type": "response", "content": f"no more than {self.max_invitees} users can be invited at once"})
+            return
+
+        # prevent chat room creation if more than one user is included in a direct message 
+        # note that a room type value of False indicates a direct message chat
+        if not content["room_type"]:
+            if len(receivers) != 1:
+                await self.send_frame({"type": "response", "content": "there can only be one friend in a direct message chat"})
+                return
             
-            # if the message type is create_room, a new chat room is created with the
-            # creator of the chat room being added as the only member of the chat room
-            if message["type"] == "create_room":
-                receivers = message["content"]["receivers"]
-
-                # prevent chat room creation if no users are included in the chat room creation
-                if len(receivers) == 0:
-                    await self.send(text_data=json.dumps({"type": "response", "content": "no users were included in chat room creation"})) 
-                    return
-
-                # prevent chat room creation if more than one user is included in a direct message 
-                # note that a room type value of False indicates a direct message chat
-                if not message["content"]["room_type"]:
-                    if len(receivers) != 1:
-                        await self.send(text_data=json.dumps({"type": "response", "content": "there can only be one friend in a direct message chat"}))
+            else:
+                try:
+                    receiver = await self.get_user_by_username(receivers[0])
+                    # obtain any friend requests sent from the sender of this socket message to the intended invitee in a direct message chat
+                    user_to_receiver = await self.filter_friend_request(user, receiver)
+                    # obtain any friend requests sent from the intended invitee of this direct message chat to the sender of this socket message
+                    receiver_to_user = await self.filter_friend_request(receiver, user)
+                    
+                    # prevent the creation of the direct message chat if the sender has already sent an invite to the intended invitee
+                    if len(user_to_receiver) >= 1:
+                        await self.send_frame({"type": "response", "content": f"you have already sent an invite to {receivers[0]}"})
                         return
                     
-                    else:
-                        try:
-                            receiver = await self.get_user_by_username(receivers[0])
-                            # obtain any friend requests sent from the sender of this socket message to the intended invitee in a direct message chat
-                            user_to_receiver = await self.filter_friend_request(user, receiver)
-                            # obtain any friend requests sent from the intended invitee of this direct message chat to the sender of this socket message
-                            receiver_to_user = await self.filter_friend_request(receiver, user)
-                            
-                            # prevent the creation of the direct message chat if the sender has already sent an invite to the intended invitee
-                            if len(user_to_receiver) >= 1:
-                                await self.send(text_data=json.dumps({"type": "response", "content": f"you have already sent an invite to {receivers[0]}"}))
-                                return
-                            
-                            # prevent the creation of the direct message chat if the intended invitee has already sent an invite to the sender and that invite is pending
-                            # note request.status == -1 indicates that the request is pending, while request.status == 0 indicates that the request was rejected and 
-                            # request.status == 1 indicates that the request was accepted
-                            for request in receiver_to_user:
-                                if request.status == -1:
-                                    await self.send(text_data=json.dumps({"type": "response", "content": f"{receivers[0]} already sent you a friend request"}))
-                                    return
-                            
-                            # prevent the creation of the direct message chat if the sender and the intended invitee are already friends
-                            friend_room = await self.retrieve_friend_rooms(user, receiver)
-                            if len(friend_room) > 0:
-                                await self.send(text_data=json.dumps({"type": "response", "content": f"you are already friends with {receivers[0]}"}))
-                                return
-                            
-                        except AccountUser.DoesNotExist:
-                            await self.send(text_data=json.dumps({"type": "response", "content": f"User {receivers[0]} does not exist"}))
-                            return
-
-                # prevent chat room creation if a group name is not provided for the creation of a group chat room
-                elif not message["content"]["group_name"]:
-                    await self.send(text_data=json.dumps({"type": "response", "content": f"A group name must be provided"}))
-                    return
-
-                # prevent chat room creation if the creator of the chat room is included in the list of invitees
-                for username in receivers:
-                    try:
-                        await self.get_user_by_username(username)
-                        if username == session_username:
-                            await self.send(text_data=json.dumps({"type": "response", "content": "cannot have yourself as one of the invited users"}))
+                    # prevent the creation of the direct message chat if the intended invitee has already sent an invite to the sender and that invite is pending
+                    # note request.status == -1 indicates that the request is pending, while request.status == 0 indicates that the request was rejected and 
+                    # request.status == 1 indicates that the request was accepted
+                    for request in receiver_to_user:
+                        if request.status == -1:
+                            await self.send_frame({"type": "response", "content": f"{receivers[0]} already sent you a friend request"})
                             return
-                    except AccountUser.DoesNotExist:
-                        await self.send(text_data=json.dumps({"type": "response", "content": f"user {username} does not exist"}))
+                    
+                    # prevent the creation of the direct message chat if the sender and the intended invitee are already friends
+                    friend_room = await self.retrieve_friend_rooms(user, receiver)
+                    if len(friend_room) > 0:
+                        await self.send_frame({"type": "response", "content": f"you are already friends with {receivers[0]}"})
                         return
-
-                # prevent chat room creation if a chat room with the provided group name already exists
-                try:    
-                    await self.get_chat_room_by_name(message["content"]["group_name"])
-                    await self.send(text_data=json.dumps({"type": "response", "content": f"chat room with name {message['content']['group_name']} already exists"}))
-                    return
-                except ChatRoom.DoesNotExist:
-                    pass
                     
-                group_name = message["content"]["group_name"]
-                room_type = message["content"]["room_type"]
+                except AccountUser.DoesNotExist:
+                    await self.send_frame({"type": "response", "content": f"User {receivers[0]} does not exist"})
+                    return
 
-                # create the chat room and add the creator of the chat room as the first member of the chat room
-                room = await self.create_chat_room(group_name, room_type, user)
-                await self.add_member_to_room(room, user)
-                
-                # send friend requests to all invitees of the chat room
-                # each friend request sent to each user contains the creator of the chat room, the friend requests
-                # id, the chat room id, the group name of the chat room and the room type of chat room 
-                # (true = group chat, false = direct message chat)
-                for username in receivers:
-                    receiver = await self.get_user_by_username(username)
-                    created_request = await self.create_friend_request(user, receiver, room, room_type)
-                    
-                    if username in user_connections:
-                        channel_name = user_connections.get(username)
-                        if channel_name:
-                            await self.channel_layer.send(
-                                channel_name,
-                                {
-                                    "type": "new_request",
-                                    "content": [session_username, created_request.id, room.pk, group_name, room_type]
-                                }
-                            )
-
-                # send back to the creator of the chat room the id of the new chat room, the chat room's group name and room type
-                await self.send(text_data=json.dumps({"type": "response", "content": [room.pk, username, group_name, room_type]}))
-            
-            # if the message type is request_res, the status of a friend request is updated
-            elif message["type"] == "request_res":
-                new_status = message["content"]["status"]
-                request_id = message["content"]["request_id"]
-
-                # check that the new status for a friend request is a valid value of 0 or 1
-                if new_status == 0 or new_status == 1:
-                    request = await self.get_friend_request(request_id)
-                    receiver = await self.get_friend_request_receiver(request)
-                    # ensure that the username of the sender of this socket message matches the intended username of the receiver of
-                    # the friend request before updating the status of the friend request
-                    if receiver.username == session_username:
-                        request.status = new_status
-                        await self.save_friend_request(request)
-                        
-                        sender = await self.get_friend_request_sender(request)
-                        room = await self.get_friend_request_room(request)
-
-                        # send the updated status of the friend request to the sender of the friend request
-                        if sender.username in user_connections:
-                            channel_name = user_connections.get(sender.username)
-                            if channel_name:
-                                await self.channel_layer.send(
-                                    channel_name,
-                                    {
-                                        "type": "request_update",
-                                        "content": [room.pk, session_username, new_status, room.name, room.type]
-                                    }
-                                )
-
-                        # if the friend request was accepted, add the invitee of the friend request to the appropriate chat room
-                        if new_status == 1:
-                            await self.add_member_to_room(room, receiver)
-                            room_members = await self.get_members_of_room(room)
-                            
-                            # if the chat room type is a group chat, inform all current members of the chat room of a new group
-                            # member so that each client will have an updated list of members in the group chat
-                            if room.type:
-                                for member in room_members:
-                                    if member in user_rooms and member in user_connections:
-                                        if user_rooms[member] == room.pk:
-                                            channel_name = user_connections[member]
-                                            if channel_name:
-                                                await self.channel_layer.send(
-                                                    channel_name,
-                                                    {
-                                                        "type": "update_members"
-                                                    }
-                                                )
-
-            # if the message type is remove_room_member, remove the sender of the socket message from the provided group chat room
-            elif message["type"] == "remove_room_member":
-                room_id = message["content"]["room_id"]
-                room = await self.get_chat_room_by_id(room_id)
-                await self.remove_member_from_room(room, user)
-
-            # if the message type is join_room, track which chat room the user joined
-            elif message["type"] == "join_room":
-                room_id = message["content"]["room_id"]
-                room = await self.get_chat_room_by_id(int(room_id))
-                members = await self.get_members_of_room(room)
-                # before tracking the user as joining the provided chat room, ensure that the user is a member of the chat room first
-                if session_username in members:
-                    user_rooms[session_username] = int(room_id)
-            
-            # if the message is send_msg, send the encrypted message to the intended receiver of the message
-            elif message["type"] == "send_msg":
-                encrypted_msg = message["content"]["message"]
-                room_id = message["content"]["room_id"]
-                receiver = message["content"]["receiver"]
-                iv = message["content"]["iv"]
-                date_time = timezone.now().isoformat()
+        # prevent chat room creation if a group name is not provided for the creation of a group chat room
+        elif not content["group_name"]:
+            await self.send_frame({"type": "response", "content": f"A group name must be provided"})
+            return
+
+        # prevent chat room creation if the creator of the chat room is included in the list of invitees
+        if session_username in receivers:
+            await self.send_frame({"type": "response", "content": "cannot have yourself as one of the invited users"})
+            return
+
+        # prevent chat room creation if any invitee does not exist, checking every invitee in one query
+        _, missing = await database_sync_to_async(find_users)(receivers)
+        if missing:
+            username = next(username for username in receivers if username in missing)
+            await self.send_frame({"type": "response", "content": f"user {username} does not exist"})
+            return
+
+        group_name = content["group_name"]
+        room_type = content["room_type"]
+
+        # create the chat room with the creator of the chat room as its first member and a friend request
+        # to every invitee, in one transaction, which is refused if a chat room with the provided group
+        # name already exists
+        try:
+            room, created_requests = await database_sync_to_async(create_room_with_requests)(group_name, room_type, user, receivers)
+        except RoomNameTaken:
+            await self.send_frame({"type": "response", "content": f"chat room with name {group_name} already exists"})
+            return
+        context.rooms.add(room.pk)
+        # the other connections of the creator must reload the chat rooms they are a member of
+        await self.send_to_user(session_username, {"type": "context_invalidate"})
+        
+        # send friend requests to all invitees of the chat room
+        # each friend request sent to each user contains the creator of the chat room, the friend requests
+        # id, the chat room id, the group name of the chat room and the room type of chat room 
+        # (true = group chat, false = direct message chat)
+        # the requests are sent to every invitee, and every sidebar patched, together rather than one invitee at a time
+        new_requests = {}
+        sidebar_patches = {}
+        sent_requests = []
+        for username, created_request in zip(receivers, created_requests):
+            new_requests[username] = {
+                "type": "new_request",
+                **prepare_frame({
+                    "type": "new_request",
+                    "content": [session_username, created_request.id, room.pk, group_name, room_type]
+                })
+            }
+
+            request = request_data(created_request.id, session_username, username, room.pk, group_name, room_type)
+            sidebar_patches[username] = [(add_received_request, request)]
+            sent_requests.append((add_sent_request, request))
+
+        if room_type:
+            sent_requests.append((add_group_chat, room.pk, group_name))
+        sidebar_patches[session_username] = sent_requests
+
+        await self.send_to_users(new_requests)
+        await get_sidebar_cache().apatch_many(sidebar_patches)
+
+        # send back to the creator of the chat room the id of the new chat room, the invitees, the chat room's group name and room type
+        await self.send_frame({"type": "response", "content": [room.pk, ", ".join(receivers), group_name, room_type]})
+
+    @frames.handler("request_res", {"request_id": int, "status": int})
+    async def receive_request_res(self, content, context):
+        """
+        Update the status of a friend request received by the sender, adding them to the chat room
+        of the request if they accepted it.
+        """
+        session_username = context.username
+        user = context.user
+
+        new_status = content["status"]
+        request_id = content["request_id"]
+
+        # check that the new status for a friend request is a valid value of 0 or 1
+        if new_status == 0 or new_status == 1:
+            request = await self.get_friend_request(request_id)
+            receiver = request.receiver
+            # ensure that the username of the sender of this socket message matches the intended username of the receiver of
+            # the friend request before updating the status of the friend request
+            if receiver.username == session_username:
+                request.status = new_status
+                await request.asave(update_fields=["status"])
                 
-                room = await self.get_chat_room_by_id(room_id)
-                members = await self.get_members_of_room(room)
-                receiver_obj = await self.get_user_by_username(receiver)
-
-                # ensure the sender of the message is a member of the chat room that they wish to send the message to
-                if session_username in members:
-                    # if the receiver is not online then save the message on the database
-                    if receiver not in user_rooms:
-                        await self.create_message(user, receiver_obj, encrypted_msg, room, date_time, iv, user.public_key)
-                    # if the receiver is online then send the message directly to them
-                    else:
-                        if receiver in user_connections:
-                            channel_name = user_connections.get(receiver)
-                            if channel_name:
-                                await self.channel_layer.send(
-                                    channel_name,
-                                    {
-                                        "type": "new_msg",
-                                        "content": [session_username, room_id, encrypted_msg, date_time, iv]
-                                    }
-                                )
-            # if the message type is add_member, add the user into the group chat
-            elif message["type"] == "add_member":
-                usernames_to_add = message["content"]["users_to_add"]
-                room_id = message["content"]["room_id"]
-
-                room = await self.get_chat_room_by_id(room_id)
-                room_owner = await self.get_room_owner(room)
-
-                # check that the sender of the socket message is the owner of the chat room and the chat room is a group chat
-                if room_owner.username == session_username and room.type:
-                    room_members = await self.get_members_of_room(room)
-                    
-                    # add each user to the group chat room, however, check that each username is actually valid first
-                    for username in usernames_to_add:
-                        try:
-                            receiver = await self.get_user_by_username(username)
-                            if username in room_members:
-                                await self.send(text_data=json.dumps({"type": "response", "content": f"user {username} is already part of the group chat"}))
-                                return
-                        except AccountUser.DoesNotExist:
-                            await self.send(text_data=json.dumps({"type": "response", "content": f"user {username} does not exist"}))
-                            return
-                    
-                    # add each user to the group chat room and send a friend request to each user
-                    for username in usernames_to_add:
-                        receiver = await self.get_user_by_username(username)
-                        created_request = await self.create_friend_request(user, receiver, room, room.type)
-                        if username in user_connections:
-                            channel_name = user_connections.get(username)
-                            if channel_name:
-                                await self.channel_layer.send(
-                                    channel_name,
-                                    {
-                                        "type": "new_request",
-                                        "content": [session_username, created_request.id, room.pk, room.name, room.type]
-                                    }
-                                )
-
-            # remove a member from a group chat room. Only the owner of the group chat room can remove members
-            elif message["type"] == "remove_member":
-                username_to_remove = message["content"]["user_to_remove"]
-                room_id = message["content"]["room_id"]
-
-                room = await self.get_chat_room_by_id(room_id)
-                room_owner = await self.get_room_owner(room)
-
-                # check that the sender of the socket message is the owner of the chat room and the chat room is a group chat
-                if room_owner.username == session_username and room.type:
-                    user_to_remove = await self.get_user_by_username(username_to_remove)
-                    await self.remove_member_from_room(room, user_to_remove)
-
-                    # inform all other members of the group chat that a member has been removed
-                    room_members = await self.get_members_of_room(room)
-                    for member in room_members:
-                        if member in user_rooms and member in user_connections:
-                            if user_rooms[member] == room_id:
-                                channel_name = user_connections[member]
-                                if channel_name:
-                                    await self.channel_layer.send(
-                                        channel_name,
-                                        {
-                                            "type": "update_members"
-                                        }
-                                    )
-
-            # if the message type is pk_key_change, inform all members of the chat room that the public key of the sender of the message has changed
-            elif message["type"] == "pk_key_change":
-                await self.channel_layer.group_send(
-                    self.room_group_name,
+                sender = request.sender
+                room = request.room
+
+                # send the updated status of the friend request to the sender of the friend request
+                await self.send_to_user(
+                    sender.username,
                     {
-                        "type": "update_key",
-                        "content": session_username
+                        "type": "request_update",
+                        **prepare_frame({
+                            "type": "request_update",
+                            "content": [room.pk, session_username, new_status, room.name, room.type]
+                        })
                     }
                 )
 
-    @database_sync_to_async
-    def get_user_by_username(self, username):
+                sidebar = get_sidebar_cache()
+                receiver_patches = [(set_request_status, request.pk, new_status)]
+                sender_patches = [(set_request_status, request.pk, new_status)]
+
+                # if the friend request was accepted, add the invitee of the friend request to the appropriate chat room
+                if new_status == 1:
+                    await self.add_member_to_room(room, receiver)
+                    context.rooms.add(room.pk)
+                    # the other connections of the invitee must reload the chat rooms they are a member of
+                    await self.send_to_user(session_username, {"type": "context_invalidate"})
+
+                    if room.type:
+                        receiver_patches.append((add_group_chat, room.pk, room.name))
+                    else:
+                        receiver_patches.append((add_friend, sender.username, room.pk, sender.about))
+                        sender_patches.append((add_friend, session_username, room.pk, user.about))
+
+                    room_members = await self.get_members_of_room(room.pk)
+                    
+                    # if the chat room type is a group chat, inform all current members of the chat room of a new group
+                    # member so that each client will have an updated list of members in the group chat
+                    if room.type:
+                        update_members = {"type": "update_members", "room_id": room.pk, **prepare_frame({"type": "update_members"})}
+                        await self.send_to_users(dict.fromkeys(room_members, update_members), room_id=room.pk)
+
+                    # the invitee now shares a chat room with every member, so exchange their presence
+                    new_contacts = set(room_members) - self.contacts - {session_username}
+                    self.contacts.update(new_contacts)
+                    await self.join_interest_groups(new_contacts)
+                    came_online = {
+                        "type": "presence",
+                        "new_contacts": [session_username],
+                        **prepare_frame({
+                            "type": "presence",
+                            "content": {"online": [session_username], "offline": []}
+                        })
+                    }
+                    await self.send_to_users(dict.fromkeys(new_contacts, came_online))
+                    online_contacts = await self.registry.filter_online(new_contacts)
+                    await self.send_frame({
+                        "type": "presence",
+                        "content": {"online": sorted(online_contacts), "offline": []}
+                    })
+
+                await sidebar.apatch_many({session_username: receiver_patches, sender.username: sender_patches})
+
+    @frames.handler("remove_room_member", {"room_id": (int, str)})
+    async def receive_remove_room_member(self, content, context):
         """
-        Retrieve a user object from the database using the provided username.
+        Remove the sender from a chat room they are a member of.
+        """
+        session_username = context.username
+        user = context.user
 
-        args:
-            username (str): the username of the user to retrieve from the database
+        room_id = content["room_id"]
+        room = await self.get_chat_room_by_id(room_id)
+        await self.remove_member_from_room(room, user)
+        context.rooms.discard(room.pk)
+        # the other connections of the user must reload the chat rooms they are a member of
+        await self.send_to_user(session_username, {"type": "context_invalidate"})
 
-        returns:
-            AccountUser: the user object retrieved from the database
+        # the user and the remaining members may no longer share a chat room
+        members = await self.get_members_of_room(room.pk)
+        await self.send_to_users(dict.fromkeys([session_username, *members], {"type": "contacts_invalidate"}))
+
+        sidebar = get_sidebar_cache()
+        await sidebar.apatch(session_username, (remove_room, room.pk))
+        # a direct message chat is no longer displayed once either friend has left it
+        if not room.type:
+            await sidebar.apatch_many({member: [(remove_room, room.pk)] for member in members})
+
+    @frames.handler("join_room", {"room_id": (int, str)})
+    async def receive_join_room(self, content, context):
         """
-        from users.models import AccountUser
-        return AccountUser.objects.get(username=username)
-    
-    @database_sync_to_async
-    def get_friend_request(self, pk):
+        Track the chat room the sender has opened and push the messages saved for them.
         """
-        Retrieve a friend request object from the database using the provided primary key.
+        session_username = context.username
 
-        args:
-            pk (int): the primary key of the friend request object to retrieve from the database
+        room_id = content["room_id"]
+        # before tracking the user as joining the provided chat room, ensure that the user is a member of the chat room first
+        if context.is_member(room_id):
+            await self.registry.join(session_username, self.channel_name, int(room_id))
+            # deliver the messages that were saved while the user was not in a chat room
+            await self.push_queued_messages(session_username)
 
-        returns:
-            FriendRequest: the friend request object retrieved from the database
+    @frames.handler("ack_msgs", {"ack": (int, str)})
+    async def receive_ack_msgs(self, content, context):
         """
-        from .models import FriendRequest
-        return FriendRequest.objects.get(pk=pk)
-    
-    @database_sync_to_async
-    def get_friend_request_sender(self, friend_request):
+        Delete the pushed messages that the client has saved and push the next batch. The
+        messages listed in the optional "keep" list, which the client could not decrypt or
+        save, are not deleted.
         """
-        Retrieve the sender of a friend request object.
+        session_username = context.username
 
-        args:
-            friend_request (FriendRequest): the friend request object to retrieve the sender from
+        ack = int(content["ack"])
+        kept = content.get("keep", [])
+        validate_kept(kept)
+        await database_sync_to_async(delete_acknowledged_messages)(session_username, self.pushed, ack, kept)
+        await self.push_queued_messages(session_username, after=ack)
 
-        returns:
-            AccountUser: the sender of the friend request
+    @frames.handler("send_msg", {"message": (list, str, bytes), "room_id": (int, str), "receiver": str, "iv": (list, str, bytes)})
+    async def receive_send_msg(self, content, context):
         """
-        return friend_request.sender
-    
-    @database_sync_to_async
-    def get_friend_request_receiver(self, friend_request):
+        Send an encrypted message to a single member of a chat room, saving it if they are offline.
+        """
+        from .models import Message
+        session_username = context.username
+        user = context.user
+
+        encrypted_msg = content["message"]
+        room_id = content["room_id"]
+        receiver = content["receiver"]
+        iv = content["iv"]
+        date_time = timezone.now().isoformat()
+
+        # ensure the sender of the message is a member of the chat room that they wish to send the message to
+        if context.is_member(room_id):
+            # ciphertexts may only be addressed to members of the chat room
+            if not await get_membership_index().ais_member(room_id, receiver):
+                await self.send_frame({"type": "error", "content": f"user {receiver} is not a member of the chat room"})
+                return
+
+            # only the receiver's socket channels which have joined a chat room can display the message
+            receiver_channels = await self.registry.channels(receiver)
+            joined_channels = [channel_name for channel_name, joined in receiver_channels.items() if joined is not None]
+
+            # if the receiver is not online then save the message on the database
+            if not joined_channels:
+                await self.save_messages([Message(sender=user, receiver_id=receiver, content=stored_ciphertext(encrypted_msg), room_id=int(room_id),
+                                                  date_time=date_time, iv=stored_ciphertext(iv), public_key=context.public_key)])
+            # if the receiver is online then send the message directly to each of their devices
+            else:
+                new_msg = {
+                    "type": "new_msg",
+                    **prepare_frame({
+                        "type": "new_msg",
+                        "content": [session_username, room_id, wire_ciphertext(encrypted_msg), date_time, wire_ciphertext(iv)]
+                    })
+                }
+                for channel_name in joined_channels:
+                    await self.channel_layer.send(channel_name, new_msg)
+
+    @frames.handler("send_msg_multi", {"room_id": (int, str), "messages": [{"receiver": str, "message": (list, str, bytes), "iv": (list, str, bytes)}]})
+    async def receive_send_msg_multi(self, content, context):
+        """
+        Deliver a message that the client encrypted separately for each member of a chat room,
+        saving the copies for offline members.
+        """
+        from .models import Message
+        session_username = context.username
+        user = context.user
+
+        room_id = content["room_id"]
+        date_time = timezone.now().isoformat()
+
+        # ensure the sender of the message is a member of the chat room that they wish to send the message to
+        if context.is_member(room_id):
+            members = await self.get_members_of_room(room_id)
+            # ciphertexts may only be addressed to members of the chat room
+            envelopes = [envelope for envelope in content["messages"] if envelope["receiver"] in members]
+
+            # the socket channels of every receiver are looked up together
+            receiver_channels = await self.registry.channels_many({envelope["receiver"] for envelope in envelopes})
+            offline_messages = []
+            sends = []
+
+            for envelope in envelopes:
+                receiver = envelope["receiver"]
+                encrypted_msg = envelope["message"]
+                iv = envelope["iv"]
+
+                joined_channels = [channel_name for channel_name, joined in receiver_channels.get(receiver, {}).items() if joined is not None]
+
+                if not joined_channels:
+                    offline_messages.append(Message(sender=user, receiver_id=receiver, content=stored_ciphertext(encrypted_msg), room_id=int(room_id),
+                                                    date_time=date_time, iv=stored_ciphertext(iv), public_key=context.public_key))
+                else:
+                    new_msg = {
+                        "type": "new_msg",
+                        **prepare_frame({
+                            "type": "new_msg",
+                            "content": [session_username, room_id, wire_ciphertext(encrypted_msg), date_time, wire_ciphertext(iv)]
+                        })
+                    }
+                    sends.extend((channel_name, new_msg) for channel_name in joined_channels)
+
+            # the copies for online receivers are sent concurrently while the others are saved
+            await fan_out(sends)
+            if offline_messages:
+                await self.save_messages(offline_messages)
+
+    @frames.handler("add_member", {"users_to_add": [str], "room_id": (int, str)})
+    async def receive_add_member(self, content, context):
         """
-        Retrieve the receiver of a friend request object.
+        Invite users to a group chat. Only the owner of the group chat can invite users.
+        """
+        session_username = context.username
+        user = context.user
+
+        usernames_to_add = list(dict.fromkeys(content["users_to_add"]))
+        room_id = content["room_id"]
+
+        if len(usernames_to_add) > self.max_invitees:
+            await self.send_frame({"type": "response", "content": f"no more than {self.max_invitees} users can be invited at once"})
+            return
+
+        room = await self.get_chat_room_by_id(room_id)
+
+        # check that the sender of the socket message is the owner of the chat room and the chat room is a group chat
+        # usernames are the primary keys of users, so the owner is checked without loading them
+        if room.owner_id == session_username and room.type:
+            room_members = await self.get_members_of_room(room.pk)
+            
+            # add each user to the group chat room, however, check that each username is actually valid first,
+            # checking every username in one query
+            _, missing = await database_sync_to_async(find_users)(usernames_to_add)
+            for username in usernames_to_add:
+                if username in missing:
+                    await self.send_frame({"type": "response", "content": f"user {username} does not exist"})
+                    return
+                if username in room_members:
+                    await self.send_frame({"type": "response", "content": f"user {username} is already part of the group chat"})
+                    return
+            
+            # send a friend request to each user, creating every friend request in one transaction
+            created_requests = await database_sync_to_async(create_friend_requests)(user, room, usernames_to_add)
+            new_requests = {}
+            sidebar_patches = {}
+            sent_requests = []
+            for username, created_request in zip(usernames_to_add, created_requests):
+                new_requests[username] = {
+                    "type": "new_request",
+                    **prepare_frame({
+                        "type": "new_request",
+                        "content": [session_username, created_request.id, room.pk, room.name, room.type]
+                    })
+                }
+
+                request = request_data(created_request.id, session_username, username, room.pk, room.name, room.type)
+                sidebar_patches[username] = [(add_received_request, request)]
+                sent_requests.append((add_sent_request, request))
+            sidebar_patches[session_username] = sent_requests
+
+            await self.send_to_users(new_requests)
+            await get_sidebar_cache().apatch_many(sidebar_patches)
+
+    @frames.handler("remove_member", {"user_to_remove": str, "room_id": (int, str)})
+    async def receive_remove_member(self, content, context):
+        """
+        Remove a member from a group chat. Only the owner of the group chat can remove members.
+        """
+        session_username = context.username
+
+        username_to_remove = content["user_to_remove"]
+        room_id = content["room_id"]
+
+        room = await self.get_chat_room_by_id(room_id)
+
+        # check that the sender of the socket message is the owner of the chat room and the chat room is a group chat
+        # usernames are the primary keys of users, so the owner is checked without loading them
+        if room.owner_id == session_username and room.type:
+            user_to_remove = await self.get_user_by_username(username_to_remove)
+            await self.remove_member_from_room(room, user_to_remove)
+
+            # the removed user's connections must reload the chat rooms they are a member of
+            await self.send_to_user(username_to_remove, {"type": "context_invalidate"})
+            await get_sidebar_cache().ainvalidate(username_to_remove)
+
+            # inform all other members of the group chat that a member has been removed
+            room_members = await self.get_members_of_room(room.pk)
+            update_members = {"type": "update_members", "room_id": room.pk, **prepare_frame({"type": "update_members"})}
+            await self.send_to_users(dict.fromkeys(room_members, update_members), room_id=int(room_id))
+
+            # the removed user and the remaining members may no longer share a chat room
+            await self.send_to_users(dict.fromkeys([username_to_remove, *room_members], {"type": "contacts_invalidate"}))
+
+    @frames.handler("pk_key_change")
+    async def receive_pk_key_change(self, content, context):
+        """
+        Inform every user who shares a chat room with the sender that their public key has changed.
+        """
+        session_username = context.username
+
+        # the new public key was saved over HTTP, so reload it before it is attached to any saved messages
+        self.context = None
+        # the frame is encoded once by each process rather than by each of the consumers in the interest group
+        await self.channel_layer.group_send(
+            interest_group(session_username),
+            {
+                "type": "update_key",
+                **prepare_frame({
+                    "type": "update_key",
+                    "content": session_username
+                })
+            }
+        )
+
+    async def send_frame(self, frame):
+        """
+        Queue a frame to be sent to the client in the wire format negotiated when the
+        socket connected.
 
         args:
-            friend_request (FriendRequest): the friend request object to retrieve the receiver
+            frame (dict): the frame to send
+        """
+        if self.outbound:
+            await self.outbound.put(self.codec.encode(frame))
 
-        returns:
-            AccountUser: the receiver of the friend request
+    async def forward(self, event, coalesce_key=None):
         """
-        return friend_request.receiver
-    
-    @database_sync_to_async
-    def get_friend_request_room(self, friend_request):
+        Queue the frame of a channel layer event built with prepare_frame() to be sent to
+        the client, encoded in the wire format of this socket connection once per process.
+
+        args:
+            event (dict): the channel layer event carrying the encoded frame
+            coalesce_key (hashable): if provided, the frame is skipped while a frame with the
+            same key is waiting to be sent
+        """
+        if self.outbound:
+            await self.outbound.put(encode_prepared(event, self.codec), coalesce_key)
+
+    async def overflowed(self):
+        """
+        Close the socket connection when more frames are waiting to be sent to the client
+        than its outbound queue holds, so that the client reconnects and reloads its state.
         """
-        Retrieve the chat room associated with a friend request object.
+        # 1013 asks the client to try again later
+        await self.close(code=1013)
+
+    async def send_failed(self):
+        """
+        Close the socket connection when a frame could not be sent to the client, as the
+        frames queued after it would never be sent.
+        """
+        # 1011 tells the client the server hit an unexpected condition
+        await self.close(code=1011)
+
+    async def send_heartbeats(self, username):
+        """
+        Periodically refresh the expiry of this socket channel in the presence registry
+        for as long as the socket connection is open.
 
         args:
-            friend_request (FriendRequest): the friend request object to retrieve the chat room
+            username (str): the username of the user who owns this socket connection
+        """
+        while True:
+            await asyncio.sleep(self.registry.heartbeat_interval)
+            await self.registry.touch(username, self.channel_name)
 
-        returns:
-            ChatRoom: the chat room associated with the friend request
+    async def push_queued_messages(self, username, after=0):
         """
-        return friend_request.room
-    
-    @database_sync_to_async
-    def save_friend_request(self, friend_request):
+        Send the client the next batch of messages that were saved on the server for the user
+        of this socket connection while they were offline. The messages are deleted once the
+        client acknowledges the batch with an ack_msgs message, which also requests the next batch.
+
+        args:
+            username (str): the username of the user of this socket connection
+            after (int): the primary key of the message after which the batch starts
+        """
+        # messages still waiting in the write-behind queue must be written before they can be read back
+        await get_write_behind().flush()
+        messages = await database_sync_to_async(get_queued_messages)(username, after, self.queued_batch_size)
+        self.pushed = [message["id"] for message in messages]
+        if messages:
+            for message in messages:
+                message["content"] = self.codec.saved_ciphertext(message["content"])
+                message["iv"] = self.codec.saved_ciphertext(message["iv"])
+            await self.send_frame({
+                "type": "queued_msgs",
+                "content": {"messages": messages, "next": messages[-1]["id"]}
+            })
+
+    async def join_interest_groups(self, usernames):
+        """
+        Add this socket channel to the interest groups of users, so that it receives the
+        events sent about those users such as public key changes.
+
+        args:
+            usernames (iterable): the usernames of the users whose interest groups to join
+        """
+        # the groups are joined concurrently, as a user may share chat rooms with many users
+        await gather_bounded(
+            self.channel_layer.group_add(interest_group(username), self.channel_name)
+            for username in usernames
+        )
+
+    async def leave_interest_groups(self, usernames):
         """
-        Save a friend request object to the database.
+        Discard this socket channel from the interest groups of users.
 
         args:
-            friend_request (FriendRequest): the friend request object to save to the database
+            usernames (iterable): the usernames of the users whose interest groups to leave
         """
-        friend_request.save()
-    
-    @database_sync_to_async 
-    def filter_friend_request(self, sender, receiver):
+        await gather_bounded(
+            self.channel_layer.group_discard(interest_group(username), self.channel_name)
+            for username in usernames
+        )
+
+    async def send_to_user(self, username, event, room_id=None):
         """
-        Retrieve all friend requests sent from a sender to a receiver.
+        Send a channel layer event to every socket channel of a user, on whichever
+        worker process the socket connection is held.
 
         args:
-            sender (AccountUser): the sender of the friend request
-            receiver (AccountUser): the receiver of the friend request
+            username (str): the username of the user to send the event to
+            event (dict): the channel layer event to send
+            room_id (int): if provided, only send to socket channels that joined this chat room
         """
-        from .models import FriendRequest
-        return list(FriendRequest.objects.filter(sender=sender, receiver=receiver, chat_type=False))
+        await send_to_user(username, event, room_id=room_id)
 
-    @database_sync_to_async 
-    def retrieve_friend_rooms(self, sender, receiver):
+    async def send_to_users(self, events, room_id=None):
         """
-        Retrieve all chat rooms that the sender and receiver are both members of.
+        Send a channel layer event to every socket channel of each of many users, looking up
+        their socket channels together and sending the events concurrently.
 
         args:
-            sender (AccountUser): the user object of the sender of some friend request
-            receiver (AccountUser): the user object of the receiver of some friend request 
+            events (dict): maps the username of each user to the channel layer event to send them
+            room_id (int): if provided, only send to socket channels that joined this chat room
         """
-        from .models import ChatRoom
-        return list(ChatRoom.objects.filter(Q(members=sender) & Q(type=False) & Q(members=receiver)))
-    
-    @database_sync_to_async
-    def get_chat_room_by_id(self, room_id):
+        await send_to_users(events, room_id=room_id)
+
+    async def get_context(self):
         """
-        Retrieve a chat room object from the database using the provided primary key.
+        Retrieve the session context of the user of this socket connection, loading it
+        from the database if it has not been loaded or was invalidated.
+
+        returns:
+            SessionContext: the session context of the user of this socket connection
+        """
+        if self.context is None:
+            self.context = await database_sync_to_async(load_session_context)(self.scope['session'].get('username'))
+        return self.context
+
+    async def get_contacts(self, username):
+        """
+        Retrieve the usernames of all users who share at least one chat room with a user.
 
         args:
-            room_id (int): the primary key of the chat room object to retrieve from the database
+            username (str): the username of the user
 
         returns:
-            ChatRoom: the chat room object retrieved from the database
+            set: the usernames of the users who share a chat room with the user
         """
-        from .models import ChatRoom
-        return ChatRoom.objects.get(pk=room_id)
-    
-    @database_sync_to_async
-    def get_chat_room_by_name(self, name):
+        from .models import RoomMember
+        rooms = RoomMember.objects.filter(user=username).values("chat_room")
+        contacts = RoomMember.objects.filter(chat_room__in=rooms).exclude(user=username).values_list("user", flat=True).distinct()
+        return {contact async for contact in contacts}
+
+    async def get_user_by_username(self, username):
         """
-        Retrieve a chat room object from the database using the provided chat name.
+        Retrieve a user object from the database using the provided username.
 
         args:
-            name (str): the name of the chat room used to retrieve the chat room object from the database
+            username (str): the username of the user to retrieve from the database
 
         returns:
-            ChatRoom: the chat room object retrieved from the database
+            AccountUser: the user object retrieved from the database
         """
-        from .models import ChatRoom
-        return ChatRoom.objects.get(name=name)
+        from users.models import AccountUser
+        return await AccountUser.objects.aget(username=username)
     
-    @database_sync_to_async
-    def create_chat_room(self, group_name, room_type, user):
+    async def get_friend_request(self, pk):
         """
-        Create a new chat room object in the database.
+        Retrieve a friend request object from the database using the provided primary key,
+        along with its sender, receiver and chat room in the same query.
 
         args:
-            group_name (str): the name of the chat room
-            room_type (bool): the type of chat room (True = group chat, False = direct message chat)
-            user (AccountUser): the user object of the creator of the chat room
+            pk (int): the primary key of the friend request object to retrieve from the database
 
         returns:
-            ChatRoom: the chat room object created in the database
+            FriendRequest: the friend request object retrieved from the database
         """
-        from .models import ChatRoom
-        return ChatRoom.objects.create(name=group_name, type=room_type, owner=user)
+        from .models import FriendRequest
+        return await FriendRequest.objects.select_related("sender", "receiver", "room").aget(pk=pk)
     
-    @database_sync_to_async
-    def create_friend_request(self, sender, receiver, room, room_type):
+    async def filter_friend_request(self, sender, receiver):
         """
-        Create a new friend request object in the database.
+        Retrieve all friend requests sent from a sender to a receiver.
 
         args:
             sender (AccountUser): the sender of the friend request
             receiver (AccountUser): the receiver of the friend request
-            room (ChatRoom): the chat room associated with the friend request
-            room_type (bool): the type of chat room (True = group chat, False = direct message chat)
+        """
+        from .models import FriendRequest
+        return [request async for request in FriendRequest.objects.filter(sender=sender, receiver=receiver, chat_type=False)]
+
+    async def retrieve_friend_rooms(self, sender, receiver):
+        """
+        Retrieve all chat rooms that the sender and receiver are both members of.
+
+        args:
+            sender (AccountUser): the user object of the sender of some friend request
+            receiver (AccountUser): the user object of the receiver of some friend request 
+        """
+        from .models import ChatRoom
+        # each membership condition needs its own filter() so that it joins the members
+        # separately, a single filter() requires one member to be both users
+        return [room async for room in ChatRoom.objects.filter(members=sender, type=False).filter(members=receiver)]
+    
+    async def get_chat_room_by_id(self, room_id):
+        """
+        Retrieve a chat room object from the database using the provided primary key.
+
+        args:
+            room_id (int): the primary key of the chat room object to retrieve from the database
 
         returns:
-            FriendRequest: the friend request object created in the database
+            ChatRoom: the chat room object retrieved from the database
         """
-        from .models import FriendRequest
-        return FriendRequest.objects.create(sender=sender, receiver=receiver, room=room, status=-1, chat_type=room_type)
+        from .models import ChatRoom
+        return await ChatRoom.objects.aget(pk=room_id)
     
-    @database_sync_to_async
-    def add_member_to_room(self, room, new_member):
+    async def add_member_to_room(self, room, new_member):
         """
         Add a new member to a chat room which is stored in the database.
 
+        The RoomMember row is created directly, as related managers have no asynchronous
+        add() in this version of Django. Like add(), adding an existing member does nothing,
+        and the post_save signal of a new row updates the membership index.
+
         args:
             room (ChatRoom): the chat room to add the new member to
             new_member (AccountUser): the new member to add to the chat room
-
-        returns:
-            ChatRoom: the chat room object with the new member added to the chat room in the database
         """
-        room.members.add(new_member)
-        room.save()
+        from .models import RoomMember
+        await RoomMember.objects.aget_or_create(chat_room=room, user=new_member)
 
-    @database_sync_to_async
-    def remove_member_from_room(self, room, member):
+    async def remove_member_from_room(self, room, member):
         """
         Remove a member from a chat room which is stored in the database.
 
         args:
             room (ChatRoom): the chat room to remove the member from
             member (AccountUser): the member to remove from the chat room
-
-        returns:
-            ChatRoom: the chat room object with the member removed from the chat room in the database
         """
-        room.members.remove(member)
-        room.save()
+        from .models import RoomMember
+        await RoomMember.objects.filter(chat_room=room, user=member).adelete()
 
-    @database_sync_to_async
-    def get_members_of_room(self, room):
+    async def get_members_of_room(self, room_id):
         """
-        Retrieve all members of a chat room.
+        Retrieve all members of a chat room from the membership index.
 
         args:
-            room (ChatRoom): the chat room to retrieve the members from
+            room_id (int): the primary key of the chat room to retrieve the members from
 
         returns:
-            list: a list of all members of the chat room
+            frozenset: the usernames of all members of the chat room
         """
-        members = []
-        for member in room.members.all():
-            members.append(member.username)
-        return members
+        return await get_membership_index().amembers(room_id)
     
-    @database_sync_to_async
-    def create_message(self, user, receiver, encrypted_msg, room, date_time, iv, public_key):
+    async def save_messages(self, messages):
         """
-        Create a new message object in the database.
+        Save messages for offline receivers through the write-behind queue, which writes
+        them to the database in batches. If the queue stays full the messages are written
+        directly instead.
 
         args:
-            user (AccountUser): the sender of the message
-            receiver (AccountUser): the receiver of the message
-            encrypted_msg (str): the encrypted message content
-            room (ChatRoom): the chat room associated with the message
-            date_time (str): the date and time the message was sent
-            iv (str): the initialisation vector used to encrypt the message
-            public_key (str): the public key of the sender of the message
-
-        returns:
-            Message: the message object created in the database
+            messages (list): the unsaved Message objects to save
         """
-        from .models import Message
-        return Message.objects.create(sender=user, receiver=receiver, content=encrypted_msg, room=room, date_time=date_time, iv=iv, public_key=public_key)
-    
-    @database_sync_to_async
-    def get_room_owner(self, room):
+        try:
+            await get_write_behind().enqueue(messages)
+        except WriteBehindFull:
+            await self.create_messages(messages)
+
+    async def create_messages(self, messages):
         """
-        Retrieve the owner of a chat room.
+        Create many new message objects in the database in a single query.
 
         args:
-            room (ChatRoom): the chat room to retrieve the owner from
-        
+            messages (list): the unsaved Message objects to create
+
         returns:
-            AccountUser: the owner of the chat room
+            list: the message objects created in the database
         """
-        return room.owner
+        from .models import Message
+        return await Message.objects.abulk_create(messages)
 
-    async def broadcast(self, event):
+    async def presence(self, event):
         """
-        Handler method for sending messages of the type "broadcast".
+        Handler method for sending messages of the type "presence", which carry the
+        contacts of the user who came online or went offline.
         """
-        online_users = event["content"]
-        await self.send(text_data=json.dumps({
-            'type': 'broadcast',
-            'content': online_users
-        }))
+        # users who became contacts after this connection was opened must also be
+        # informed when the user of this connection goes offline, and this connection
+        # must now receive their key changes
+        new_contacts = set(event.get("new_contacts", [])) - self.contacts
+        self.contacts.update(new_contacts)
+        await self.join_interest_groups(new_contacts)
+        await self.forward(event)
     
+    async def context_invalidate(self, event):
+        """
+        Handler method for events of the type "context_invalidate", which are not sent to
+        the client but discard the cached session context of this socket connection.
+        """
+        self.context = None
+
+    async def contacts_invalidate(self, event):
+        """
+        Handler method for events of the type "contacts_invalidate", which are not sent to
+        the client but reload the contacts of the user of this socket connection after a
+        membership was removed, leaving the interest groups of users who no longer share a
+        chat room with them.
+        """
+        contacts = await self.get_contacts(self.scope['session'].get('username'))
+        await self.leave_interest_groups(self.contacts - contacts)
+        await self.join_interest_groups(contacts - self.contacts)
+        self.contacts = contacts
+
     async def request_update(self, event):
         """
         Handler method for sending messages of the type "request_update".
         """
-        content = event["content"]
-        await self.send(text_data=json.dumps({
-            'type': 'request_update',
-            'content': content
-        }))
+        await self.forward(event)
 
     async def new_request(self, event):
         """
         Handler method for sending messages of the type "new_request".
         """
-        content = event["content"]
-        await self.send(text_data=json.dumps({
-            'type': 'new_request',
-            'content': content
-        }))
+        await self.forward(event)
 
     async def new_msg(self, event):
         """
         Handler method for sending messages of the type "new_msg".
         """
-        content = event["content"]
-        await self.send(text_data=json.dumps({
-            'type': 'new_msg',
-            'content': content
-        }))
+        await self.forward(event)
 
     async def update_members(self, event):
         """
-        Handler method for sending messages of the type "update_members".
+        Handler method for sending messages of the type "update_members". The client
+        reloads the members of the chat room upon any number of these frames, so a frame
+        is not queued while another for the same chat room is waiting to be sent.
         """
-        await self.send(text_data=json.dumps({
-            'type': 'update_members'
-        }))
+        await self.forward(event, coalesce_key=("update_members", event.get("room_id")))
 
     async def update_key(self, event):
         """
         Handler method for sending messages of the type "update_key".
         """
-        content = event["content"]
-        await self.send(text_data=json.dumps({
-            'type': 'update_key',
-            'content': content
-        }))
\ No newline at end of file
+        await self.forward(event)
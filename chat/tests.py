@@ -0,0 +1,930 @@
+import asyncio
+import json
+import msgpack
+import threading
+import time
+from unittest import mock
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from users.models import AccountUser
+from chat import membership, presence, ratelimit, sidebar, writebehind
+from chat.codec import JSONCodec, MsgpackCodec, encode_prepared, prepare_frame, wire_ciphertext
+from chat.models import ChatRoom, FriendRequest, Message, RoomMember
+from chat.outbound import OutboundQueue
+from chat.sockets import ChatConsumer
+from chat.views import ChatHistoryView
+
+# backends held in the memory of the test process, so that the tests need no Redis server
+LOCAL_SETTINGS = {
+    "CHANNEL_LAYERS": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    "CHAT_PRESENCE": {"BACKEND": "chat.presence.LocalPresenceRegistry", "CONFIG": {}, "DELTA_WINDOW": 0.01},
+    "CHAT_MEMBERSHIP": {"BACKEND": "chat.membership.LocalMembershipIndex", "CONFIG": {}},
+    "CHAT_RATE_LIMIT": {"BACKEND": "chat.ratelimit.LocalRateLimiter", "CONFIG": {}},
+    "CHAT_OUTBOUND": {"max_frames": 1000, "overflow": "disconnect", "batch_frames": 1, "batch_bytes": 4096},
+    "CACHES": {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "sidebar": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "sidebar"},
+        "throttle": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "throttle"},
+    },
+}
+
+
+@override_settings(**LOCAL_SETTINGS)
+class ChatTestCase(TransactionTestCase):
+    """
+    Base test case of the chat app, which recreates the per process backends of the
+    chat app from the local settings before each test.
+    """
+    def setUp(self):
+        presence._registry = None
+        presence._notifier = None
+        membership._index = None
+        ratelimit._limiter = None
+        sidebar._sidebar_cache = None
+        writebehind._write_behind = None
+        caches["sidebar"].clear()
+
+    def create_user(self, username):
+        return AccountUser.objects.create(username=username, first_name=username, last_name="test", public_key={})
+
+    def create_room(self, name, room_type, owner, members):
+        room = ChatRoom.objects.create(name=name, type=room_type, owner=owner)
+        for member in [owner, *members]:
+            RoomMember.objects.create(chat_room=room, user=member)
+        return room
+
+    def log_in(self, username):
+        session = self.client.session
+        session["username"] = username
+        session.save()
+
+    async def connect(self, username, subprotocols=None, query_string=b""):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/", subprotocols=subprotocols)
+        communicator.scope["session"] = {"username": username}
+        communicator.scope["query_string"] = query_string
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_frame(self, communicator, timeout=1):
+        message = await communicator.receive_output(timeout)
+        if message.get("bytes") is not None:
+            return msgpack.unpackb(message["bytes"], raw=False)
+        return json.loads(message["text"])
+
+    async def send_msgpack(self, communicator, frame):
+        await communicator.send_to(bytes_data=msgpack.packb(frame))
+
+    async def receive_frame_of_type(self, communicator, frame_type, timeout=1):
+        while True:
+            frame = await self.receive_frame(communicator, timeout)
+            if frame["type"] == frame_type:
+                return frame
+
+
+class PresenceTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.carol = self.create_user("carol")
+        self.create_room("alice-bob", False, self.alice, [self.bob])
+
+    async def test_contact_receives_delta_when_user_connects(self):
+        alice = await self.connect("alice")
+        snapshot = await self.receive_frame(alice)
+        self.assertEqual(snapshot, {"type": "presence_snapshot", "content": []})
+
+        bob = await self.connect("bob")
+        self.assertEqual(await self.receive_frame(bob), {"type": "presence_snapshot", "content": ["alice"]})
+
+        delta = await self.receive_frame_of_type(alice, "presence")
+        self.assertEqual(delta["content"], {"online": ["bob"], "offline": []})
+
+        await bob.disconnect()
+        delta = await self.receive_frame_of_type(alice, "presence")
+        self.assertEqual(delta["content"], {"online": [], "offline": ["bob"]})
+        await alice.disconnect()
+
+    async def test_non_contact_receives_no_delta(self):
+        carol = await self.connect("carol")
+        await self.receive_frame(carol)
+
+        alice = await self.connect("alice")
+        await self.receive_frame(alice)
+        await asyncio.sleep(0.05)
+        self.assertTrue(await carol.receive_nothing())
+
+        await alice.disconnect()
+        await carol.disconnect()
+
+
+@override_settings(**LOCAL_SETTINGS)
+class SendToUsersTests(SimpleTestCase):
+    async def connect_channels(self, registry, username, count, room_id=None):
+        channel_layer = get_channel_layer()
+        channel_names = [await channel_layer.new_channel() for _ in range(count)]
+        for channel_name in channel_names:
+            await registry.add(username, channel_name)
+            if room_id is not None:
+                await registry.join(username, channel_name, room_id)
+        return channel_names
+
+    async def receive(self, channel_name):
+        return await asyncio.wait_for(get_channel_layer().receive(channel_name), 1)
+
+    async def test_each_channel_of_each_user_receives_its_event(self):
+        registry = presence.LocalPresenceRegistry()
+        alice = await self.connect_channels(registry, "alice", 2)
+        bob = await self.connect_channels(registry, "bob", 1)
+
+        # carol is offline, so her event is not sent
+        await presence.send_to_users({
+            "alice": {"type": "ping", "to": "alice"},
+            "bob": {"type": "ping", "to": "bob"},
+            "carol": {"type": "ping", "to": "carol"},
+        }, registry=registry)
+
+        for channel_name in alice:
+            self.assertEqual((await self.receive(channel_name))["to"], "alice")
+        self.assertEqual((await self.receive(bob[0]))["to"], "bob")
+
+    async def test_only_offline_users_sends_nothing(self):
+        registry = presence.LocalPresenceRegistry()
+        with mock.patch("chat.presence.fan_out") as fan_out:
+            await presence.send_to_users({"carol": {"type": "ping"}}, registry=registry)
+        fan_out.assert_called_once_with([])
+
+    async def test_room_id_limits_the_channels_sent_to(self):
+        registry = presence.LocalPresenceRegistry()
+        in_room = await self.connect_channels(registry, "alice", 1, room_id=1)
+        elsewhere = await self.connect_channels(registry, "alice", 1, room_id=2)
+
+        await presence.send_to_users({"alice": {"type": "ping"}}, room_id=1, registry=registry)
+
+        self.assertEqual(await self.receive(in_room[0]), {"type": "ping"})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(get_channel_layer().receive(elsewhere[0]), 0.05)
+
+    async def test_sends_beyond_the_concurrency_bound_are_all_made(self):
+        registry = presence.LocalPresenceRegistry()
+        channel_names = {}
+        for index in range(5):
+            channel_names[f"user{index}"] = await self.connect_channels(registry, f"user{index}", 1)
+
+        with override_settings(CHAT_PRESENCE={**LOCAL_SETTINGS["CHAT_PRESENCE"], "FANOUT_CONCURRENCY": 2}):
+            await presence.send_to_users({username: {"type": "ping", "to": username} for username in channel_names},
+                                         registry=registry)
+
+        for username, (channel_name,) in channel_names.items():
+            self.assertEqual((await self.receive(channel_name))["to"], username)
+
+
+class InterestGroupTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.friends = [self.create_user(f"friend{index}") for index in range(5)]
+        self.create_room("group", True, self.alice, self.friends)
+
+    async def test_key_change_reaches_every_contact(self):
+        friends = [await self.connect(friend.username) for friend in self.friends]
+        alice = await self.connect("alice")
+
+        await alice.send_to(text_data=json.dumps({"type": "pk_key_change"}))
+        for friend in friends:
+            frame = await self.receive_frame_of_type(friend, "update_key")
+            self.assertEqual(frame["content"], "alice")
+
+        for communicator in [alice, *friends]:
+            await communicator.disconnect()
+
+
+class MessageTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.carol = self.create_user("carol")
+        self.room = self.create_room("group", True, self.alice, [self.bob, self.carol])
+
+    async def join(self, username):
+        communicator = await self.connect(username)
+        await self.receive_frame(communicator)
+        await communicator.send_to(text_data=json.dumps({"type": "join_room", "content": {"room_id": self.room.pk}}))
+        # join_room is not answered unless messages were saved, so wait for the registry to record it
+        while self.room.pk not in (await presence.get_presence_registry().channels(username)).values():
+            await asyncio.sleep(0.01)
+        return communicator
+
+    async def test_send_msg_multi_delivers_online_and_saves_offline(self):
+        alice = await self.join("alice")
+        bob = await self.join("bob")
+
+        await alice.send_to(text_data=json.dumps({"type": "send_msg_multi", "content": {
+            "room_id": self.room.pk,
+            "messages": [
+                {"receiver": "bob", "message": [1, 2], "iv": [3]},
+                {"receiver": "carol", "message": [4, 5], "iv": [6]},
+                {"receiver": "mallory", "message": [7], "iv": [8]},
+            ]
+        }}))
+
+        frame = await self.receive_frame_of_type(bob, "new_msg")
+        self.assertEqual(frame["content"][0], "alice")
+        self.assertEqual(frame["content"][2], [1, 2])
+
+        await writebehind.get_write_behind().flush()
+        saved = [message async for message in Message.objects.values_list("receiver", "content")]
+        self.assertEqual(saved, [("carol", "[4, 5]")])
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_saved_ciphertexts_are_validated(self):
+        alice = await self.join("alice")
+
+        await alice.send_to(text_data=json.dumps({"type": "send_msg", "content": {
+            "message": [256], "room_id": self.room.pk, "receiver": "carol", "iv": [1]
+        }}))
+        frame = await self.receive_frame_of_type(alice, "error")
+        self.assertEqual(frame["content"], "ciphertexts must be arrays of byte values")
+
+        await writebehind.get_write_behind().flush()
+        self.assertFalse(await Message.objects.aexists())
+        await alice.disconnect()
+
+    async def test_database_errors_are_answered_with_an_error_frame(self):
+        alice = await self.join("alice")
+
+        with mock.patch.object(ChatConsumer, "save_messages", side_effect=IntegrityError("FOREIGN KEY constraint failed")), \
+                self.assertLogs("chat.sockets", "ERROR"):
+            await alice.send_to(text_data=json.dumps({"type": "send_msg", "content": {
+                "message": [1], "room_id": self.room.pk, "receiver": "carol", "iv": [2]
+            }}))
+            frame = await self.receive_frame_of_type(alice, "error")
+        self.assertEqual(frame["content"], "the request could not be saved")
+
+        # the socket connection is still open
+        await alice.send_to(text_data=json.dumps({"type": "send_msg", "content": {
+            "message": [1], "room_id": self.room.pk, "receiver": "carol", "iv": [2]
+        }}))
+        self.assertTrue(await alice.receive_nothing())
+        await writebehind.get_write_behind().flush()
+        self.assertEqual(await Message.objects.acount(), 1)
+        await alice.disconnect()
+
+
+class MembershipTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.carol = self.create_user("carol")
+        self.room = self.create_room("alice-bob", False, self.alice, [self.bob])
+
+    def test_index_is_invalidated_when_the_transaction_commits(self):
+        index = membership.get_membership_index()
+        self.assertEqual(index.members(self.room.pk), {"alice", "bob"})
+
+        with transaction.atomic():
+            RoomMember.objects.create(chat_room=self.room, user=self.carol)
+            # a reader outside the transaction would reload the members from before the change
+            self.assertEqual(index.members(self.room.pk), {"alice", "bob"})
+        self.assertEqual(index.members(self.room.pk), {"alice", "bob", "carol"})
+
+    async def test_send_msg_to_non_member_is_refused(self):
+        alice = await self.connect("alice")
+        await self.receive_frame(alice)
+
+        await alice.send_to(text_data=json.dumps({"type": "send_msg", "content": {
+            "message": [1], "room_id": self.room.pk, "receiver": "carol", "iv": [2]
+        }}))
+        frame = await self.receive_frame_of_type(alice, "error")
+        self.assertEqual(frame["content"], "user carol is not a member of the chat room")
+
+        await writebehind.get_write_behind().flush()
+        self.assertFalse(await Message.objects.aexists())
+        await alice.disconnect()
+
+    async def test_room_created_on_one_device_is_joinable_on_another(self):
+        laptop = await self.connect("alice")
+        phone = await self.connect("alice")
+        await self.receive_frame(laptop)
+        await self.receive_frame(phone)
+        # load the session context of the phone before the chat room is created
+        await phone.send_to(text_data=json.dumps({"type": "join_room", "content": {"room_id": self.room.pk}}))
+
+        await laptop.send_to(text_data=json.dumps({"type": "create_room", "content": {
+            "receivers": ["carol"], "room_type": True, "group_name": "new group"
+        }}))
+        room_id = (await self.receive_frame_of_type(laptop, "response"))["content"][0]
+
+        await phone.send_to(text_data=json.dumps({"type": "join_room", "content": {"room_id": room_id}}))
+        registry = presence.get_presence_registry()
+        for _ in range(100):
+            if room_id in (await registry.channels("alice")).values():
+                break
+            await asyncio.sleep(0.01)
+        self.assertIn(room_id, (await registry.channels("alice")).values())
+
+        await laptop.disconnect()
+        await phone.disconnect()
+
+
+class InviteTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.carol = self.create_user("carol")
+        self.dave = self.create_user("dave")
+        self.create_room("alice-bob", False, self.alice, [self.bob])
+        self.group = self.create_room("group", True, self.alice, [self.bob])
+
+    async def invite(self, communicator, frame_type, content):
+        await communicator.send_to(text_data=json.dumps({"type": frame_type, "content": content}))
+        return (await self.receive_frame_of_type(communicator, "response"))["content"]
+
+    async def send_create_room(self, communicator, receivers, room_type=True, group_name="new group"):
+        return await self.invite(communicator, "create_room", {
+            "receivers": receivers, "room_type": room_type, "group_name": group_name
+        })
+
+    async def test_create_room_refuses_unknown_users(self):
+        alice = await self.connect("alice")
+
+        response = await self.send_create_room(alice, ["carol", "ghost"])
+
+        self.assertEqual(response, "user ghost does not exist")
+        self.assertFalse(await ChatRoom.objects.filter(name="new group").aexists())
+        self.assertFalse(await FriendRequest.objects.aexists())
+        await alice.disconnect()
+
+    async def test_direct_message_refused_for_friends_and_invited_users(self):
+        alice = await self.connect("alice")
+
+        self.assertEqual(await self.send_create_room(alice, ["bob"], False), "you are already friends with bob")
+        self.assertIsInstance(await self.send_create_room(alice, ["carol"], False, ""), list)
+        self.assertEqual(await self.send_create_room(alice, ["carol"], False, ""), "you have already sent an invite to carol")
+        self.assertEqual(await self.send_create_room(alice, ["carol", "dave"], False, ""),
+                         "there can only be one friend in a direct message chat")
+
+        self.assertEqual(await FriendRequest.objects.acount(), 1)
+        await alice.disconnect()
+
+    async def test_duplicate_invitees_receive_one_request(self):
+        alice = await self.connect("alice")
+
+        await self.send_create_room(alice, ["carol", "dave", "carol"])
+
+        receivers = [request.receiver_id async for request in FriendRequest.objects.order_by("receiver")]
+        self.assertEqual(receivers, ["carol", "dave"])
+        await alice.disconnect()
+
+    async def test_response_lists_every_invitee(self):
+        alice = await self.connect("alice")
+
+        response = await self.send_create_room(alice, ["carol", "dave"])
+
+        self.assertEqual(response[1:], ["carol, dave", "new group", True])
+        await alice.disconnect()
+
+    async def test_duplicate_room_name_leaves_no_partial_room(self):
+        alice = await self.connect("alice")
+
+        response = await self.send_create_room(alice, ["carol", "dave"], group_name="group")
+
+        self.assertEqual(response, "chat room with name group already exists")
+        self.assertEqual(await ChatRoom.objects.filter(name="group").acount(), 1)
+        self.assertFalse(await FriendRequest.objects.aexists())
+        self.assertEqual(await RoomMember.objects.filter(chat_room=self.group).acount(), 2)
+        await alice.disconnect()
+
+    async def test_invitees_are_capped(self):
+        alice = await self.connect("alice")
+
+        with mock.patch.object(ChatConsumer, "max_invitees", 1):
+            self.assertEqual(await self.send_create_room(alice, ["carol", "dave"]), "no more than 1 users can be invited at once")
+            self.assertEqual(await self.invite(alice, "add_member", {"users_to_add": ["carol", "dave"], "room_id": self.group.pk}),
+                             "no more than 1 users can be invited at once")
+            # duplicates are removed before the invitees are counted
+            self.assertIsInstance(await self.send_create_room(alice, ["carol", "carol"]), list)
+
+        self.assertEqual(await FriendRequest.objects.acount(), 1)
+        await alice.disconnect()
+
+    async def test_add_member_refuses_unknown_users_and_members(self):
+        alice = await self.connect("alice")
+        room_id = self.group.pk
+
+        self.assertEqual(await self.invite(alice, "add_member", {"users_to_add": ["carol", "ghost"], "room_id": room_id}),
+                         "user ghost does not exist")
+        self.assertEqual(await self.invite(alice, "add_member", {"users_to_add": ["carol", "bob"], "room_id": room_id}),
+                         "user bob is already part of the group chat")
+        self.assertFalse(await FriendRequest.objects.aexists())
+        await alice.disconnect()
+
+    async def test_add_member_invites_each_user_once(self):
+        alice = await self.connect("alice")
+        carol = await self.connect("carol")
+
+        await alice.send_to(text_data=json.dumps({"type": "add_member", "content": {
+            "users_to_add": ["carol", "dave", "carol"], "room_id": self.group.pk
+        }}))
+        frame = await self.receive_frame_of_type(carol, "new_request")
+
+        self.assertEqual(frame["content"][2:], [self.group.pk, "group", True])
+        receivers = [request.receiver_id async for request in FriendRequest.objects.order_by("receiver")]
+        self.assertEqual(receivers, ["carol", "dave"])
+        await alice.disconnect()
+        await carol.disconnect()
+
+    async def test_only_the_owner_can_add_members(self):
+        bob = await self.connect("bob")
+
+        await bob.send_to(text_data=json.dumps({"type": "add_member", "content": {
+            "users_to_add": ["carol"], "room_id": self.group.pk
+        }}))
+        # a later frame is answered once the add_member frame was handled
+        await bob.send_to(text_data=json.dumps({"type": "join_room", "content": {}}))
+        await self.receive_frame_of_type(bob, "error")
+
+        self.assertFalse(await FriendRequest.objects.aexists())
+        await bob.disconnect()
+
+
+class LocalMembershipIndexTests(SimpleTestCase):
+    class Index(membership.LocalMembershipIndex):
+        def load_members(self, room_id):
+            return frozenset([f"user{room_id}"])
+
+    def test_threads_share_a_bounded_index(self):
+        index = self.Index(max_entries=4)
+        errors = []
+
+        def use(offset):
+            try:
+                for i in range(5000):
+                    room_id = (i + offset) % 8
+                    self.assertEqual(index.members(room_id), {f"user{room_id}"})
+                    if i % 7 == 0:
+                        index.invalidate_room(room_id)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=use, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(index._members), 4)
+
+
+class RateLimiterTests(SimpleTestCase):
+    async def test_bucket_rejects_when_empty_and_refills(self):
+        limiter = ratelimit.LocalRateLimiter(limits={"send_msg": (2, 3)})
+        with mock.patch("chat.ratelimit.time.monotonic", return_value=100.0) as monotonic:
+            for _ in range(3):
+                await limiter.check("alice", "send_msg")
+            with self.assertRaises(ratelimit.RateLimited) as raised:
+                await limiter.check("alice", "send_msg")
+            self.assertAlmostEqual(raised.exception.retry_after, 0.5)
+            # other users have buckets of their own
+            await limiter.check("bob", "send_msg")
+
+            # two tokens are added every second, up to the size of the bucket
+            monotonic.return_value = 101.0
+            await limiter.check("alice", "send_msg")
+            await limiter.check("alice", "send_msg")
+            with self.assertRaises(ratelimit.RateLimited):
+                await limiter.check("alice", "send_msg")
+
+            monotonic.return_value = 200.0
+            for _ in range(3):
+                await limiter.check("alice", "send_msg")
+
+        self.assertEqual(limiter.stats(), {"allowed": {"send_msg": 9}, "throttled": {"send_msg": 2}})
+
+    async def test_frame_types_without_a_limit_are_not_limited(self):
+        limiter = ratelimit.LocalRateLimiter(limits={"join_room": None, "send_msg": (1, 1)})
+        for _ in range(10):
+            await limiter.check("alice", "join_room")
+            await limiter.check("alice", "ack_msgs")
+
+    def test_rates_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            ratelimit.LocalRateLimiter(limits={"send_msg": (0, 10)})
+        with self.assertRaises(ValueError):
+            ratelimit.LocalRateLimiter(default=(1, 0))
+
+
+class SidebarQueryTests(ChatTestCase):
+    """
+    The friends and chat pages load in a fixed number of queries however many friends,
+    group chats and friend requests the user has.
+    """
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.room = self.create_room("alice-first", False, self.alice, [self.create_user("first")])
+
+    def add_sidebar_entries(self, count):
+        start = AccountUser.objects.count()
+        for index in range(start, start + count):
+            friend = self.create_user(f"user{index}")
+            self.create_room(f"dm{index}", False, self.alice, [friend])
+            group = self.create_room(f"group{index}", True, friend, [self.alice])
+            FriendRequest.objects.create(sender=friend, receiver=self.alice, room=group, status=-1, chat_type=True)
+            FriendRequest.objects.create(sender=self.alice, receiver=friend, room=group, status=1, chat_type=True)
+
+    def test_friends_page(self):
+        self.log_in("alice")
+        for count in (1, 5):
+            self.add_sidebar_entries(count)
+            caches["sidebar"].clear()
+            # session, user, friends, group chats, received and sent requests
+            with self.assertNumQueries(6):
+                response = self.client.get("/friends/")
+            self.assertEqual(response.status_code, 200)
+            # the cached sidebar is reused by the next page load
+            with self.assertNumQueries(2):
+                self.client.get("/friends/")
+
+    def test_chat_page(self):
+        self.log_in("alice")
+        for count in (1, 5):
+            self.add_sidebar_entries(count)
+            caches["sidebar"].clear()
+            membership.get_membership_index().invalidate_room(self.room.pk)
+            # session, user, the four sidebar queries, chat room and its members
+            with self.assertNumQueries(8):
+                response = self.client.get(f"/chat/{self.room.pk}/")
+            self.assertEqual(response.status_code, 200)
+            with self.assertNumQueries(3):
+                self.client.get(f"/chat/{self.room.pk}/")
+
+
+class SidebarCacheTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.cache = sidebar.get_sidebar_cache()
+
+    def test_patch_updates_cached_sidebar(self):
+        self.cache.get(self.alice)
+        self.cache.patch("alice", (sidebar.add_group_chat, 1, "group"))
+        self.assertEqual(self.cache.get(self.alice)["group_chats"], [{"pk": 1, "name": "group"}])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_sidebar_built_during_patch_is_not_used(self):
+        build_sidebar = sidebar.build_sidebar
+
+        def patched_while_building(user, include_requests=False):
+            built = build_sidebar(user, include_requests)
+            self.cache.patch("alice", (sidebar.add_group_chat, 1, "group"))
+            return built
+
+        with mock.patch("chat.sidebar.build_sidebar", patched_while_building):
+            self.cache.get(self.alice)
+        # the stored sidebar lacks the patch, so it is built again rather than read
+        self.cache.get(self.alice)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_concurrent_patch_makes_sidebar_stale(self):
+        self.cache.get(self.alice)
+        entries = self.cache.cache.get_many([self.cache.key("alice")], version=self.cache.VERSION)
+
+        # another patch increments the revision after this patch read the sidebar
+        def read_then_patched(*args, **kwargs):
+            self.cache.cache.incr(self.cache.revision_key("alice"), version=self.cache.VERSION)
+            return entries
+
+        with mock.patch.object(self.cache.cache, "get_many", read_then_patched):
+            self.cache.patch("alice", (sidebar.add_group_chat, 1, "group"))
+        self.assertEqual(self.cache.patches, 0)
+
+        self.cache.get(self.alice)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+
+class RemoveMemberTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.carol = self.create_user("carol")
+        self.room = self.create_room("group", True, self.alice, [self.bob, self.carol])
+
+    async def test_removed_member_loses_sidebar_and_contacts(self):
+        cache = sidebar.get_sidebar_cache()
+        await database_sync_to_async(cache.get)(self.bob)
+        alice = await self.connect("alice")
+        bob = await self.connect("bob")
+        channel = next(iter(await presence.get_presence_registry().channels("bob")))
+        groups = get_channel_layer().groups
+        self.assertIn(channel, groups[presence.interest_group("carol")])
+
+        await alice.send_to(text_data=json.dumps({"type": "remove_member", "content": {
+            "user_to_remove": "bob", "room_id": self.room.pk
+        }}))
+        for _ in range(100):
+            if channel not in groups.get(presence.interest_group("carol"), {}):
+                break
+            await asyncio.sleep(0.01)
+        self.assertNotIn(channel, groups.get(presence.interest_group("carol"), {}))
+        self.assertNotIn(channel, groups.get(presence.interest_group("alice"), {}))
+        self.assertIsNone(await caches["sidebar"].aget(cache.key("bob"), version=cache.VERSION))
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class HistoryTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.room = self.create_room("alice-bob", False, self.alice, [self.bob])
+
+    def save_messages(self, count):
+        return Message.objects.bulk_create([
+            Message(sender=self.bob, receiver=self.alice, content="[1]", room=self.room, date_time=timezone.now(),
+                    public_key={}, iv="[2]")
+            for _ in range(count)
+        ])
+
+    def test_limit_is_clamped(self):
+        self.save_messages(3)
+        self.log_in("alice")
+        self.assertEqual(len(self.client.get("/history/?limit=0").json()["messages"]), 1)
+        self.assertEqual(len(self.client.get("/history/?limit=-5").json()["messages"]), 1)
+        with mock.patch.object(ChatHistoryView, "max_page_size", 2):
+            self.assertEqual(len(self.client.get("/history/?limit=100").json()["messages"]), 2)
+
+    def test_invalid_parameters_are_rejected(self):
+        self.log_in("alice")
+        self.assertEqual(self.client.get("/history/?limit=ten").status_code, 400)
+        self.assertEqual(self.client.get("/history/?ack=1.5").status_code, 400)
+
+    def test_ack_only_deletes_served_messages(self):
+        first, late, last = self.save_messages(3)
+        self.log_in("alice")
+        # the message saved with the middle primary key was not committed when the page was read
+        late_pk = late.pk
+        late.delete()
+        page = self.client.get("/history/").json()
+        self.assertEqual([message["id"] for message in page["messages"]], [first.pk, last.pk])
+        late.pk = late_pk
+        late.save()
+
+        self.assertEqual(self.client.get(f"/history/?ack={page['next']}").json()["messages"], [])
+        self.assertEqual(list(Message.objects.values_list("pk", flat=True)), [late.pk])
+
+    def test_ack_keeps_messages_the_client_could_not_read(self):
+        first, unreadable = self.save_messages(2)
+        self.log_in("alice")
+        page = self.client.get("/history/").json()
+        self.assertEqual(self.client.get(f"/history/?ack={page['next']}&keep={unreadable.pk}").json()["messages"], [])
+        self.assertEqual(list(Message.objects.values_list("pk", flat=True)), [unreadable.pk])
+        self.assertEqual(self.client.get("/history/?keep=one").status_code, 400)
+
+    async def test_ack_msgs_keeps_messages_the_client_could_not_read(self):
+        first, unreadable = await database_sync_to_async(self.save_messages)(2)
+        alice = await self.connect("alice", query_string=b"drain=1")
+        queued = await self.receive_frame_of_type(alice, "queued_msgs")
+
+        await alice.send_to(text_data=json.dumps({"type": "ack_msgs", "content": {
+            "ack": queued["content"]["next"], "keep": [unreadable.pk]
+        }}))
+        self.assertTrue(await alice.receive_nothing())
+        self.assertEqual([pk async for pk in Message.objects.values_list("pk", flat=True)], [unreadable.pk])
+
+        await alice.send_to(text_data=json.dumps({"type": "ack_msgs", "content": {"ack": 0, "keep": ["one"]}}))
+        self.assertEqual((await self.receive_frame_of_type(alice, "error"))["content"], "content.keep[] must be of type int")
+        await alice.disconnect()
+
+    async def test_ack_msgs_only_deletes_pushed_messages(self):
+        first, second = await database_sync_to_async(self.save_messages)(2)
+        alice = await self.connect("alice", query_string=b"drain=1")
+        await self.receive_frame(alice)
+        queued = await self.receive_frame_of_type(alice, "queued_msgs")
+        self.assertEqual(queued["content"]["next"], second.pk)
+
+        # acknowledging beyond the pushed messages does not delete messages saved since
+        unpushed, = await database_sync_to_async(self.save_messages)(1)
+        await alice.send_to(text_data=json.dumps({"type": "ack_msgs", "content": {"ack": unpushed.pk}}))
+        self.assertTrue(await alice.receive_nothing())
+        self.assertEqual([pk async for pk in Message.objects.values_list("pk", flat=True)], [unpushed.pk])
+        await alice.disconnect()
+
+        alice = await self.connect("alice", query_string=b"drain=1")
+        queued = await self.receive_frame_of_type(alice, "queued_msgs")
+        self.assertEqual([message["id"] for message in queued["content"]["messages"]], [unpushed.pk])
+        await alice.disconnect()
+
+
+class WriteBehindTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.room = self.create_room("alice-bob", False, self.alice, [self.bob])
+
+    async def test_flush_waits_for_batch_being_written(self):
+        write_behind = writebehind.get_write_behind()
+        write = write_behind._write
+        written = threading.Event()
+
+        def slow_write(batch):
+            time.sleep(0.1)
+            write(batch)
+            written.set()
+
+        with mock.patch.object(write_behind, "_write", slow_write):
+            await write_behind.enqueue([Message(sender=self.bob, receiver=self.alice, content="[1]", room=self.room,
+                                                date_time=timezone.now(), public_key={}, iv="[2]")])
+            # the writer task takes the message from the queue and starts writing it
+            while write_behind._pending:
+                await asyncio.sleep(0.001)
+            await write_behind.flush()
+            self.assertTrue(written.is_set())
+
+        consumer = ChatConsumer()
+        consumer.codec = JSONCodec()
+        consumer.outbound = OutboundQueue(mock.AsyncMock(), consumer.codec)
+        await consumer.push_queued_messages("alice")
+        self.assertEqual(len(consumer.pushed), 1)
+
+
+class CodecTests(SimpleTestCase):
+    def test_prepared_frame_is_encoded_once_per_wire_format(self):
+        event = {"type": "new_msg", **prepare_frame({"type": "new_msg", "content": [b"\x01\x02", "text"]})}
+        self.assertNotIn("text_data", event)
+        self.assertNotIn("bytes_data", event)
+
+        json_codec, msgpack_codec = JSONCodec(), MsgpackCodec()
+        encoded = encode_prepared(event, json_codec)
+        self.assertEqual(json.loads(encoded["text_data"])["content"], [[1, 2], "text"])
+        self.assertIs(encode_prepared(event, json_codec), encoded)
+        self.assertEqual(msgpack_codec.decode(**encode_prepared(event, msgpack_codec))["content"], [b"\x01\x02", "text"])
+
+    def test_text_ciphertexts_are_not_decoded_as_json(self):
+        self.assertEqual(wire_ciphertext("opaque text"), "opaque text")
+        self.assertEqual(wire_ciphertext([1, 2]), b"\x01\x02")
+        with self.assertRaises(ValueError):
+            wire_ciphertext([256])
+
+    def test_saved_ciphertexts(self):
+        msgpack_codec = MsgpackCodec()
+        self.assertEqual(msgpack_codec.saved_ciphertext("[1, 2]"), b"\x01\x02")
+        # text saved as sent by a client is sent as text
+        self.assertEqual(msgpack_codec.saved_ciphertext("opaque text"), "opaque text")
+        self.assertEqual(msgpack_codec.saved_ciphertext("12"), "12")
+        self.assertEqual(JSONCodec().saved_ciphertext("[1, 2]"), "[1, 2]")
+
+
+class WireFormatInteropTests(ChatTestCase):
+    """
+    Clients using the msgpack and JSON wire formats exchange every ciphertext shape the
+    send_msg schema accepts.
+    """
+    def setUp(self):
+        super().setUp()
+        self.alice = self.create_user("alice")
+        self.bob = self.create_user("bob")
+        self.carol = self.create_user("carol")
+        self.room = self.create_room("group", True, self.alice, [self.bob, self.carol])
+
+    async def join(self, username, subprotocols=None):
+        communicator = await self.connect(username, subprotocols)
+        await self.receive_frame(communicator)
+        frame = {"type": "join_room", "content": {"room_id": self.room.pk}}
+        if subprotocols:
+            await self.send_msgpack(communicator, frame)
+        else:
+            await communicator.send_to(text_data=json.dumps(frame))
+        while self.room.pk not in (await presence.get_presence_registry().channels(username)).values():
+            await asyncio.sleep(0.01)
+        return communicator
+
+    def send_msg(self, receiver, message, iv):
+        return {"type": "send_msg", "content": {"message": message, "room_id": self.room.pk, "receiver": receiver, "iv": iv}}
+
+    async def test_msgpack_and_json_clients_exchange_messages(self):
+        alice = await self.join("alice", ["chat.msgpack.v1"])
+        bob = await self.join("bob")
+
+        # (ciphertext sent by alice, as bob receives it) and the reverse
+        for sent, received in [(b"\x01\x02", [1, 2]), ([3, 4], [3, 4]), ("opaque", "opaque")]:
+            await self.send_msgpack(alice, self.send_msg("bob", sent, sent))
+            frame = await self.receive_frame_of_type(bob, "new_msg")
+            self.assertEqual((frame["content"][2], frame["content"][4]), (received, received))
+
+        for sent, received in [([5, 6], b"\x05\x06"), ("opaque", "opaque")]:
+            await bob.send_to(text_data=json.dumps(self.send_msg("alice", sent, sent)))
+            frame = await self.receive_frame_of_type(alice, "new_msg")
+            self.assertEqual((frame["content"][2], frame["content"][4]), (received, received))
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_saved_messages_reach_either_wire_format(self):
+        alice = await self.join("alice", ["chat.msgpack.v1"])
+        bob = await self.join("bob")
+        await self.send_msgpack(alice, self.send_msg("carol", b"\x01\x02", b"\x03"))
+        await bob.send_to(text_data=json.dumps(self.send_msg("carol", "opaque", "iv")))
+        for _ in range(100):
+            if await Message.objects.acount() == 2:
+                break
+            await writebehind.get_write_behind().flush()
+            await asyncio.sleep(0.01)
+
+        carol = await self.connect("carol", ["chat.msgpack.v1"], query_string=b"drain=1")
+        messages = (await self.receive_frame_of_type(carol, "queued_msgs"))["content"]["messages"]
+        self.assertEqual([(message["content"], message["iv"]) for message in messages], [(b"\x01\x02", b"\x03"), ("opaque", "iv")])
+        await carol.disconnect()
+
+        carol = await self.connect("carol", query_string=b"drain=1")
+        messages = (await self.receive_frame_of_type(carol, "queued_msgs"))["content"]["messages"]
+        # JSON clients receive saved ciphertexts as the JSON text of an array of byte values
+        self.assertEqual([(message["content"], message["iv"]) for message in messages], [("[1, 2]", "[3]"), ("opaque", "iv")])
+
+        await carol.disconnect()
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class OutboundQueueTests(SimpleTestCase):
+    async def test_drop_oldest_and_batching(self):
+        sent = []
+
+        async def send(**frame):
+            sent.append(json.loads(frame["text_data"]))
+
+        codec = JSONCodec()
+        queue = OutboundQueue(send, codec, max_frames=3, overflow="drop_oldest", batch_frames=2)
+        # frames are queued without yielding to the writer, so the oldest are dropped
+        for index in range(5):
+            await queue.put(codec.encode({"type": "frame", "content": index}))
+        await asyncio.sleep(0.01)
+        await queue.close()
+
+        self.assertEqual(sent, [
+            {"type": "batch", "content": [{"type": "frame", "content": 2}, {"type": "frame", "content": 3}]},
+            {"type": "frame", "content": 4},
+        ])
+
+    async def test_coalesced_frames_are_skipped_while_waiting(self):
+        sent = []
+
+        async def send(**frame):
+            sent.append(json.loads(frame["text_data"]))
+
+        codec = JSONCodec()
+        queue = OutboundQueue(send, codec, batch_frames=1, start=False)
+        for index in range(3):
+            await queue.put(codec.encode({"type": "update_members", "content": index}), coalesce_key=("room", 1))
+        await queue.put(codec.encode({"type": "update_members", "content": 3}), coalesce_key=("room", 2))
+        await asyncio.sleep(0.01)
+        # nothing is sent until the queue is started
+        self.assertEqual(sent, [])
+
+        queue.start()
+        await asyncio.sleep(0.01)
+        # a frame with the key can be queued again once the waiting one was sent
+        await queue.put(codec.encode({"type": "update_members", "content": 4}), coalesce_key=("room", 1))
+        await asyncio.sleep(0.01)
+        await queue.close()
+        self.assertEqual([frame["content"] for frame in sent], [0, 3, 4])
+
+    async def test_overflow_disconnects(self):
+        on_overflow = mock.AsyncMock()
+        codec = JSONCodec()
+        queue = OutboundQueue(mock.AsyncMock(), codec, on_overflow, max_frames=2, start=False)
+        with self.assertLogs("chat.outbound", "WARNING"):
+            for index in range(3):
+                await queue.put(codec.encode({"type": "frame", "content": index}))
+
+        on_overflow.assert_awaited_once()
+        self.assertTrue(queue.closed)
+        self.assertEqual(queue.depth, 0)
+
+    async def test_send_failure_closes_the_connection(self):
+        on_failure = mock.AsyncMock()
+        codec = JSONCodec()
+        queue = OutboundQueue(mock.AsyncMock(side_effect=RuntimeError("connection reset")), codec,
+                              on_failure=on_failure)
+        with self.assertLogs("chat.outbound", "ERROR"):
+            await queue.put(codec.encode({"type": "frame", "content": 0}))
+            await asyncio.sleep(0.01)
+
+        on_failure.assert_awaited_once()
+        self.assertTrue(queue.closed)
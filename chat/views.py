@@ -1,13 +1,15 @@
+from asgiref.sync import async_to_sync
 from django.shortcuts import render
 from django.http import Http404, HttpResponseForbidden, JsonResponse, HttpResponseRedirect
 from django.views import View
-from django.core import serializers
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .models import AccountUser, FriendRequest, ChatRoom, Message
-from django.db.models import Q
+from .models import AccountUser, ChatRoom
+from .history import delete_acknowledged_messages, get_queued_messages
+from .membership import get_membership_index
+from .presence import send_to_user
+from .sidebar import get_sidebar_cache
 from users.serialiser import UserSerialiser
-import json
 
 
 class Friends(View):
@@ -34,63 +36,13 @@ class Friends(View):
         # serialise the user object into JSON to be able to pass it to the template
         user_obj_data = UserSerialiser(user_obj)
 
-        received_requests = FriendRequest.objects.filter(receiver=user_obj)
-
-        received_requests_list = []
-        # convert the received friend request database objects into a list of dictionaries
-        for received in received_requests:
-            room = received.room
-            received_requests_list.append({
-                "id": received.pk, 
-                "sender": received.sender, 
-                "receiver": received.receiver, 
-                "room_id": room.pk,
-                "room_name": room.name,
-                "room_type": received.chat_type,
-                "status": received.status
-            })
-
-        sent_requests = FriendRequest.objects.filter(sender=user_obj).order_by('-pk')
-
-        sent_requests_list = []
-        # convert the sent friend request database objects into a list of dictionaries
-        for sent in sent_requests:
-            room = sent.room
-            sent_requests_list.append({
-                "id": sent.pk, 
-                "sender": sent.sender, 
-                "receiver": sent.receiver, 
-                "room_id": room.pk,
-                "room_name": room.name,
-                "room_type": sent.chat_type,
-                "status": sent.status
-            })
-
-        rooms = ChatRoom.objects.filter(Q(members=user_obj) & Q(type=False))
-        
-        friend_rooms = []
-        # convert all direct message chat rooms into a list of dictionaries
-        for room in rooms:
-            # display only rooms with more than one member (the only member of a chat room would be its creator)
-            if room.members.count() > 1:
-                room_members = room.members.all()
-                # if the user is the first member of the room, display the second member's username
-                if room_members[0].username == user:
-                    friend = AccountUser.objects.get(username=room_members[1])
-                    friend_rooms.append({"username": room_members[1], "room_id": room.id, "about": friend.about})
-                else:
-                    friend = AccountUser.objects.get(username=room_members[0])
-                    friend_rooms.append({"username": room_members[0], "room_id": room.id, "about": friend.about})
-
-        # serialise the group chat rooms into JSON to be able to pass it to the template
-        group_chats = ChatRoom.objects.filter(Q(members=user_obj) & Q(type=True))
-        group_chat_data = json.loads(serializers.serialize('json', group_chats))
+        sidebar = get_sidebar_cache().get(user_obj)
 
         context = {
-            "received_requests": received_requests_list,
-            "sent_requests": sent_requests_list,
-            "group_chats": group_chat_data,
-            "friends": friend_rooms,
+            "received_requests": sidebar["received_requests"],
+            "sent_requests": sidebar["sent_requests"],
+            "group_chats": sidebar["group_chats"],
+            "friends": sidebar["friends"],
             "user": user_obj_data.data,
         }
 
@@ -125,32 +77,14 @@ class ChatView(View):
         user = request.session.get("username")
 
         user_obj = AccountUser.objects.get(username=user) 
-        rooms = ChatRoom.objects.filter(Q(members=user_obj) & Q(type=False))
-        
-        friend_rooms = []
-        # convert all direct message chat rooms into a list of dictionaries
-        for room in rooms:
-            # display only rooms with more than one member (the only member of a chat room would be its creator)
-            if room.members.count() > 1:
-                room_members = room.members.all()
-                # if the user is the first member of the room, display the second member's username
-                if room_members[0].username == user:
-                    friend = AccountUser.objects.get(username=room_members[1])
-                    friend_rooms.append({"username": room_members[1], "room_id": room.id, "about": friend.about})
-                else:
-                    friend = AccountUser.objects.get(username=room_members[0])
-                    friend_rooms.append({"username": room_members[0], "room_id": room.id, "about": friend.about})
-
-        group_chats = ChatRoom.objects.filter(Q(members=user_obj) & Q(type=True))
-        # serialise the group chat rooms into JSON to be able to pass it to the template
-        group_chat_data = json.loads(serializers.serialize('json', group_chats))
-
-        room = ChatRoom.objects.get(pk=room_id)
-
-        if user_obj in room.members.all():
+        sidebar = get_sidebar_cache().get(user_obj)
+
+        room = ChatRoom.objects.select_related("owner").get(pk=room_id)
+
+        if get_membership_index().is_member(room.pk, user):
             context = {
-                "group_chats": group_chat_data,
-                "friends": friend_rooms,
+                "group_chats": sidebar["group_chats"],
+                "friends": sidebar["friends"],
                 "room_id": room_id,
                 "username": user,
                 "room_owner": room.owner.username,
@@ -162,38 +96,49 @@ class ChatView(View):
         return HttpResponseForbidden()
    
 class ChatHistoryView(View):
+    page_size = 100
+    max_page_size = 500
+
     def get(self, request):
         """
         Get request method handler for the ChatHistory view.
 
-        Intended for clients who are logged in and want to retrieve the chat history of all chat rooms
-        the user is part of.
+        Intended for clients who are logged in and want to retrieve the messages sent to them
+        while they were offline, one page at a time in the order they were received.
+
+        Messages are only deleted from the server once the client acknowledges them, by passing
+        the "next" cursor of the last page it saved as the "ack" query parameter of its next
+        request. Only the messages of the last page served to the session are deleted, except
+        those listed in the comma separated "keep" query parameter, which the client could not
+        decrypt or save. The "after" query parameter, which defaults to "ack", is the cursor
+        after which the returned page starts, and "limit" sets the size of the page, between 1
+        and max_page_size.
 
         args:
             request: HttpRequest object containing the get request
 
         returns:
-            JsonResponse: object containing the chat history of all chat rooms the user is part of
+            JsonResponse: object containing a page of messages sent to the user and the cursor of
+            the last message in the page, which is null when there are no more messages
         """
         if "username" in request.session:
-            user = AccountUser.objects.get(username=request.session.get("username"))
-            history = Message.objects.filter(receiver=user).order_by('pk')
-            
-            messages = []
-            for message in history:
-                msg = {
-                    "sender": message.sender.username, 
-                    "content": message.content, 
-                    "room_id": message.room.pk, 
-                    "date_time": message.date_time,
-                    "public_key": message.public_key,
-                    "iv": message.iv
-                }
-                messages.append(msg)
-
-            history.delete()
-
-            return JsonResponse({"messages": messages})
+            username = request.session.get("username")
+
+            try:
+                ack = int(request.GET.get("ack", 0))
+                after = int(request.GET.get("after", ack))
+                limit = int(request.GET.get("limit", self.page_size))
+                kept = [int(pk) for pk in request.GET.get("keep", "").split(",") if pk]
+            except ValueError:
+                return JsonResponse({"message": "ack, after, limit and keep must be integers"}, status=400)
+            limit = max(1, min(limit, self.max_page_size))
+
+            # delete the messages of the last page the client has acknowledged saving
+            delete_acknowledged_messages(username, request.session.get("history_page", []), ack, kept)
+            messages = get_queued_messages(username, after, limit)
+            request.session["history_page"] = [message["id"] for message in messages]
+
+            return JsonResponse({"messages": messages, "next": messages[-1]["id"] if messages else None})
         
         return HttpResponseForbidden()
 
@@ -218,11 +163,11 @@ class RoomMembersView(APIView):
             except ValueError:
                 raise Http404
     
-            room = ChatRoom.objects.get(id=room_id)
+            members = get_membership_index().members(room_id)
             
             room_members_data = []
             # convert all members of the chat room into a list of dictionaries
-            for member in room.members.all():
+            for member in AccountUser.objects.filter(username__in=members):
                 room_members_data.append({
                     "username": member.username,
                     "first_name": member.first_name,
@@ -254,6 +199,8 @@ class SavePublicKeyView(APIView):
             user = AccountUser.objects.get(username=request.session.get("username"))
             user.public_key = public_key;
             user.save()
+            # open socket connections of the user cached the previous public key
+            async_to_sync(send_to_user)(user.username, {"type": "context_invalidate"})
             return Response({"message": "Public key saved successfully"}, status=200)
         
         return Response({"message": "Permission Denied"}, status=403)
@@ -0,0 +1,202 @@
+import asyncio
+import atexit
+import logging
+import time
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_write_behind = None
+
+
+class WriteBehindFull(Exception):
+    """
+    Raised when a message could not be queued because the queue stayed full for longer
+    than the enqueue timeout.
+    """
+
+
+class MessageWriteBehind:
+    """
+    Per-process queue of offline messages which are saved to the database in batches.
+
+    Rather than each offline message being inserted in its own transaction, messages are
+    queued and written with a single bulk_create once batch_size messages are queued or
+    max_delay seconds after the first message of the batch was queued, whichever comes
+    first. Producers wait for space while max_pending messages are queued, and give up
+    with WriteBehindFull after enqueue_timeout seconds. Messages still queued when the
+    process exits are written by flush_sync(), which is called at exit for the queue of
+    the process.
+    """
+    def __init__(self, batch_size=100, max_delay=0.005, max_pending=10000, enqueue_timeout=1.0):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.enqueue_timeout = enqueue_timeout
+
+        self._pending = []
+        self._writer = None
+        self._wakeup = None
+        self._space = None
+        # batches taken from the queue which are still being written, and set when there are none
+        self._in_flight = 0
+        self._idle = None
+
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_batch = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+
+    def _start(self):
+        # the writer task and its events belong to the event loop of the first producer
+        if self._writer is None or self._writer.done():
+            self._wakeup = asyncio.Event()
+            self._space = asyncio.Condition()
+            self._idle = asyncio.Event()
+            self._idle.set()
+            self._writer = asyncio.get_running_loop().create_task(self._run())
+
+    async def enqueue(self, messages):
+        """
+        Queue unsaved messages to be written to the database in the next batch.
+
+        args:
+            messages (list): the unsaved Message objects to write
+
+        raises:
+            WriteBehindFull: if the queue did not have space within the enqueue timeout
+        """
+        self._start()
+
+        if len(self._pending) >= self.max_pending:
+            try:
+                async with self._space:
+                    await asyncio.wait_for(
+                        self._space.wait_for(lambda: len(self._pending) < self.max_pending),
+                        self.enqueue_timeout
+                    )
+            except asyncio.TimeoutError:
+                self.rejected += len(messages)
+                raise WriteBehindFull(f"{len(self._pending)} messages are waiting to be written")
+
+        self._pending.extend(messages)
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            # give other messages a chance to join the batch unless it is already full
+            if len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.max_delay)
+
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write every queued message to the database, returning once the batches already
+        taken from the queue by another flush have also been written.
+        """
+        while self._pending or self._in_flight:
+            if not self._pending:
+                await self._idle.wait()
+                continue
+
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+
+            self._in_flight += 1
+            self._idle.clear()
+            try:
+                await database_sync_to_async(self._write)(batch)
+            finally:
+                self._in_flight -= 1
+                if not self._in_flight:
+                    self._idle.set()
+
+            async with self._space:
+                self._space.notify_all()
+
+    def flush_sync(self):
+        """
+        Write every queued message to the database without an event loop, used when the
+        process is shutting down.
+        """
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            self._write(batch)
+
+    def _write(self, batch):
+        from .models import Message
+
+        start = time.perf_counter()
+        try:
+            Message.objects.bulk_create(batch)
+        except Exception:
+            # save the messages one by one so that one bad row does not lose the whole batch
+            logger.exception("bulk write of %d messages failed, writing individually", len(batch))
+            for message in batch:
+                try:
+                    message.save()
+                except Exception:
+                    self.failed += 1
+                    logger.exception("dropping message for %s which could not be written", message.receiver_id)
+        elapsed = time.perf_counter() - start
+
+        self.batches += 1
+        self.written += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.total_flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+
+    def stats(self):
+        """
+        Retrieve the queue depth, batch size and flush latency metrics of this process.
+
+        returns:
+            dict: the metrics of the write-behind queue
+        """
+        return {
+            "pending": len(self._pending),
+            "in_flight": self._in_flight,
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "max_batch_size": self.max_batch,
+            "mean_batch_size": self.written / self.batches if self.batches else 0.0,
+            "mean_flush_ms": self.total_flush_time * 1000 / self.batches if self.batches else 0.0,
+            "max_flush_ms": self.max_flush_time * 1000
+        }
+
+
+def flush_at_exit():
+    """
+    Write the messages still queued in the write-behind queue of this process when it
+    exits.
+    """
+    if _write_behind is not None:
+        _write_behind.flush_sync()
+
+
+atexit.register(flush_at_exit)
+
+
+def get_write_behind():
+    """
+    Retrieve the write-behind queue of this process, configured by the CHAT_WRITE_BEHIND
+    setting.
+
+    returns:
+        MessageWriteBehind: the write-behind queue
+    """
+    global _write_behind
+    if _write_behind is None:
+        _write_behind = MessageWriteBehind(**getattr(settings, "CHAT_WRITE_BEHIND", {}))
+    return _write_behind
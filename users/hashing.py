@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth import hashers
+
+DEFAULT_PASSWORD_HASHING = {
+    "workers": 2,
+    "max_pending": 16,
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class HashingPoolFull(Exception):
+    """
+    Raised when a password could not be hashed because the hashing pool already has as
+    many passwords waiting as it allows, so that the request can be rejected at once.
+    """
+
+
+class PasswordHashingPool:
+    """
+    Bounded pool of threads dedicated to hashing and checking passwords.
+
+    Hashing a password runs hundreds of thousands of PBKDF2 iterations. Hashed by the
+    views themselves, a burst of logins hashes as many passwords at once as there are
+    requests, as Django runs every request served over ASGI on a thread of its own, and
+    leaves no CPU time for socket consumers delivering messages. The pool hashes at most
+    workers passwords at once, as hashlib releases the GIL while it hashes, and lets
+    max_pending further passwords wait for a worker. Passwords arriving once the pool is
+    full are rejected with HashingPoolFull rather than queued.
+
+    The methods are awaited by async views, which hold no thread, and so no database
+    connection, while their password waits for a worker and is hashed.
+    """
+    def __init__(self, workers=2, max_pending=16):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hashing")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_in_flight = 0
+        self.total_wait = 0.0
+        self.total_hash_time = 0.0
+
+    def _submit(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashingPoolFull(f"{self.workers + self.max_pending} passwords are being hashed")
+
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                with self._lock:
+                    self.total_wait += started - submitted
+                    self.total_hash_time += time.perf_counter() - started
+
+        def done(future):
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+            self._slots.release()
+
+        # the slot is released when the hash is done, even if its caller stopped waiting
+        future = self._executor.submit(timed)
+        future.add_done_callback(done)
+        return future
+
+    async def arun(self, function, *args):
+        """
+        Call a hashing function on a worker of the pool and await its result.
+
+        Args:
+            function (function): the hashing function to call
+            *args: the arguments of the function
+
+        Returns:
+            the result of the function
+
+        Raises:
+            HashingPoolFull: if the pool has no space for another password
+        """
+        return await asyncio.wrap_future(self._submit(function, *args))
+
+    async def acheck_password(self, user, raw_password):
+        """
+        Check a password against the password of a user on the pool, rehashing the
+        password as AbstractBaseUser.check_password() does when the hasher settings have
+        changed since it was saved. The rehash is left to a later login when the pool is
+        full, rather than failing a login whose password was correct.
+
+        Args:
+            user (AccountUser): the user whose password is checked
+            raw_password (str): the password provided by the client
+
+        Returns:
+            bool: True if the password is correct
+
+        Raises:
+            HashingPoolFull: if the pool has no space to check the password
+        """
+        # the setter is only recorded on the pool, so the database is not written from its threads
+        outdated = []
+        valid = await self.arun(hashers.check_password, raw_password, user.password, outdated.append)
+
+        if outdated:
+            try:
+                user.password = await self.amake_password(raw_password)
+            except HashingPoolFull:
+                return valid
+            user._password = raw_password
+            await user.asave(update_fields=["password"])
+        return valid
+
+    async def amake_password(self, raw_password):
+        """
+        Hash a password on the pool for it to be saved as the password of a user.
+
+        Args:
+            raw_password (str): the password to hash
+
+        Returns:
+            str: the hashed password
+
+        Raises:
+            HashingPoolFull: if the pool has no space for the password
+        """
+        return await self.arun(hashers.make_password, raw_password)
+
+    def stats(self):
+        """
+        Retrieve the number of passwords being hashed or waiting, the number hashed and
+        rejected, and the mean time passwords waited for a worker and took to hash.
+
+        Returns:
+            dict: the metrics of the hashing pool
+        """
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "mean_wait_ms": self.total_wait * 1000 / self.completed if self.completed else 0.0,
+                "mean_hash_ms": self.total_hash_time * 1000 / self.completed if self.completed else 0.0
+            }
+
+
+def get_hashing_pool():
+    """
+    Retrieve the password hashing pool of this process, configured by the
+    PASSWORD_HASHING setting.
+
+    Returns:
+        PasswordHashingPool: the password hashing pool
+    """
+    global _pool
+    # views run on many threads at once, which must not each create a pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PasswordHashingPool(**getattr(settings, "PASSWORD_HASHING", DEFAULT_PASSWORD_HASHING))
+    return _pool
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import statistics
+import time
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import HttpCommunicator
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import ChatRoom, Message, RoomMember
+from chat.sockets import ChatConsumer
+from EncryptedChatApp.asgi import application
+from users import hashing
+from users.models import AccountUser
+
+PASSWORD = "Bench-password-1"
+
+
+class RequestThreadHashing(hashing.PasswordHashingPool):
+    """
+    Hashing "pool" which hashes each password on the thread of its request, as a sync
+    login view hashing the password itself does, with no bound on how many passwords are
+    hashed at once and no request ever rejected.
+    """
+    async def arun(self, function, *args):
+        # within a request, thread sensitive code runs on the thread of that request
+        return await sync_to_async(function)(*args)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure login throughput while many clients log in at once through the ASGI "
+        "application, and the latency of the database write of a send_msg frame for an "
+        "offline receiver made at the same time, with passwords hashed on the thread of "
+        "each request and on the bounded password hashing pool"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=16, help="number of clients logging in at once")
+        parser.add_argument("--duration", type=float, default=10.0, help="seconds each mode is run for")
+        parser.add_argument("--interval", type=float, default=0.01, help="seconds between send_msg writes")
+
+    def handle(self, *args, **options):
+        user = AccountUser(username="bench-login-user", first_name="bench", last_name="user")
+        user.set_password(PASSWORD)
+        user.save()
+        friend = AccountUser.objects.create(username="bench-login-friend", first_name="bench", last_name="friend")
+        room = ChatRoom.objects.create(name="bench-login-room", type=False, owner=user)
+        RoomMember.objects.bulk_create([RoomMember(chat_room=room, user=user), RoomMember(chat_room=room, user=friend)])
+
+        configured = hashing.get_hashing_pool()
+        modes = {
+            "no logins": None,
+            "request threads": RequestThreadHashing(workers=configured.workers, max_pending=configured.max_pending),
+            "hashing pool": configured,
+        }
+
+        try:
+            self.stdout.write(f"{'mode':<16} {'logins/s':>9} {'rejected':>9} {'send_msg p50 ms':>16} {'send_msg p99 ms':>16}")
+            for name, pool in modes.items():
+                hashing._pool = pool
+                clients = options["clients"] if pool is not None else 0
+                logins, rejected, latencies = async_to_sync(self.run)(room, clients, options["duration"], options["interval"])
+                self.stdout.write(
+                    f"{name:<16} {logins / options['duration']:>9.1f} {rejected:>9} "
+                    f"{self.percentile(latencies, 50):>16.2f} {self.percentile(latencies, 99):>16.2f}"
+                )
+        finally:
+            hashing._pool = configured
+            # deleting the users cascades to the chat room, its members and the messages
+            AccountUser.objects.filter(username__in=[user.username, friend.username]).delete()
+
+    async def run(self, room, clients, duration, interval):
+        """
+        Log clients in repeatedly through the ASGI application for a duration while timing
+        send_msg writes on the same event loop.
+
+        args:
+            room (ChatRoom): the chat room the send_msg writes are made in
+            clients (int): the number of clients logging in at once
+            duration (float): the seconds to run for
+            interval (float): the seconds between send_msg writes
+
+        returns:
+            tuple: the number of successful and rejected logins, and the send_msg write latencies
+        """
+        counts = {200: 0, 429: 0}
+        end = time.perf_counter() + duration
+        body = json.dumps({"username": "bench-login-user", "password": PASSWORD}).encode()
+
+        async def login():
+            while time.perf_counter() < end:
+                communicator = HttpCommunicator(application, "POST", "/auth/login/", body=body, headers=[
+                    (b"host", b"localhost"),
+                    (b"content-type", b"application/json"),
+                ])
+                response = await communicator.get_response(timeout=60)
+                counts[response["status"]] = counts.get(response["status"], 0) + 1
+
+        results = await asyncio.gather(
+            self.send_messages(room, end, interval),
+            *(login() for _ in range(clients))
+        )
+        return counts[200], counts[429], results[0]
+
+    async def send_messages(self, room, end, interval):
+        """
+        Save messages to an offline receiver as the send_msg handler does, timing each write.
+
+        returns:
+            list: the latency in milliseconds of each write
+        """
+        consumer = ChatConsumer()
+        latencies = []
+        while time.perf_counter() < end:
+            message = Message(sender_id="bench-login-user", receiver_id="bench-login-friend", content="[0]",
+                              room_id=room.pk, date_time=timezone.now(), iv="[0]", public_key={})
+            start = time.perf_counter()
+            await consumer.create_messages([message])
+            latencies.append((time.perf_counter() - start) * 1000)
+            await asyncio.sleep(interval)
+        return latencies
+
+    def percentile(self, values, percent):
+        if len(values) < 2:
+            return values[0]
+        return statistics.quantiles(values, n=100)[percent - 1]
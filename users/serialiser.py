@@ -42,20 +42,21 @@ class UserSerialiser(serializers.ModelSerializer):
 
     def create(self, validated_data):
         """
-        Create a new user instance in the database with the validated data, but
-        first hashes the password before saving it in the user object on the database.
+        Create a new user instance in the database with the validated data. The password
+        is not hashed here, as the view hashes it on the password hashing pool beforehand
+        without blocking a thread, and passes the hash to save() as password_hash.
 
         Args:
-            validated_data (dict): The validated data from the request.
+            validated_data (dict): The validated data from the request, along with the
+            password_hash passed to save().
 
         Returns:
             AccountUser: The user object that was created.
         """
-        password = validated_data.pop('password', None)
+        validated_data.pop('password', None)
+        password_hash = validated_data.pop('password_hash')
         instance = self.Meta.model(**validated_data)
-
-        if password is not None:
-            instance.set_password(password)
+        instance.password = password_hash
 
         instance.save()
 
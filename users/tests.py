@@ -0,0 +1,248 @@
+import asyncio
+import threading
+from unittest import mock
+from django.contrib.auth import hashers
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import caches
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from users import hashing, throttle
+from users.hashing import HashingPoolFull, PasswordHashingPool
+from users.models import AccountUser
+from users.throttle import LoginThrottle
+
+PASSWORD = "Test-password-1"
+
+# a fast hasher and caches held in the memory of the test process, so that the tests need no Redis server
+LOCAL_SETTINGS = {
+    "PASSWORD_HASHERS": ["django.contrib.auth.hashers.MD5PasswordHasher"],
+    "PASSWORD_HASHING": {"workers": 1, "max_pending": 1},
+    "LOGIN_THROTTLE": {"cache": "throttle", "user_attempts": 2, "ip_attempts": 4, "base_lockout": 10,
+                       "max_lockout": 40, "window": 3600, "verified_ttl": 300},
+    "CACHES": {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "throttle": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "throttle"},
+    },
+}
+
+
+def fill(pool):
+    """
+    Fill every slot of a hashing pool with a task which waits for the returned event.
+    """
+    release = threading.Event()
+    futures = [pool._submit(release.wait) for _ in range(pool.workers + pool.max_pending)]
+    return release, futures
+
+
+class PasswordHashingPoolTests(SimpleTestCase):
+    async def test_full_pool_rejects_until_a_slot_is_released(self):
+        pool = PasswordHashingPool(workers=1, max_pending=1)
+        release, futures = fill(pool)
+
+        with self.assertRaises(HashingPoolFull):
+            await pool.amake_password(PASSWORD)
+        self.assertEqual(pool.stats()["rejected"], 1)
+        self.assertEqual(pool.stats()["in_flight"], 2)
+
+        release.set()
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        # the done callbacks release the slots once the futures completed
+        await asyncio.sleep(0.01)
+
+        self.assertTrue(hashers.check_password(PASSWORD, await pool.amake_password(PASSWORD)))
+        stats = pool.stats()
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["max_in_flight"], 2)
+        self.assertEqual(stats["completed"], 3)
+
+    async def test_hashing_does_not_block_the_event_loop(self):
+        pool = PasswordHashingPool(workers=1, max_pending=1)
+        release = threading.Event()
+        waiting = asyncio.ensure_future(pool.arun(release.wait))
+
+        # the loop keeps running while the worker is blocked
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        release.set()
+        self.assertTrue(await waiting)
+
+
+@override_settings(**LOCAL_SETTINGS)
+class LoginThrottleTests(SimpleTestCase):
+    def setUp(self):
+        caches["throttle"].clear()
+        self.throttle = LoginThrottle(cache="throttle", user_attempts=2, ip_attempts=3, base_lockout=10,
+                                      max_lockout=40)
+
+    def test_username_is_locked_out_from_any_address(self):
+        self.throttle.failed("alice", "10.0.0.1")
+        self.throttle.failed("alice", "10.0.0.2")
+        self.assertEqual(self.throttle.locked_for("alice", "10.0.0.3"), 0)
+
+        self.throttle.failed("alice", "10.0.0.3")
+
+        self.assertAlmostEqual(self.throttle.locked_for("alice", "10.0.0.4"), 10, delta=1)
+        self.assertEqual(self.throttle.locked_for("bob", "10.0.0.4"), 0)
+
+    def test_address_is_locked_out_for_any_username(self):
+        for username in ["alice", "bob", "carol", "dave"]:
+            self.throttle.failed(username, "10.0.0.1")
+
+        self.assertAlmostEqual(self.throttle.locked_for("erin", "10.0.0.1"), 10, delta=1)
+        self.assertEqual(self.throttle.locked_for("erin", "10.0.0.2"), 0)
+
+    def test_lockout_doubles_up_to_the_maximum(self):
+        lockouts = []
+        with mock.patch("users.throttle.time.time", return_value=1000.0):
+            for _ in range(6):
+                self.throttle.failed("alice", "10.0.0.1")
+                lockouts.append(self.throttle.locked_for("alice", "10.0.0.1"))
+
+        self.assertEqual(lockouts, [0, 0, 10, 20, 40, 40])
+
+    def test_success_clears_the_username_but_not_the_address(self):
+        for _ in range(4):
+            self.throttle.failed("alice", "10.0.0.1")
+        self.throttle.succeeded("alice")
+
+        self.assertEqual(self.throttle.locked_for("alice", "10.0.0.2"), 0)
+        self.assertGreater(self.throttle.locked_for("alice", "10.0.0.1"), 0)
+
+    def test_verified_marker_is_opaque_single_use_and_bound_to_the_password(self):
+        user = AccountUser(username="alice", password=hashers.make_password(PASSWORD))
+        session = SessionStore()
+
+        self.throttle.mark_verified(session, user)
+        # nothing derived from the password is stored in the session
+        self.assertNotIn(PASSWORD, str(session["password_verified"]))
+        self.assertTrue(self.throttle.recently_verified(session, user))
+        self.assertFalse(self.throttle.recently_verified(session, user))
+
+        self.throttle.mark_verified(session, user)
+        user.password = hashers.make_password("Other-password-1")
+        self.assertFalse(self.throttle.recently_verified(session, user))
+
+        self.throttle.mark_verified(session, user)
+        with mock.patch("users.throttle.time.time", return_value=session["password_verified"]["expires"] + 1):
+            self.assertFalse(self.throttle.recently_verified(session, user))
+
+
+@override_settings(**LOCAL_SETTINGS)
+class UsersTestCase(TransactionTestCase):
+    """
+    Base test case of the users app, which recreates the hashing pool and login throttle
+    of the process from the local settings before each test.
+    """
+    def setUp(self):
+        hashing._pool = None
+        throttle._throttle = None
+        caches["throttle"].clear()
+        self.user = AccountUser(username="alice", first_name="alice", last_name="test")
+        self.user.set_password(PASSWORD)
+        self.user.save()
+
+    def tearDown(self):
+        hashing._pool = None
+        throttle._throttle = None
+
+    async def login(self, password=PASSWORD, username="alice", **extra):
+        return await self.async_client.post("/auth/login/", {"username": username, "password": password},
+                                            content_type="application/json", **extra)
+
+    async def verify(self, password=PASSWORD):
+        return await self.async_client.post("/auth/verify_password/", {"password": password},
+                                            content_type="application/json")
+
+
+class RegisterViewTests(UsersTestCase):
+    async def test_register_saves_the_hashed_password(self):
+        response = await self.async_client.post("/auth/register/", {
+            "username": "bob", "first_name": "bob", "last_name": "test", "password": PASSWORD
+        }, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        user = await AccountUser.objects.aget(username="bob")
+        self.assertTrue(user.check_password(PASSWORD))
+        self.assertNotEqual(user.password, PASSWORD)
+
+    async def test_invalid_registration_hashes_nothing(self):
+        response = await self.async_client.post("/auth/register/", {
+            "username": "bob", "first_name": "bob", "last_name": "test", "password": "short"
+        }, content_type="application/json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(hashing.get_hashing_pool().stats()["completed"], 0)
+        self.assertFalse(await AccountUser.objects.filter(username="bob").aexists())
+
+    async def test_full_pool_is_answered_with_retry_after(self):
+        release, futures = fill(hashing.get_hashing_pool())
+        try:
+            response = await self.async_client.post("/auth/register/", {
+                "username": "bob", "first_name": "bob", "last_name": "test", "password": PASSWORD
+            }, content_type="application/json")
+        finally:
+            release.set()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertFalse(await AccountUser.objects.filter(username="bob").aexists())
+
+
+class LoginViewTests(UsersTestCase):
+    async def test_login_with_correct_password(self):
+        response = await self.login()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["message"], "/friends/")
+        self.assertEqual(hashing.get_hashing_pool().stats()["completed"], 1)
+
+    async def test_login_with_wrong_password_or_username(self):
+        self.assertEqual((await self.login("Wrong-password-1")).status_code, 403)
+        self.assertEqual((await self.login(username="nobody")).status_code, 403)
+
+    async def test_full_pool_is_answered_with_retry_after(self):
+        release, futures = fill(hashing.get_hashing_pool())
+        try:
+            response = await self.login()
+        finally:
+            release.set()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+
+    async def test_lockout_is_answered_with_retry_after_without_hashing(self):
+        for _ in range(3):
+            await self.login("Wrong-password-1")
+        completed = hashing.get_hashing_pool().stats()["completed"]
+
+        response = await self.login()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "10")
+        # the correct password was refused before it was hashed
+        self.assertEqual(hashing.get_hashing_pool().stats()["completed"], completed)
+
+
+class VerifyPasswordTests(UsersTestCase):
+    async def test_verify_requires_a_session(self):
+        self.assertEqual((await self.verify()).status_code, 403)
+
+    async def test_recently_verified_password_is_not_hashed_again(self):
+        await self.login()
+        completed = hashing.get_hashing_pool().stats()["completed"]
+
+        response = await self.verify()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(hashing.get_hashing_pool().stats()["completed"], completed)
+
+    async def test_wrong_password_is_hashed_and_refused(self):
+        await self.login()
+        # uses up the marker left by the login
+        await self.verify()
+        completed = hashing.get_hashing_pool().stats()["completed"]
+
+        response = await self.verify("Wrong-password-1")
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(hashing.get_hashing_pool().stats()["completed"], completed + 1)
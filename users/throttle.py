@@ -0,0 +1,154 @@
+import secrets
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+DEFAULT_LOGIN_THROTTLE = {
+    "cache": "default",
+}
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+class LoginThrottle:
+    """
+    Tracks failed password attempts per username and per client IP address, locking out
+    further attempts before any password is hashed.
+
+    Each username may fail user_attempts times, and each IP address ip_attempts times,
+    within window seconds of its first failure. Every failure past the allowance locks
+    the username or IP address out for base_lockout seconds, doubling with each further
+    failure up to max_lockout seconds. A successful attempt clears the failures of the
+    username, but not those of the IP address, so that an attacker cannot reset their
+    allowance by logging in to an account of their own.
+
+    The attempts are stored in a Django cache, which is shared by every worker process
+    when it is a Redis cache.
+
+    Sessions which have just verified a password are also marked, so that the password
+    can be verified once more within verified_ttl seconds without being hashed.
+    """
+    def __init__(self, cache="default", user_attempts=5, ip_attempts=20, base_lockout=1, max_lockout=900,
+                 window=3600, verified_ttl=300):
+        self.cache_alias = cache
+        self.user_attempts = user_attempts
+        self.ip_attempts = ip_attempts
+        self.base_lockout = base_lockout
+        self.max_lockout = max_lockout
+        self.window = window
+        self.verified_ttl = verified_ttl
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _subjects(self, username, ip):
+        return [(f"login:user:{username}", self.user_attempts), (f"login:ip:{ip}", self.ip_attempts)]
+
+    def locked_for(self, username, ip):
+        """
+        Check whether attempts for a username or from an IP address are locked out.
+
+        Args:
+            username (str): the username the attempt is made for
+            ip (str): the IP address of the client making the attempt
+
+        Returns:
+            float: the seconds until the lockout ends, or 0 if attempts are allowed
+        """
+        lock_keys = [f"{key}:locked" for key, _ in self._subjects(username, ip)]
+        locked_until = self.cache.get_many(lock_keys).values()
+        return max([until - time.time() for until in locked_until] + [0])
+
+    def failed(self, username, ip):
+        """
+        Record a failed attempt for a username from an IP address, locking either out once
+        it has failed more times than it is allowed.
+
+        Args:
+            username (str): the username the attempt was made for
+            ip (str): the IP address of the client which made the attempt
+        """
+        for key, allowed in self._subjects(username, ip):
+            failures = self._increment(f"{key}:failures")
+            if failures > allowed:
+                lockout = min(self.max_lockout, self.base_lockout * 2 ** (failures - allowed - 1))
+                self.cache.set(f"{key}:locked", time.time() + lockout, lockout)
+
+    def succeeded(self, username):
+        """
+        Clear the failed attempts of a username after its password was provided.
+
+        Args:
+            username (str): the username the attempt was made for
+        """
+        self.cache.delete_many([f"login:user:{username}:failures", f"login:user:{username}:locked"])
+
+    def _increment(self, key):
+        # add() only sets the key when it is missing, so the window starts at the first failure
+        self.cache.add(key, 0, self.window)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # the key expired between add() and incr()
+            self.cache.set(key, 1, self.window)
+            return 1
+
+    def mark_verified(self, session, user):
+        """
+        Mark a session as having verified the password of its user. The marker is a random
+        nonce along with a keyed digest binding it to the password hash of the user, so
+        nothing derived from the password itself is stored in the session, and the marker
+        no longer matches once the password of the user changes.
+
+        Args:
+            session (SessionBase): the session of the client
+            user (AccountUser): the user whose password was verified
+        """
+        nonce = secrets.token_hex(16)
+        session["password_verified"] = {
+            "nonce": nonce,
+            "binding": self._binding(user, nonce),
+            "expires": time.time() + self.verified_ttl
+        }
+
+    def recently_verified(self, session, user):
+        """
+        Check whether a session verified the password of its user within verified_ttl
+        seconds, so that the password does not have to be hashed again. The marker is
+        used up by the check, so a verification spares a single further hash.
+
+        Args:
+            session (SessionBase): the session of the client
+            user (AccountUser): the user whose password is being verified
+
+        Returns:
+            bool: True if the session recently verified the current password of the user
+        """
+        marker = session.pop("password_verified", None)
+        if not marker or marker["expires"] < time.time():
+            return False
+        return constant_time_compare(marker["binding"], self._binding(user, marker["nonce"]))
+
+    def _binding(self, user, nonce):
+        # keyed with the secret key and the password hash, so a changed password no longer matches
+        return salted_hmac("users.throttle.verified", nonce, secret=settings.SECRET_KEY + user.password,
+                           algorithm="sha256").hexdigest()
+
+
+def get_login_throttle():
+    """
+    Retrieve the login throttle of this process, configured by the LOGIN_THROTTLE
+    setting.
+
+    Returns:
+        LoginThrottle: the login throttle
+    """
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            _throttle = LoginThrottle(**getattr(settings, "LOGIN_THROTTLE", DEFAULT_LOGIN_THROTTLE))
+    return _throttle
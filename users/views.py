@@ -1,67 +1,173 @@
+import json
+import math
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
-from rest_framework.response import Response
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render, redirect
 
+from .hashing import HashingPoolFull, get_hashing_pool
 from .serialiser import UserSerialiser
 from .models import AccountUser
+from .throttle import get_login_throttle
 
-class RegisterView(APIView):
-    def post(self, request):
+def request_data(request):
+    """
+    Parse the JSON body of a request, or its form data if it was not sent as JSON, as
+    request.data of DRF does for the views below, which are not DRF views.
+
+    Args:
+        request (HttpRequest): The request object.
+
+    Returns:
+        dict: The data of the request, or None if the JSON body is malformed.
+    """
+    if request.content_type != 'application/json':
+        return request.POST
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def bad_request():
+    """
+    Build the response sent when the body of a request is malformed.
+
+    Returns:
+        JsonResponse: A response object with a 400 status code.
+    """
+    return JsonResponse({'message': 'The request body is malformed'}, status=400)
+
+def hashing_pool_busy():
+    """
+    Build the response sent when a password could not be hashed because the password
+    hashing pool is full, asking the client to try again shortly.
+
+    Returns:
+        JsonResponse: A response object with a 429 status code and a Retry-After header.
+    """
+    return JsonResponse({'message': 'The server is busy, please try again shortly'}, status=429,
+                        headers={'Retry-After': '1'})
+
+def attempts_locked_out(seconds):
+    """
+    Build the response sent when password attempts are locked out after too many failed
+    attempts for the username or from the IP address of the client.
+
+    Args:
+        seconds (float): The seconds until the lockout ends.
+
+    Returns:
+        JsonResponse: A response object with a 429 status code and a Retry-After header.
+    """
+    retry_after = math.ceil(seconds)
+    return JsonResponse({'message': f'Too many failed attempts, please try again in {retry_after} seconds'},
+                        status=429, headers={'Retry-After': str(retry_after)})
+
+# The views which hash passwords are async views, so that a request waiting for the password
+# hashing pool holds no thread. A sync view served over ASGI runs on a thread of its own,
+# which would be blocked, along with the database connection it opened, for as long as the
+# password waited for a worker and was hashed. The session, the throttle and the database
+# are still used synchronously, through sync_to_async, in short steps between hashing.
+
+@method_decorator(csrf_exempt, name='dispatch')
+class RegisterView(View):
+    async def post(self, request):
         """
         Post request handler for RegisterView.
 
         Intended to create a new user account when a user signs up and submits their details.
 
         Args:
-            request (Request): The request object from the POST request.
+            request (HttpRequest): The request object from the POST request.
         
         Returns:
-            Response: A response object with a message that details errors in the input
+            JsonResponse: A response object with a message that details errors in the input
             provided, such as missing data, or a message with a link that the page should direct
-            the user to if the registration is successful.
+            the user to if the registration is successful. A 429 status code is returned if the
+            password could not be hashed as the server is busy.
         """
-        serialiser = UserSerialiser(data=request.data)
+        data = request_data(request)
+        if data is None:
+            return bad_request()
+
+        serialiser = UserSerialiser(data=data)
         
-        if not serialiser.is_valid():
-            return Response({'message': serialiser.errors}, status=400)
+        if not await sync_to_async(serialiser.is_valid)():
+            return JsonResponse({'message': serialiser.errors}, status=400)
         
-        serialiser.save()
-        request.session["username"] = request.data['username']
+        try:
+            password_hash = await get_hashing_pool().amake_password(serialiser.validated_data['password'])
+        except HashingPoolFull:
+            return hashing_pool_busy()
+        await sync_to_async(self.register)(request, serialiser, password_hash)
+
+        return JsonResponse({'message': "/auth/signin/"}, status=200)
 
-        return Response({'message': "/auth/signin/"}, status=200)
+    def register(self, request, serialiser, password_hash):
+        serialiser.save(password_hash=password_hash)
+        request.session["username"] = serialiser.validated_data['username']
 
-class LoginView(APIView):
-    def post(self, request):
+@method_decorator(csrf_exempt, name='dispatch')
+class LoginView(View):
+    async def post(self, request):
         """
         Post request handler for LoginView.
 
         Intended to authenticate a user when they submit their login credentials upon login.
 
         Args:
-            request (Request): The request object from the POST request.
+            request (HttpRequest): The request object from the POST request.
 
         Returns:
-            Response: A response object with an error message if the credentials do not match
+            JsonResponse: A response object with an error message if the credentials do not match
             some record in the database or a link that the page should direct the user too if 
-            the login is successful.
+            the login is successful. A 429 status code is returned if the password could not be
+            checked as the server is busy, or after too many failed attempts for the username or
+            from the IP address of the client.
         """
-        username = request.data['username']
-        password = request.data['password']
+        data = request_data(request)
+        if data is None or 'username' not in data or 'password' not in data:
+            return bad_request()
+
+        username = data['username']
+        password = data['password']
+        ip = request.META.get('REMOTE_ADDR')
+
+        # refuse locked out attempts before the password is hashed
+        throttle = get_login_throttle()
+        locked_for = await sync_to_async(throttle.locked_for)(username, ip)
+        if locked_for:
+            return attempts_locked_out(locked_for)
 
         try:
-            user = AccountUser.objects.get(username=username)
-            if not user.check_password(password):
-                return Response({'message': 'Account credentials could not be found'}, status=403)
-            request.session["username"] = username
+            user = await AccountUser.objects.aget(username=username)
+            if not await get_hashing_pool().acheck_password(user, password):
+                await sync_to_async(throttle.failed)(username, ip)
+                return JsonResponse({'message': 'Account credentials could not be found'}, status=403)
+            await sync_to_async(self.logged_in)(request, throttle, user)
 
-            return Response({'message': "/friends/"}, status=200)
+            return JsonResponse({'message': "/friends/"}, status=200)
         
         except AccountUser.DoesNotExist:
-            return Response({'message': 'Account credentials could not be found'}, status=403)
+            await sync_to_async(throttle.failed)(username, ip)
+            return JsonResponse({'message': 'Account credentials could not be found'}, status=403)
+
+        except HashingPoolFull:
+            return hashing_pool_busy()
+
+    def logged_in(self, request, throttle, user):
+        throttle.succeeded(user.username)
+        request.session["username"] = user.username
+        # the chat page verifies the password again as soon as it opens
+        throttle.mark_verified(request.session, user)
         
-class VerifyPassword(APIView):
-    def post(self, request):
+@method_decorator(csrf_exempt, name='dispatch')
+class VerifyPassword(View):
+    async def post(self, request):
         """
         Post request handler for VerifyPassword.
 
@@ -69,27 +175,64 @@ class VerifyPassword(APIView):
         use the client's username from request object but rather from the username is stored in the
         session. Used to verify the password that the user has provided the correct password to be
         used for derviving a PBKDF2 key used for encrypting and decrypting data stored in the client's
-        IndexDB database on the browser.
+        IndexDB database on the browser. The first verification after the session verified its
+        password, within the last few minutes, is accepted without hashing the password again.
 
         Args:
-            request (Request): The request object from the POST request.
+            request (HttpRequest): The request object from the POST request.
 
         Returns:
-            Response: A response object with a message that details if the password is valid or not.
+            JsonResponse: A response object with a message that details if the password is valid or not,
+            or a 429 status code if the password could not be checked as the server is busy or after
+            too many failed attempts.
         """
-        if "username" in request.session:
-            username = request.session["username"]
-            password = request.data["password"]
+        data = request_data(request)
+        if data is None or 'password' not in data:
+            return bad_request()
 
-            user = AccountUser.objects.get(username=username)
-            if not user.check_password(password):
-                return Response({'message': 'Password invalid'}, status=403)
-            
-            request.session["username"] = username
+        password = data["password"]
+        ip = request.META.get('REMOTE_ADDR')
+        throttle = get_login_throttle()
 
-            return Response({'message': 'Password valid'}, status=200)
-        
-        return Response({'message': 'Password invalid'}, status=403)
+        checked = await sync_to_async(self.check_session)(request, throttle, ip)
+        if checked is None:
+            return JsonResponse({'message': 'Password invalid'}, status=403)
+        user, verified, locked_for = checked
+        if verified:
+            return JsonResponse({'message': 'Password valid'}, status=200)
+        if locked_for:
+            return attempts_locked_out(locked_for)
+
+        try:
+            if not await get_hashing_pool().acheck_password(user, password):
+                await sync_to_async(throttle.failed)(user.username, ip)
+                return JsonResponse({'message': 'Password invalid'}, status=403)
+        except HashingPoolFull:
+            return hashing_pool_busy()
+        await sync_to_async(self.verified)(request, throttle, user)
+
+        return JsonResponse({'message': 'Password valid'}, status=200)
+
+    def check_session(self, request, throttle, ip):
+        """
+        Load the user of the session and check whether the session recently verified the
+        password, or password attempts for the user are locked out.
+
+        Returns:
+            tuple: The user, whether the password was recently verified and the seconds until
+            the lockout ends, or None if the client is not logged in.
+        """
+        if "username" not in request.session:
+            return None
+
+        user = AccountUser.objects.get(username=request.session["username"])
+        if throttle.recently_verified(request.session, user):
+            return user, True, 0
+        return user, False, throttle.locked_for(user.username, ip)
+
+    def verified(self, request, throttle, user):
+        throttle.succeeded(user.username)
+        throttle.mark_verified(request.session, user)
 
 class LogoutView(APIView):
     def get(self, request):